@@ -0,0 +1,586 @@
+"""
+FTP Sync Benchmark
+==================
+Замеры производительности RemoteFTPClient против локального pyftpdlib-сервера,
+который изображает удалённый FTP (с искусственной задержкой и ограничением канала).
+
+Генерирует синтетические деревья ftp_root и для каждого измеряет files/s, MB/s
+и число FTP-команд (round-trip) на файл для sync_all, upload_file,
+_list_remote_files и mirror_sync. Результаты пишутся в JSON, чтобы сравнивать
+их между коммитами:
+
+    python benchmark.py --scenario all --latency-ms 20
+    python benchmark.py --compare bench_results/before.json
+    python benchmark.py --engine asyncio --workers 200 --pool-size 200
+
+`--check-engines` прогоняет одни и те же операции через оба движка
+(remote_ftp.engine: ftplib и asyncio) и сверяет результаты и удалённые деревья.
+`--check-hashes` проверяет mirror с compare="checksum" против стенда, который
+умеет HASH, XSHA1, XMD5 и XCRC (у самого pyftpdlib их нет).
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import platform
+import zlib
+import tempfile
+import hashlib
+import argparse
+import threading
+import subprocess
+from pathlib import Path
+
+from pyftpdlib.authorizers import DummyAuthorizer
+from pyftpdlib.handlers import FTPHandler, DTPHandler
+from pyftpdlib.servers import ThreadedFTPServer
+
+import main
+
+APP_DIR = Path(__file__).parent
+RESULTS_DIR = APP_DIR / "bench_results"
+
+USER = "bench"
+PASSWORD = "bench"
+
+
+# ─── Стенд: локальный «удалённый» FTP ────────────────────────────────────────
+
+class StandInHandler(FTPHandler):
+    """FTPHandler, который считает команды и добавляет задержку перед каждым ответом."""
+
+    latency = 0.0
+    commands = 0
+    _lock = threading.Lock()
+
+    def pre_process_command(self, line, cmd, arg):
+        with StandInHandler._lock:
+            StandInHandler.commands += 1
+        if self.latency:
+            # ThreadedFTPServer: у каждого соединения свой поток, сон не тормозит остальных
+            time.sleep(self.latency)
+        return super().pre_process_command(line, cmd, arg)
+
+
+class HashingHandler(StandInHandler):
+    """Стенд с командой хеша файла: HASH (с OPTS HASH), XSHA1, XMD5 или XCRC.
+
+    FEAT объявляет только `hash_command`, чтобы клиент выбрал именно её.
+    XCRC отвечает в верхнем регистре и без ведущих нулей — как некоторые серверы.
+    """
+
+    hash_command = "HASH"
+    proto_cmds = {
+        **FTPHandler.proto_cmds,
+        **{
+            cmd: dict(perm="r", auth=True, arg=True, help=f"Syntax: {cmd} <SP> file-name.")
+            for cmd in ("HASH", "XSHA1", "XMD5", "XCRC")
+        },
+    }
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._hash_algo = "SHA-256"
+        if self.hash_command == "HASH":
+            self._extra_feats = [*self._extra_feats, "HASH " + ";".join(
+                f"{algo}*" if algo == self._hash_algo else algo for algo in main.HASH_ALGORITHMS
+            )]
+        else:
+            self._extra_feats = [*self._extra_feats, self.hash_command]
+
+    def ftp_OPTS(self, line):
+        cmd, _, arg = line.partition(" ")
+        if cmd.upper() != "HASH":
+            return super().ftp_OPTS(line)
+        if arg.upper() not in main.HASH_ALGORITHMS:
+            self.respond("501 Unknown algorithm.")
+            return
+        self._hash_algo = arg.upper()
+        self.respond(f"200 {self._hash_algo}")
+
+    # pyftpdlib уже перевёл аргумент команды с perm в путь файловой системы
+    def _digest(self, path: str, algo: str) -> str | None:
+        if not self.fs.isfile(path):
+            self.respond(f"550 {self.fs.fs2ftp(path)} is not retrievable.")
+            return None
+        return main.hash_file(path, main.HASH_ALGORITHMS[algo])
+
+    def ftp_HASH(self, path):
+        if self.hash_command != "HASH":
+            return self.respond("502 Command not implemented.")
+        digest = self._digest(path, self._hash_algo)
+        if digest is not None:
+            size = os.path.getsize(path)
+            self.respond(f"213 {self._hash_algo} 0-{max(0, size - 1)} {digest} {self.fs.fs2ftp(path)}")
+
+    def ftp_XSHA1(self, path):
+        self._reply_x("XSHA1", "SHA-1", path)
+
+    def ftp_XMD5(self, path):
+        self._reply_x("XMD5", "MD5", path)
+
+    def ftp_XCRC(self, path):
+        self._reply_x("XCRC", "CRC32", path)
+
+    def _reply_x(self, cmd: str, algo: str, path: str):
+        if self.hash_command != cmd:
+            return self.respond("502 Command not implemented.")
+        digest = self._digest(path, algo)
+        if digest is not None:
+            if algo == "CRC32":
+                digest = f"{int(digest, 16):X}"
+            self.respond(f"250 {digest}")
+
+
+class SharedLinkDTPHandler(DTPHandler):
+    """Канал данных, делящий одну полосу на все соединения стенда.
+
+    ThrottledDTPHandler из pyftpdlib ограничивает каждое соединение отдельно и только
+    после первых read_limit байт, то есть мелкие файлы не тормозит вовсе.
+    """
+
+    link: main.TokenBucket
+
+    def use_sendfile(self):
+        return False
+
+    def recv(self, buffer_size):
+        chunk = super().recv(buffer_size)
+        self.link.consume(len(chunk))
+        return chunk
+
+    def send(self, data):
+        sent = super().send(data)
+        self.link.consume(sent)
+        return sent
+
+
+class StandInRemote:
+    """pyftpdlib-сервер на 127.0.0.1 со случайным портом и временной корневой папкой."""
+
+    def __init__(self, latency_ms: float = 0, bandwidth_kib: int = 0, hash_command: str = ""):
+        self.root = tempfile.mkdtemp(prefix="ftp_bench_remote_")
+        authorizer = DummyAuthorizer()
+        authorizer.add_user(USER, PASSWORD, self.root, perm="elradfmwMT")
+
+        if hash_command:
+            handler = type("BenchHandler", (HashingHandler,), {"hash_command": hash_command})
+        else:
+            handler = type("BenchHandler", (StandInHandler,), {})
+        handler.authorizer = authorizer
+        handler.latency = latency_ms / 1000
+        if bandwidth_kib:
+            dtp = type("BenchDTPHandler", (SharedLinkDTPHandler,), {})
+            dtp.link = main.TokenBucket(bandwidth_kib * 1024)
+            handler.dtp_handler = dtp
+
+        logging.getLogger("pyftpdlib").setLevel(logging.WARNING)
+        self.server = ThreadedFTPServer(("127.0.0.1", 0), handler)
+        self.port = self.server.socket.getsockname()[1]
+        self._stopping = threading.Event()
+        self._thread = threading.Thread(target=self._serve, daemon=True)
+
+    def _serve(self):
+        # close_all() из чужого потока гонялся бы с ioloop сервера: тот при выходе закрывает
+        # свои дескрипторы ещё раз, а их номера к тому времени заняты соединениями следующего стенда
+        while not self._stopping.is_set():
+            self.server.serve_forever(timeout=0.05, blocking=False)
+        self.server.close_all()
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stopping.set()
+        self._thread.join()
+        # CWD в pyftpdlib меняет текущую папку процесса — из удаляемого root нужно уйти,
+        # иначе CWD на следующем стенде падает на os.getcwd()
+        os.chdir(APP_DIR)
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def clear(self):
+        """Очищает удалённую папку между замерами."""
+        for entry in os.scandir(self.root):
+            if entry.is_dir():
+                shutil.rmtree(entry.path, ignore_errors=True)
+            else:
+                os.remove(entry.path)
+
+    @staticmethod
+    def reset_commands() -> int:
+        with StandInHandler._lock:
+            count, StandInHandler.commands = StandInHandler.commands, 0
+        return count
+
+
+# ─── Синтетические деревья ───────────────────────────────────────────────────
+
+def _write(path: Path, size: int):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "wb") as f:
+        chunk = os.urandom(min(size, 1024 * 1024)) if size else b""
+        left = size
+        while left > 0:
+            f.write(chunk[:left])
+            left -= len(chunk)
+
+
+def make_tiny(root: Path, scale: float):
+    """Много мелких файлов: 2000 × 1 КБ по 20 директориям."""
+    for i in range(int(2000 * scale)):
+        _write(root / f"dir{i % 20:02d}" / f"file{i:05d}.txt", 1024)
+
+
+def make_huge(root: Path, scale: float):
+    """Несколько больших файлов: 4 × 64 МБ."""
+    for i in range(4):
+        _write(root / f"big{i}.bin", int(64 * 1024 * 1024 * scale))
+
+
+def make_deep(root: Path, scale: float):
+    """Глубокая вложенность: 20 веток по 12 уровней, по 2 файла на уровень."""
+    for branch in range(max(1, int(20 * scale))):
+        level = root / f"branch{branch:02d}"
+        for depth in range(12):
+            level = level / f"level{depth:02d}"
+            for i in range(2):
+                _write(level / f"f{i}.dat", 4096)
+
+
+SCENARIOS = {"tiny": make_tiny, "huge": make_huge, "deep": make_deep}
+
+
+# ─── Замеры ──────────────────────────────────────────────────────────────────
+
+def tree_stats(root: Path) -> tuple[int, int]:
+    files = 0
+    size = 0
+    for path in root.rglob("*"):
+        if path.is_file():
+            files += 1
+            size += path.stat().st_size
+    return files, size
+
+
+def measure(scenario: str, operation: str, files: int, size: int, fn) -> dict:
+    StandInRemote.reset_commands()
+    started = time.perf_counter()
+    fn()
+    seconds = time.perf_counter() - started
+    commands = StandInRemote.reset_commands()
+    result = {
+        "scenario": scenario,
+        "operation": operation,
+        "files": files,
+        "bytes": size,
+        "seconds": round(seconds, 4),
+        "files_per_sec": round(files / seconds, 1) if seconds else None,
+        "mb_per_sec": round(size / seconds / 1024 / 1024, 2) if seconds else None,
+        "commands": commands,
+        "commands_per_file": round(commands / files, 2) if files else None,
+    }
+    print(
+        f"  {operation:<24} {seconds:8.2f}s  {result['files_per_sec'] or 0:9.1f} files/s  "
+        f"{result['mb_per_sec'] or 0:8.2f} MB/s  {result['commands_per_file'] or 0:6.2f} cmd/file"
+    )
+    return result
+
+
+def make_client(remote: StandInRemote, args, engine: str, manifest=None, remote_index=None) -> main.RemoteFTPClient:
+    return main.REMOTE_ENGINES[engine](
+        "127.0.0.1", remote.port, USER, PASSWORD,
+        pool_size=args.pool_size, keepalive=0, workers=args.workers,
+        block_size=args.block_kib * 1024, use_sendfile=not args.no_sendfile,
+        manifest=manifest, remote_index=remote_index,
+    )
+
+
+def run_scenario(name: str, remote: StandInRemote, args) -> list[dict]:
+    local_root = Path(tempfile.mkdtemp(prefix=f"ftp_bench_{name}_"))
+    db_path = Path(tempfile.mkdtemp(prefix="ftp_bench_db_")) / "bench.db"
+    manifest = main.SyncManifest(db_path)
+    remote_index = main.RemoteIndex(db_path)
+    results = []
+
+    def client(with_manifest: bool = True) -> main.RemoteFTPClient:
+        return make_client(remote, args, args.engine, manifest if with_manifest else None)
+
+    try:
+        SCENARIOS[name](local_root, args.scale)
+        files, size = tree_stats(local_root)
+        print(f"[{name}] {files} файлов, {size / 1024 / 1024:.1f} МБ")
+
+        # Локальный обход без сервера: разовый и повторный по снимку директорий
+        scanner = main.LocalScanner(local_root)
+        results.append(measure(name, "local_scan", files, 0, lambda: sum(1 for _ in scanner.scan())))
+        results.append(measure(name, "local_scan_snapshot", files, 0, lambda: sum(1 for _ in scanner.scan())))
+
+        remote.clear()
+        c = client()
+        results.append(measure(name, "sync_all_cold", files, size, lambda: c.sync_all(local_root)))
+        results.append(measure(name, "sync_all_unchanged", files, 0, lambda: c.sync_all(local_root)))
+        c.close()
+
+        # upload_file по одному, последовательно: задержка на файл без параллелизма
+        sample = sorted(p for p in local_root.rglob("*") if p.is_file())[:args.sample]
+        sample_size = sum(p.stat().st_size for p in sample)
+        remote.clear()
+        c = client(with_manifest=False)
+
+        def upload_each():
+            for path in sample:
+                c.upload_file(path, path.relative_to(local_root).as_posix())
+
+        results.append(measure(name, "upload_file_sequential", len(sample), sample_size, upload_each))
+        c.close()
+
+        remote.clear()
+        c = client(with_manifest=False)
+        c.sync_all(local_root)
+        c.close()
+
+        c = client(with_manifest=False)
+        results.append(measure(name, "list_remote_files", files, 0, c._list_remote_files))
+        c.close()
+
+        c = make_client(remote, args, args.engine, remote_index=remote_index)
+        results.append(measure(
+            name, "mirror_sync_unchanged", files, 0,
+            lambda: c.mirror_sync(local_root, delete_orphans=True, compare="size"),
+        ))
+        # Индекс заполнен полным листингом выше — дальше только MLST директорий
+        results.append(measure(
+            name, "mirror_sync_incremental", files, 0,
+            lambda: c.mirror_sync(local_root, delete_orphans=True, compare="size", full_listing_days=7),
+        ))
+        c.close()
+    finally:
+        manifest.close()
+        remote_index.close()
+        shutil.rmtree(local_root, ignore_errors=True)
+        shutil.rmtree(db_path.parent, ignore_errors=True)
+    return results
+
+
+# ─── Сверка движков ─────────────────────────────────────────────────────────
+
+def remote_tree(root: str) -> dict[str, str]:
+    """{путь: sha1 содержимого} файлов стенда; директории — с пустым значением."""
+    tree = {}
+    for path in Path(root).rglob("*"):
+        rel = path.relative_to(root).as_posix()
+        tree[rel] = hashlib.sha1(path.read_bytes()).hexdigest() if path.is_file() else ""
+    return tree
+
+
+def engine_run(remote: StandInRemote, args, engine: str, local_root: Path) -> list:
+    """Одинаковая последовательность операций; возвращает сравнимые снимки после каждой."""
+    remote.clear()
+    snapshots = []
+    c = make_client(remote, args, engine)
+    try:
+        synced, failed = c.sync_all(local_root)
+        snapshots.append(("sync_all", sorted(synced), sorted(failed), remote_tree(remote.root)))
+        snapshots.append(("list_remote_files", c._list_remote_files()))
+
+        big = local_root / "big.bin"
+        c.put_file(big, "nested/deeper/big.bin")
+        snapshots.append(("put_file", remote_tree(remote.root)))
+
+        # Orphan-файлы и пустеющие директории для mirror: удаляем локально каждый третий
+        removed = sorted(p for p in local_root.rglob("*.txt"))[::3]
+        for path in removed:
+            path.rename(path.with_suffix(".keep"))
+        try:
+            result = c.mirror_sync(local_root, delete_orphans=True, compare="size")
+        finally:
+            for path in removed:
+                path.with_suffix(".keep").rename(path)
+        snapshots.append(("mirror_sync", *(sorted(r) for r in result), remote_tree(remote.root)))
+
+        c.delete_file("nested/deeper/big.bin")
+        c.delete_file("nested/deeper/missing.bin")
+        snapshots.append(("delete_file", remote_tree(remote.root)))
+    finally:
+        c.close()
+    return snapshots
+
+
+def check_engines(remote: StandInRemote, args) -> bool:
+    local_root = Path(tempfile.mkdtemp(prefix="ftp_bench_engines_"))
+    try:
+        make_tiny(local_root / "tiny", args.scale / 10)
+        make_deep(local_root / "deep", args.scale / 10)
+        _write(local_root / "big.bin", 3 * 1024 * 1024 + 17)
+        runs = {engine: engine_run(remote, args, engine, local_root) for engine in main.REMOTE_ENGINES}
+    finally:
+        shutil.rmtree(local_root, ignore_errors=True)
+
+    reference, *others = runs
+    ok = True
+    for engine in others:
+        for expected, got in zip(runs[reference], runs[engine]):
+            same = expected == got
+            ok = ok and same
+            print(f"  {expected[0]:<20} {reference} vs {engine}: {'совпадает' if same else 'РАЗЛИЧАЕТСЯ'}")
+    return ok
+
+
+# ─── Сверка по хешам ────────────────────────────────────────────────────────
+
+def _crc_with_leading_zero(size: int) -> bytes:
+    """Содержимое, у которого CRC32 начинается с нуля: на нём видно, как сравниваются XCRC."""
+    n = 0
+    while True:
+        data = n.to_bytes(8, "little") * (size // 8)
+        if zlib.crc32(data) < 0x10000000:
+            return data
+        n += 1
+
+
+def check_hashes(args) -> bool:
+    """mirror_sync(compare="checksum") против стенда с каждой из команд хеша.
+
+    После первой выгрузки повторный проход ничего не грузит; файл, изменённый
+    без изменения размера, загружается заново — и только он.
+    """
+    ok = True
+    for command in ("HASH", "XSHA1", "XMD5", "XCRC"):
+        remote = StandInRemote(hash_command=command)
+        remote.start()
+        local_root = Path(tempfile.mkdtemp(prefix="ftp_bench_hashes_"))
+        try:
+            make_tiny(local_root, args.scale / 20)
+            (local_root / "zero_crc.bin").write_bytes(_crc_with_leading_zero(4096))
+            c = make_client(remote, args, args.engine)
+            try:
+                c.sync_all(local_root)
+                unchanged = c.mirror_sync(local_root, delete_orphans=False, compare="checksum")[0]
+                changed_file = sorted(local_root.rglob("*.txt"))[0]
+                data = bytearray(changed_file.read_bytes())
+                data[0] ^= 0xFF
+                changed_file.write_bytes(data)
+                changed = c.mirror_sync(local_root, delete_orphans=False, compare="checksum")[0]
+            finally:
+                c.close()
+            expected = [changed_file.relative_to(local_root).as_posix()]
+            passed = not unchanged and sorted(changed) == expected
+            ok = ok and passed
+            print(
+                f"  {command:<6} без изменений загружено {len(unchanged)}, после правки {len(changed)}: "
+                f"{'верно' if passed else 'ОШИБКА'}"
+            )
+        finally:
+            remote.stop()
+            shutil.rmtree(local_root, ignore_errors=True)
+    return ok
+
+
+# ─── Результаты ──────────────────────────────────────────────────────────────
+
+def git_commit() -> str | None:
+    try:
+        out = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=APP_DIR,
+            capture_output=True, text=True, timeout=10,
+        )
+        return out.stdout.strip() or None
+    except OSError:
+        return None
+
+
+def compare(current: dict, baseline_path: Path):
+    """Печатает изменение времени и команд на файл относительно прошлого прогона."""
+    baseline = json.loads(baseline_path.read_text(encoding="utf-8"))
+    before = {(r["scenario"], r["operation"]): r for r in baseline["results"]}
+    print(f"\nСравнение с {baseline_path.name} (коммит {baseline['meta'].get('commit')}):")
+    for r in current["results"]:
+        old = before.get((r["scenario"], r["operation"]))
+        if not old or not old["seconds"]:
+            continue
+        delta = (r["seconds"] - old["seconds"]) / old["seconds"] * 100
+        print(
+            f"  {r['scenario']:<6} {r['operation']:<24} {old['seconds']:8.2f}s -> {r['seconds']:8.2f}s "
+            f"({delta:+6.1f}%)  cmd/file {old['commands_per_file']} -> {r['commands_per_file']}"
+        )
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Замеры RemoteFTPClient против локального FTP-стенда")
+    parser.add_argument("--scenario", choices=[*SCENARIOS, "all"], default="all")
+    parser.add_argument("--scale", type=float, default=1.0, help="Множитель размера деревьев")
+    parser.add_argument("--latency-ms", type=float, default=0, help="Задержка стенда на каждую команду, мс")
+    parser.add_argument("--bandwidth-kib", type=int, default=0, help="Ограничение канала стенда, КБ/с (0 — нет)")
+    parser.add_argument("--workers", type=int, default=main.CONFIG["sync_workers"])
+    parser.add_argument("--pool-size", type=int, default=main.CONFIG["remote_targets"][0]["pool_size"])
+    parser.add_argument("--block-kib", type=int, default=main.CONFIG["transfer_block_kib"],
+                        help="Блок канала данных, КБ (0 — по размеру файла)")
+    parser.add_argument("--no-sendfile", action="store_true", default=not main.CONFIG["transfer_sendfile"],
+                        help="Передавать через буфер, а не socket.sendfile")
+    parser.add_argument("--engine", choices=list(main.REMOTE_ENGINES),
+                        default=main.CONFIG["remote_targets"][0]["engine"], help="Движок удалённого FTP")
+    parser.add_argument("--check-engines", action="store_true",
+                        help="Сверить результаты движков ftplib и asyncio вместо замеров")
+    parser.add_argument("--check-hashes", action="store_true",
+                        help="Проверить mirror по хешам (HASH, XSHA1, XMD5, XCRC) вместо замеров")
+    parser.add_argument("--sample", type=int, default=50, help="Сколько файлов грузить через upload_file по одному")
+    parser.add_argument("--output", type=Path, help="Куда записать JSON (по умолчанию bench_results/)")
+    parser.add_argument("--compare", type=Path, help="JSON прошлого прогона для сравнения")
+    args = parser.parse_args()
+
+    # Лог каждого файла в ftp_sync.log искажал бы замеры
+    main.logger.setLevel(logging.WARNING)
+
+    if args.check_hashes:
+        ok = check_hashes(args)
+        print("Сверка по хешам работает" if ok else "Сверка по хешам ошибается")
+        sys.exit(0 if ok else 1)
+
+    remote = StandInRemote(args.latency_ms, args.bandwidth_kib)
+    remote.start()
+    if args.check_engines:
+        try:
+            ok = check_engines(remote, args)
+        finally:
+            remote.stop()
+        print("Движки дают одинаковый результат" if ok else "Результаты движков различаются")
+        sys.exit(0 if ok else 1)
+
+    results = []
+    try:
+        for name in (SCENARIOS if args.scenario == "all" else [args.scenario]):
+            results.extend(run_scenario(name, remote, args))
+    finally:
+        remote.stop()
+
+    commit = git_commit()
+    report = {
+        "meta": {
+            "commit": commit,
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": sys.version.split()[0],
+            "platform": platform.platform(),
+            "params": {
+                "scenario": args.scenario, "scale": args.scale,
+                "latency_ms": args.latency_ms, "bandwidth_kib": args.bandwidth_kib,
+                "workers": args.workers, "pool_size": args.pool_size, "sample": args.sample,
+                "block_kib": args.block_kib, "sendfile": not args.no_sendfile, "engine": args.engine,
+            },
+        },
+        "results": results,
+    }
+
+    output = args.output or RESULTS_DIR / f"{time.strftime('%Y%m%d-%H%M%S')}_{commit or 'nogit'}.json"
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(report, indent=2, ensure_ascii=False), encoding="utf-8")
+    print(f"\nРезультаты: {output}")
+
+    if args.compare:
+        compare(report, args.compare)
+
+
+if __name__ == "__main__":
+    main_cli()
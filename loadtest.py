@@ -0,0 +1,248 @@
+"""
+FTP Sync Load Test
+==================
+Нагрузочный тест встроенного FTP-сервера (local_ftp): сколько данных он
+принимает в устойчивом режиме при множестве одновременных клиентов.
+
+Для каждого движка (local_ftp.engine: async, threaded, multiprocess) поднимает
+сервер из main.build_local_ftp_server на временном каталоге, запускает N клиентов
+ftplib, каждый из которых грузит свои файлы, и считает MB/s, files/s и время
+приёма одного файла (p50/p95). Заодно проверяет, что событие «файл принят»
+дошло до диспетчера по каждому файлу. Результаты пишутся в JSON:
+
+    python loadtest.py --clients 50 --files 20 --size-kib 512
+    python loadtest.py --engine threaded --clients 200 --write-delay-ms 5
+
+`--write-delay-ms` добавляет задержку к каждой записи на диск — так медленный
+диск (антивирус, сетевой том) тормозит однопоточный async сильнее всего.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import ftplib
+import logging
+import platform
+import tempfile
+import argparse
+import threading
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+import main
+from benchmark import git_commit
+
+APP_DIR = Path(__file__).parent
+RESULTS_DIR = APP_DIR / "bench_results"
+
+USER = "load"
+PASSWORD = "load"
+
+
+class ReceivedCounter:
+    """Вместо UploadDispatcher: только считает события приёма."""
+
+    def __init__(self):
+        self.received = 0
+        self.incomplete = 0
+        self._lock = threading.Lock()
+
+    def hold(self, file):
+        pass
+
+    def release(self, file):
+        pass
+
+    def submit(self, file, ready=False):
+        with self._lock:
+            self.received += 1
+
+    def discard(self, file):
+        with self._lock:
+            self.incomplete += 1
+
+
+class SlowDiskFile:
+    """Файл, каждая запись в который ждёт write_delay секунд."""
+
+    def __init__(self, f, delay: float):
+        self._f = f
+        self._delay = delay
+
+    def write(self, data):
+        time.sleep(self._delay)
+        return self._f.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self._f, name)
+
+
+def slow_disk(handler_class, delay: float):
+    """Оборачивает файлы, открываемые FTP-сервером на запись."""
+    fs_class = handler_class.abstracted_fs
+
+    class SlowFS(fs_class):
+        def open(self, filename, mode):
+            f = super().open(filename, mode)
+            return SlowDiskFile(f, delay) if "w" in mode or "a" in mode else f
+
+    handler_class.abstracted_fs = SlowFS
+    return fs_class
+
+
+def client_upload(port: int, client: int, files: int, payload: bytes) -> list[float]:
+    """Один клиент: логин и files загрузок подряд. Возвращает время каждой."""
+    timings = []
+    ftp = ftplib.FTP()
+    ftp.connect("127.0.0.1", port, timeout=120)
+    ftp.login(USER, PASSWORD)
+    try:
+        for n in range(files):
+            started = time.perf_counter()
+            ftp.storbinary(f"STOR c{client:04d}_{n:04d}.bin", _Payload(payload))
+            timings.append(time.perf_counter() - started)
+    finally:
+        ftp.quit()
+    return timings
+
+
+class _Payload:
+    """Поток из готовых байт без копии на каждый файл."""
+
+    def __init__(self, data: bytes):
+        self._view = memoryview(data)
+        self._pos = 0
+
+    def read(self, size=-1):
+        if size < 0:
+            size = len(self._view)
+        chunk = self._view[self._pos:self._pos + size]
+        self._pos += len(chunk)
+        return chunk
+
+
+def percentile(values: list[float], share: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * share))]
+
+
+def run_engine(engine: str, args) -> dict:
+    root = Path(tempfile.mkdtemp(prefix=f"ftp_load_{engine}_"))
+    counter = ReceivedCounter()
+    main.upload_dispatcher = counter
+    main.CONFIG.update({
+        "local_ftp_engine": engine,
+        "local_ftp_user": USER,
+        "local_ftp_pass": PASSWORD,
+        "local_ftp_perm": "elradfmw",
+        "local_ftp_max_cons": args.clients * 2 + 10,
+        "local_ftp_max_cons_per_ip": args.clients * 2 + 10,
+        "local_ftp_read_buffer": args.read_buffer_kib * 1024,
+        "local_ftp_write_buffer": args.write_buffer_kib * 1024,
+        "local_ftp_sendfile": not args.no_sendfile,
+    })
+    original_fs = slow_disk(main.SyncFTPHandler, args.write_delay_ms / 1000) if args.write_delay_ms else None
+    server = main.build_local_ftp_server(root, ("127.0.0.1", 0))
+    port = server.address[1]
+    serving = threading.Thread(target=server.serve_forever, daemon=True)
+    serving.start()
+
+    payload = os.urandom(args.size_kib * 1024)
+    total_files = args.clients * args.files
+    timings: list[float] = []
+    errors = 0
+    started = time.perf_counter()
+    try:
+        with ThreadPoolExecutor(max_workers=args.clients) as pool:
+            futures = [pool.submit(client_upload, port, c, args.files, payload) for c in range(args.clients)]
+            for future in futures:
+                try:
+                    timings.extend(future.result())
+                except (OSError, ftplib.Error) as e:
+                    errors += 1
+                    print(f"  ошибка клиента: {e}")
+        seconds = time.perf_counter() - started
+        # События из процессов multiprocess приходят через очередь — даём им дойти
+        deadline = time.monotonic() + 10
+        while counter.received < len(timings) and time.monotonic() < deadline:
+            time.sleep(0.05)
+    finally:
+        server.close_all()
+        if original_fs:
+            main.SyncFTPHandler.abstracted_fs = original_fs
+        main.upload_dispatcher = None
+        shutil.rmtree(root, ignore_errors=True)
+
+    size = len(timings) * len(payload)
+    result = {
+        "engine": engine,
+        "clients": args.clients,
+        "files": len(timings),
+        "bytes": size,
+        "seconds": round(seconds, 4),
+        "files_per_sec": round(len(timings) / seconds, 1) if seconds else None,
+        "mb_per_sec": round(size / seconds / 1024 / 1024, 2) if seconds else None,
+        "file_p50_ms": round(percentile(timings, 0.5) * 1000, 1) if timings else None,
+        "file_p95_ms": round(percentile(timings, 0.95) * 1000, 1) if timings else None,
+        "client_errors": errors,
+        "events_received": counter.received,
+        "events_missing": total_files - counter.received,
+    }
+    print(
+        f"  {engine:<13} {seconds:8.2f}s  {result['mb_per_sec'] or 0:8.2f} MB/s  "
+        f"{result['files_per_sec'] or 0:9.1f} files/s  p95 {result['file_p95_ms'] or 0:8.1f} ms  "
+        f"событий {counter.received}/{total_files}"
+    )
+    return result
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест встроенного FTP-сервера по движкам")
+    parser.add_argument("--engine", choices=[*main.LOCAL_FTP_ENGINES, "all"], default="all")
+    parser.add_argument("--clients", type=int, default=50, help="Одновременных клиентов")
+    parser.add_argument("--files", type=int, default=20, help="Файлов на клиента")
+    parser.add_argument("--size-kib", type=int, default=256, help="Размер файла, КБ")
+    parser.add_argument("--write-delay-ms", type=float, default=0, help="Задержка каждой записи на диск, мс")
+    parser.add_argument("--read-buffer-kib", type=int, default=main.CONFIG["local_ftp_read_buffer"] // 1024)
+    parser.add_argument("--write-buffer-kib", type=int, default=main.CONFIG["local_ftp_write_buffer"] // 1024)
+    parser.add_argument("--no-sendfile", action="store_true", default=not main.CONFIG["local_ftp_sendfile"])
+    parser.add_argument("--output", type=Path, help="Куда записать JSON (по умолчанию bench_results/)")
+    args = parser.parse_args()
+
+    main.logger.setLevel(logging.WARNING)
+
+    engines = list(main.LOCAL_FTP_ENGINES) if args.engine == "all" else [args.engine]
+    results = []
+    print(f"{args.clients} клиентов x {args.files} файлов x {args.size_kib} КБ:")
+    for engine in engines:
+        if main.LOCAL_FTP_ENGINES[engine] is None:
+            print(f"  {engine:<13} недоступен на этой системе, пропущен")
+            continue
+        results.append(run_engine(engine, args))
+
+    commit = git_commit()
+    report = {
+        "meta": {
+            "commit": commit,
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": sys.version.split()[0],
+            "platform": platform.platform(),
+            "params": {
+                "clients": args.clients, "files": args.files, "size_kib": args.size_kib,
+                "write_delay_ms": args.write_delay_ms, "read_buffer_kib": args.read_buffer_kib,
+                "write_buffer_kib": args.write_buffer_kib, "sendfile": not args.no_sendfile,
+            },
+        },
+        "results": results,
+    }
+    output = args.output or RESULTS_DIR / f"load_{time.strftime('%Y%m%d-%H%M%S')}_{commit or 'nogit'}.json"
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(report, indent=2, ensure_ascii=False), encoding="utf-8")
+    print(f"\nРезультаты: {output}")
+    sys.exit(1 if any(r["client_errors"] or r["events_missing"] for r in results) else 0)
+
+
+if __name__ == "__main__":
+    main_cli()
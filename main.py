@@ -12,27 +12,49 @@ import os
 import sys
 import json
 import time
+import zlib
+import hashlib
+import calendar
+import asyncio
+import base64
+import bisect
 import ctypes
+import fnmatch
+import heapq
+import random
 import ftplib
 import socket
+import ssl
+import sqlite3
 import logging
+import operator
 import threading
+import uuid
+import contextvars
+import multiprocessing
+from collections import deque
 from pathlib import Path
-from contextlib import asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from contextlib import asynccontextmanager, contextmanager
 
-from fastapi import FastAPI, HTTPException
+# От этого момента считается время до приёма первых подключений (см. mark_startup)
+PROCESS_STARTED = time.monotonic()
+
+# fastapi, uvicorn, pystray и PIL импортируются там, где нужны: create_app(), run_api_server(), run_tray()
 from pydantic import BaseModel, Field
 
 from pyftpdlib.authorizers import DummyAuthorizer
-from pyftpdlib.handlers import FTPHandler
-from pyftpdlib.servers import FTPServer
+from pyftpdlib.handlers import DTPHandler, FTPHandler
+from pyftpdlib.servers import FTPServer, ThreadedFTPServer
+try:
+    from pyftpdlib.servers import MultiprocessFTPServer
+except ImportError:
+    # Есть только на POSIX
+    MultiprocessFTPServer = None
 
 from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
 
-import pystray
-from PIL import Image, ImageDraw
-
 # ─── Определение рабочей директории (для PyInstaller EXE) ────────────────────
 
 if getattr(sys, "frozen", False):
@@ -42,6 +64,7 @@ else:
 
 CONFIG_PATH = APP_DIR / "config.json"
 LOG_PATH = APP_DIR / "ftp_sync.log"
+STATE_DB_PATH = APP_DIR / "ftp_sync.db"
 
 # ─── Перенаправление stdout/stderr для --noconsole режима ────────────────────
 
@@ -57,6 +80,68 @@ def show_error(message: str):
     ctypes.windll.user32.MessageBoxW(0, message, "FTP Sync Server - Ошибка", 0x10)
 
 
+def parse_remote_targets(remote: dict | list, mirror: dict) -> list[dict]:
+    """Секция remote_ftp — один сервер (объект) или несколько (список объектов)."""
+    targets = []
+    for index, item in enumerate(remote if isinstance(remote, list) else [remote]):
+        targets.append({
+            "name": str(item.get("name", f"remote{index + 1}")),
+            "host": item.get("host", "ftp.example.com"),
+            "port": int(item.get("port", 21)),
+            "user": item.get("user", "remoteuser"),
+            "password": item.get("password", "remotepass"),
+            "root": item.get("root", "/"),
+            "tls": bool(item.get("tls", False)),
+            "pool_size": int(item.get("pool_size", 4)),
+            "keepalive": int(item.get("keepalive_seconds", 60)),
+            "engine": item.get("engine", "ftplib"),
+            "concurrency": int(item.get("concurrency", 0)),
+            "mirror_interval_days": int(item.get("mirror_interval_days", mirror.get("interval_days", 3))),
+        })
+    for t in targets:
+        if t["engine"] not in ("ftplib", "asyncio"):
+            show_error(f"remote_ftp.engine сервера {t['name']}: ожидается ftplib или asyncio, получено {t['engine']!r}")
+            sys.exit(1)
+    names = [t["name"] for t in targets]
+    if not targets or len(set(names)) != len(names):
+        show_error(f"remote_ftp: нужен хотя бы один сервер, имена (name) не должны повторяться: {names}")
+        sys.exit(1)
+    return targets
+
+
+def parse_time_windows(values: list[str]) -> list[tuple[int, int]]:
+    """Окна вида "01:00-06:30" (локальное время) -> [(начало, конец)] в минутах от полуночи.
+
+    Окно, у которого конец раньше начала, переходит через полночь.
+    """
+    windows = []
+    for value in values:
+        try:
+            start, end = (
+                int(h) * 60 + int(m)
+                for h, m in (part.strip().split(":") for part in value.split("-"))
+            )
+            if not (0 <= start < 1440 and 0 <= end <= 1440):
+                raise ValueError
+        except ValueError:
+            show_error(f"mirror.windows: ожидается окно ЧЧ:ММ-ЧЧ:ММ, получено {value!r}")
+            sys.exit(1)
+        windows.append((start, end))
+    return windows
+
+
+def parse_port_range(value: str) -> range:
+    """Диапазон пассивных портов "60000-60099" (включительно) -> range."""
+    try:
+        first, last = (int(part) for part in str(value).split("-"))
+        if not 1 <= first <= last <= 65535:
+            raise ValueError
+    except ValueError:
+        show_error(f"local_ftp.passive_ports: ожидается диапазон вида 60000-60099, получено {value!r}")
+        sys.exit(1)
+    return range(first, last + 1)
+
+
 def load_config(path: Path) -> dict:
     """Читает config.json и возвращает плоский словарь конфигурации."""
     if not path.exists():
@@ -74,6 +159,15 @@ def load_config(path: Path) -> dict:
     remote = raw.get("remote_ftp", {})
     sync = raw.get("sync", {})
     mirror = raw.get("mirror", {})
+    transfer = raw.get("transfer", {})
+    queue = raw.get("queue", {})
+
+    if mirror.get("mode", "burst") not in ("burst", "rolling"):
+        show_error(f"mirror.mode: ожидается burst или rolling, получено {mirror['mode']!r}")
+        sys.exit(1)
+    if local.get("engine", "async") not in ("async", "threaded", "multiprocess"):
+        show_error(f"local_ftp.engine: ожидается async, threaded или multiprocess, получено {local['engine']!r}")
+        sys.exit(1)
 
     return {
         "local_ftp_host": local.get("host", "0.0.0.0"),
@@ -82,19 +176,49 @@ def load_config(path: Path) -> dict:
         "local_ftp_pass": local.get("password", "localpass"),
         "local_ftp_root": local.get("root", "./ftp_root"),
         "local_ftp_perm": local.get("permissions", "elradfmw"),
-
-        "remote_ftp_host": remote.get("host", "ftp.example.com"),
-        "remote_ftp_port": int(remote.get("port", 21)),
-        "remote_ftp_user": remote.get("user", "remoteuser"),
-        "remote_ftp_pass": remote.get("password", "remotepass"),
-        "remote_ftp_root": remote.get("root", "/"),
-        "remote_ftp_tls": bool(remote.get("tls", False)),
+        "local_ftp_engine": local.get("engine", "async"),
+        "local_ftp_max_cons": int(local.get("max_cons", 50)),
+        "local_ftp_max_cons_per_ip": int(local.get("max_cons_per_ip", 10)),
+        "local_ftp_passive_ports": parse_port_range(local.get("passive_ports", "60000-60099")),
+        "local_ftp_read_buffer": int(local.get("read_buffer_kib", 64)) * 1024,
+        "local_ftp_write_buffer": int(local.get("write_buffer_kib", 64)) * 1024,
+        "local_ftp_sendfile": bool(local.get("use_sendfile", True)),
+
+        # Список словарей: name, host, port, user, password, root, tls, pool_size, keepalive,
+        # engine, concurrency, mirror_interval_days
+        "remote_targets": parse_remote_targets(remote, mirror),
 
         "sync_interval": int(sync.get("interval_seconds", 30)),
         "sync_on_upload": bool(sync.get("on_upload", True)),
+        "sync_workers": int(sync.get("workers", 4)),
+        "sync_quiet_seconds": float(sync.get("quiet_seconds", 2.0)),
+        "sync_watch_filesystem": bool(sync.get("watch_filesystem", True)),
+        "sync_rescan_minutes": float(sync.get("rescan_minutes", 60)),
 
         "mirror_interval_days": int(mirror.get("interval_days", 3)),
         "mirror_delete_orphans": bool(mirror.get("delete_orphans", True)),
+        "mirror_compare": mirror.get("compare", "size"),
+        "mirror_max_deletions": int(mirror.get("max_deletions", 5000)),
+        "mirror_full_listing_days": float(mirror.get("full_listing_days", 7)),
+        "mirror_mode": mirror.get("mode", "burst"),
+        "mirror_shards": max(1, int(mirror.get("shards", 64))),
+        "mirror_tick_minutes": float(mirror.get("tick_minutes", 15)),
+        # [(начало, конец)] в минутах от полуночи; пусто — весь день
+        "mirror_windows": parse_time_windows(mirror.get("windows", [])),
+
+        "transfer_resume_min_bytes": int(float(transfer.get("resume_min_mb", 16)) * 1024 * 1024),
+        "transfer_temp_suffix": transfer.get("temp_suffix", ".part"),
+        "transfer_verify_tail": int(transfer.get("verify_tail_kb", 64)) * 1024,
+        "transfer_realtime_kib": int(transfer.get("realtime_kib_per_sec", 0)),
+        "transfer_bulk_kib": int(transfer.get("bulk_kib_per_sec", 0)),
+        "transfer_block_kib": int(transfer.get("block_kib", 0)),
+        "transfer_sendfile": bool(transfer.get("sendfile", True)),
+        "transfer_trace_size": int(transfer.get("trace_size", 200)),
+        "transfer_slow_seconds": float(transfer.get("slow_seconds", 0)),
+
+        "queue_max_attempts": int(queue.get("max_attempts", 10)),
+        "queue_base_delay": float(queue.get("base_delay_seconds", 10)),
+        "queue_max_delay": float(queue.get("max_delay_seconds", 3600)),
     }
 
 
@@ -113,87 +237,57 @@ logger = logging.getLogger("ftp_sync")
 
 # ─── Стартовые проверки ──────────────────────────────────────────────────────
 
-def run_startup_checks() -> bool:
-    """Запускает самотестирование. Логирует результаты. При критической ошибке показывает MessageBox."""
-    errors = []
-    warnings = []
-
-    # 1. config.json
-    if CONFIG_PATH.exists():
-        logger.info(f"[CHECK] config.json: OK ({CONFIG_PATH})")
-    else:
-        errors.append("config.json не найден")
-
-    # 2. FTP root
-    ftp_root_path = (APP_DIR / CONFIG["local_ftp_root"]).resolve()
+def check_port_free(name: str, port: int) -> str | None:
+    """Предупреждение, если порт на 127.0.0.1 уже кто-то слушает."""
     try:
-        ftp_root_path.mkdir(parents=True, exist_ok=True)
-        logger.info(f"[CHECK] FTP root: OK ({ftp_root_path})")
-    except Exception as e:
-        errors.append(f"Не удалось создать FTP root: {e}")
+        with socket.create_connection(("127.0.0.1", port), timeout=1):
+            return f"Порт {name} {port} уже занят"
+    except OSError:
+        logger.info(f"[CHECK] Порт {name} {port}: OK (свободен)")
+        return None
 
-    # 3. Локальный порт FTP
-    local_port = CONFIG["local_ftp_port"]
-    try:
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.settimeout(1)
-        result = sock.connect_ex(("127.0.0.1", local_port))
-        sock.close()
-        if result == 0:
-            warnings.append(f"Порт {local_port} уже занят")
-        else:
-            logger.info(f"[CHECK] Порт FTP {local_port}: OK (свободен)")
-    except Exception:
-        logger.info(f"[CHECK] Порт FTP {local_port}: OK")
-
-    # 4. Порт API
-    api_port = 8000
-    try:
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.settimeout(1)
-        result = sock.connect_ex(("127.0.0.1", api_port))
-        sock.close()
-        if result == 0:
-            warnings.append(f"Порт API {api_port} уже занят")
-        else:
-            logger.info(f"[CHECK] Порт API {api_port}: OK (свободен)")
-    except Exception:
-        logger.info(f"[CHECK] Порт API {api_port}: OK")
 
-    # 5. Подключение к удалённому FTP
-    rhost = CONFIG["remote_ftp_host"]
-    rport = CONFIG["remote_ftp_port"]
+def check_remote_login(target: dict) -> str | None:
+    """Пробный вход на удалённый FTP; текст предупреждения при ошибке."""
+    rhost = target["host"]
+    rport = target["port"]
     try:
-        if CONFIG["remote_ftp_tls"]:
-            ftp = ftplib.FTP_TLS()
-        else:
-            ftp = ftplib.FTP()
+        ftp = ftplib.FTP_TLS(context=remote_tls_context()) if target["tls"] else ftplib.FTP()
         ftp.connect(rhost, rport, timeout=10)
-        ftp.login(CONFIG["remote_ftp_user"], CONFIG["remote_ftp_pass"])
-        if CONFIG["remote_ftp_tls"]:
+        ftp.login(target["user"], target["password"])
+        if target["tls"]:
             ftp.prot_p()
         ftp.quit()
-        logger.info(f"[CHECK] Удалённый FTP {rhost}:{rport}: OK")
+        logger.info(f"[CHECK] Удалённый FTP {target['name']} ({rhost}:{rport}): OK")
+        return None
     except Exception as e:
-        warnings.append(f"Удалённый FTP {rhost}:{rport}: {e}")
+        return f"Удалённый FTP {target['name']} ({rhost}:{rport}): {e}"
 
-    for w in warnings:
-        logger.warning(f"[CHECK] {w}")
-    for e in errors:
-        logger.error(f"[CHECK] {e}")
 
-    if errors:
-        show_error("Критические ошибки при запуске:\n\n" + "\n".join(errors))
-        return False
+def run_startup_checks():
+    """Самотестирование в фоне: вход на каждый удалённый сервер — параллельно.
 
-    logger.info("[CHECK] Все проверки пройдены, запуск сервера...")
-    return True
+    Запуск не ждёт проверок, результаты только логируются. Критичное (config.json,
+    FTP root, порт FTP) проверяется по ходу запуска: load_config, start_services,
+    start_local_ftp_server. Порт API проверяется до запуска uvicorn, в точке входа:
+    отсюда проверка гонялась бы с его собственным bind.
+    """
+    checks = [(check_remote_login, target) for target in CONFIG["remote_targets"]]
+    with ThreadPoolExecutor(max_workers=max(1, len(checks)), thread_name_prefix="check") as pool:
+        futures = [pool.submit(check, *args) for check, *args in checks]
+        warnings = [w for w in (future.result() for future in futures) if w]
+
+    for w in warnings:
+        logger.warning(f"[CHECK] {w}")
+    mark_startup("checks", f"[CHECK] Проверки завершены ({len(warnings)} предупреждений)")
 
 
 # ─── Иконка трея ─────────────────────────────────────────────────────────────
 
-def create_tray_image(color: str = "#1976D2") -> Image.Image:
+def create_tray_image(color: str = "#1976D2") -> "Image.Image":
     """Создаёт иконку для трея — синий круг с буквой S."""
+    from PIL import Image, ImageDraw
+
     img = Image.new("RGBA", (64, 64), (0, 0, 0, 0))
     draw = ImageDraw.Draw(img)
     draw.ellipse([2, 2, 62, 62], fill=color)
@@ -208,12 +302,36 @@ def create_tray_image(color: str = "#1976D2") -> Image.Image:
 # ─── Pydantic-модели ────────────────────────────────────────────────────────
 
 class RemoteConfig(BaseModel):
+    name: str | None = Field(None, description="Какой сервер из remote_ftp изменить (по умолчанию — первый)")
     host: str = Field(..., description="Хост удалённого FTP")
     port: int = Field(21, description="Порт")
     user: str = Field(..., description="Логин")
     password: str = Field(..., description="Пароль")
     root: str = Field("/", description="Корневая директория на удалённом сервере")
     tls: bool = Field(False, description="Использовать FTPS")
+    engine: str | None = Field(None, pattern="^(ftplib|asyncio)$", description="Движок передач (по умолчанию — не менять)")
+
+class RateLimits(BaseModel):
+    realtime_kib_per_sec: int = Field(0, ge=0, description="Лимит для мгновенных загрузок, КБ/с (0 — без лимита)")
+    bulk_kib_per_sec: int = Field(0, ge=0, description="Лимит для periodic sync и mirror, КБ/с (0 — без лимита)")
+
+class QueueItem(BaseModel):
+    id: int
+    target: str
+    op: str
+    path: str
+    state: str
+    attempts: int
+    next_attempt_at: float
+    last_error: str | None = None
+    created_at: float
+    realtime: bool = False
+
+class QueueStatus(BaseModel):
+    pending: int
+    active: int
+    dead: int
+    items: list[QueueItem]
 
 class SyncStatus(BaseModel):
     synced_files: int
@@ -221,101 +339,1866 @@ class SyncStatus(BaseModel):
     last_sync: str | None
     is_running: bool
 
-class SyncResult(BaseModel):
-    success: bool
-    synced: list[str]
-    failed: list[str]
-    message: str
+class SyncOptions(BaseModel):
+    force: bool = Field(False, description="Загрузить все файлы, игнорируя манифест")
+    target: str | None = Field(None, description="Имя сервера из remote_ftp (по умолчанию — все)")
+
+class MirrorOptions(BaseModel):
+    delete_orphans: bool | None = Field(None, description="Удалять orphan-файлы (по умолчанию — из config.json)")
+    compare: str | None = Field(None, pattern="^(size|checksum)$", description="size или checksum (по умолчанию — из config.json)")
+    max_deletions: int | None = Field(None, ge=0, description="Больше orphan-файлов — удаление пропускается, 0 — без лимита (по умолчанию — из config.json)")
+    full_listing: bool = Field(False, description="Листать сервер целиком, а не сверять индекс инкрементально")
+    target: str | None = Field(None, description="Имя сервера из remote_ftp (по умолчанию — все)")
+
+class JobInfo(BaseModel):
+    id: str
+    kind: str
+    options: dict
+    state: str
+    phase: str
+    files_done: int
+    files_total: int
+    bytes_done: int
+    bytes_total: int
+    eta_seconds: float | None
+    errors: list[str]
+    error_count: int
+    result: dict | None
+    created_at: float
+    started_at: float | None
+    finished_at: float | None
+
+# ─── Манифест синхронизации ─────────────────────────────────────────────────
+
+class SyncManifest:
+    """Манифест загруженных файлов в SQLite (ftp_sync.db рядом с config.json).
+
+    Для каждого удалённого сервера хранит путь, размер и mtime файла на момент
+    последней успешной загрузки. Файл с теми же размером и mtime считается
+    неизменённым и повторно не выгружается.
+    """
+
+    def __init__(self, path: Path):
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(str(path), check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS manifest ("
+            " target TEXT NOT NULL,"
+            " path TEXT NOT NULL,"
+            " size INTEGER NOT NULL,"
+            " mtime_ns INTEGER NOT NULL,"
+            " uploaded_at REAL NOT NULL,"
+            " PRIMARY KEY (target, path))"
+        )
+        self._db.commit()
+
+    def load(self, target: str) -> dict[str, tuple[int, int]]:
+        """Возвращает {путь: (размер, mtime_ns)} для всех загруженных файлов сервера."""
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT path, size, mtime_ns FROM manifest WHERE target = ?", (target,)
+            ).fetchall()
+        return {path: (size, mtime_ns) for path, size, mtime_ns in rows}
+
+    def mark_uploaded(self, target: str, path: str, size: int, mtime_ns: int):
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO manifest (target, path, size, mtime_ns, uploaded_at) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (target, path, size, mtime_ns, time.time()),
+            )
+            self._db.commit()
+
+    def forget(self, target: str, paths):
+        with self._lock:
+            self._db.executemany(
+                "DELETE FROM manifest WHERE target = ? AND path = ?",
+                ((target, path) for path in paths),
+            )
+            self._db.commit()
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+# ─── Индекс локальных хешей ─────────────────────────────────────────────────
+
+# Алгоритмы в терминах команды HASH -> функция для локального подсчёта
+HASH_ALGORITHMS = {
+    "SHA-256": "sha256",
+    "SHA-1": "sha1",
+    "MD5": "md5",
+    "CRC32": "crc32",
+}
+
+# С этого числа файлов хеши считаются в пуле потоков, а не в текущем потоке
+HASH_POOL_THRESHOLD = 32
+
+
+def hash_file(path: str, algo: str) -> str:
+    """Хеш файла в нижнем регистре (hex).
+
+    hashlib и zlib.crc32 отпускают GIL на блоках по 1 МБ, поэтому пул потоков
+    считает хеши параллельно — без пула процессов, который на Windows (spawn)
+    заново импортировал бы main с конфигом и логированием.
+    """
+    if algo == "crc32":
+        crc = 0
+        with open(path, "rb") as f:
+            while chunk := f.read(1024 * 1024):
+                crc = zlib.crc32(chunk, crc)
+        return f"{crc:08x}"
+    h = hashlib.new(algo)
+    with open(path, "rb") as f:
+        while chunk := f.read(1024 * 1024):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def same_digest(remote: str, local: str, algo: str) -> bool:
+    """Совпадает ли хеш с сервера с локальным.
+
+    CRC32 сравнивается как число: серверы отвечают на XCRC и без ведущих нулей,
+    и в верхнем регистре, а локальный — всегда 8 цифр в нижнем.
+    """
+    if algo == "crc32":
+        try:
+            return int(remote, 16) == int(local, 16)
+        except ValueError:
+            return False
+    return remote.lower() == local.lower()
+
+
+def hash_file_or_none(path: str, algo: str) -> str | None:
+    """hash_file, но None, если файл удалили, переименовали или заблокировали после обхода."""
+    try:
+        return hash_file(path, algo)
+    except OSError as e:
+        logger.warning(f"Mirror: не удалось посчитать хеш {path}: {e}")
+        return None
+
+
+class HashIndex:
+    """Кэш локальных хешей в ftp_sync.db, ключ — (путь, размер, mtime).
+
+    Пока файл не менялся, его хеш берётся из индекса, и повторный mirror
+    в режиме checksum ничего не пересчитывает.
+    """
+
+    def __init__(self, path: Path):
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(str(path), check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS hashes ("
+            " path TEXT NOT NULL,"
+            " algo TEXT NOT NULL,"
+            " size INTEGER NOT NULL,"
+            " mtime_ns INTEGER NOT NULL,"
+            " digest TEXT NOT NULL,"
+            " PRIMARY KEY (path, algo))"
+        )
+        self._db.commit()
+
+    def lookup(self, algo: str) -> dict[str, tuple[int, int, str]]:
+        """{путь: (размер, mtime_ns, хеш)} для алгоритма algo."""
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT path, size, mtime_ns, digest FROM hashes WHERE algo = ?", (algo,)
+            ).fetchall()
+        return {path: (size, mtime_ns, digest) for path, size, mtime_ns, digest in rows}
+
+    def store(self, algo: str, records):
+        """records — итерируемое из (путь, размер, mtime_ns, хеш)."""
+        with self._lock:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO hashes (path, algo, size, mtime_ns, digest) VALUES (?, ?, ?, ?, ?)",
+                ((path, algo, size, mtime_ns, digest) for path, size, mtime_ns, digest in records),
+            )
+            self._db.commit()
+
+    def retain(self, paths: set[str]):
+        """Удаляет записи о файлах, которых больше нет локально."""
+        with self._lock:
+            known = {row[0] for row in self._db.execute("SELECT DISTINCT path FROM hashes")}
+            self._db.executemany("DELETE FROM hashes WHERE path = ?", ((p,) for p in known - paths))
+            self._db.commit()
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+# ─── Индекс удалённого дерева ───────────────────────────────────────────────
+
+class RemoteIndex:
+    """Последнее известное состояние удалённых серверов в ftp_sync.db.
+
+    Для каждого сервера хранит файлы и директории (тип, размер, MLSD `modify`)
+    так же, как их отдаёт листинг. Заполняется полным листингом mirror и дальше
+    обновляется после каждого успешного STOR, DELE и RMD этого процесса.
+    У директории, которую мы сами изменили, `modify` сбрасывается в "" —
+    при следующей инкрементальной сверке её содержимое перечитывается.
+    """
+
+    def __init__(self, path: Path):
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(str(path), check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS remote_index ("
+            " target TEXT NOT NULL,"
+            " path TEXT NOT NULL,"
+            " is_dir INTEGER NOT NULL,"
+            " size INTEGER NOT NULL,"
+            " modify TEXT NOT NULL,"
+            " PRIMARY KEY (target, path))"
+        )
+        # Корень сервера: modify и время последнего полного листинга
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS remote_index_state ("
+            " target TEXT PRIMARY KEY,"
+            " root_modify TEXT NOT NULL,"
+            " full_listing_at REAL)"
+        )
+        self._db.commit()
+
+    def load(self, target: str) -> dict[str, dict[str, str]]:
+        """{путь: факты} в формате листинга MLSD (type, size, modify)."""
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT path, is_dir, size, modify FROM remote_index WHERE target = ?", (target,)
+            ).fetchall()
+        return {
+            path: {"type": "dir" if is_dir else "file", "size": str(size), "modify": modify}
+            for path, is_dir, size, modify in rows
+        }
+
+    def state(self, target: str) -> tuple[str, float | None]:
+        """(modify корня, время последнего полного листинга или None)."""
+        with self._lock:
+            row = self._db.execute(
+                "SELECT root_modify, full_listing_at FROM remote_index_state WHERE target = ?", (target,)
+            ).fetchone()
+        return row if row else ("", None)
+
+    @staticmethod
+    def _row(target: str, path: str, facts: dict[str, str]) -> tuple:
+        is_dir = facts.get("type", "").lower() == "dir"
+        size = 0 if is_dir else int(facts.get("size", 0) or 0)
+        return target, path, int(is_dir), size, facts.get("modify", "")
+
+    def _remove_tree(self, target: str, path: str):
+        # Всё под path: пути в диапазоне [path + "/", path + "0"), "0" — следующий символ после "/"
+        self._db.execute(
+            "DELETE FROM remote_index WHERE target = ? AND (path = ? OR (path > ? AND path < ?))",
+            (target, path, path + "/", path + "0"),
+        )
+
+    def _touch_parent(self, target: str, path: str):
+        """Помечает родителя path изменённым: его содержимое надо перечитать."""
+        parent = path.rpartition("/")[0]
+        if parent:
+            self._db.execute(
+                "UPDATE remote_index SET modify = '' WHERE target = ? AND path = ?", (target, parent)
+            )
+        else:
+            self._db.execute("UPDATE remote_index_state SET root_modify = '' WHERE target = ?", (target,))
+
+    def replace(self, target: str, entries: dict[str, dict[str, str]]):
+        """Заменяет индекс сервера результатом полного листинга."""
+        with self._lock:
+            self._db.execute("DELETE FROM remote_index WHERE target = ?", (target,))
+            self._db.executemany(
+                "INSERT INTO remote_index (target, path, is_dir, size, modify) VALUES (?, ?, ?, ?, ?)",
+                (self._row(target, path, facts) for path, facts in entries.items()),
+            )
+            self._db.execute(
+                "INSERT OR REPLACE INTO remote_index_state (target, root_modify, full_listing_at) VALUES (?, '', ?)",
+                (target, time.time()),
+            )
+            self._db.commit()
+
+    def apply(self, target: str, upserts: dict[str, dict[str, str]], removed, root_modify: str | None = None):
+        """Результат сверки с листингом: сначала удалённые поддеревья, затем новые факты.
+
+        root_modify=None — modify корня не меняется.
+        """
+        with self._lock:
+            for path in removed:
+                self._remove_tree(target, path)
+            self._db.executemany(
+                "INSERT OR REPLACE INTO remote_index (target, path, is_dir, size, modify) VALUES (?, ?, ?, ?, ?)",
+                (self._row(target, path, facts) for path, facts in upserts.items()),
+            )
+            if root_modify is not None:
+                self._db.execute(
+                    "UPDATE remote_index_state SET root_modify = ? WHERE target = ?", (root_modify, target)
+                )
+            self._db.commit()
+
+    def stored(self, target: str, path: str, size: int):
+        """Файл загружен: запись о нём, о директориях над ним и пометка родителя."""
+        with self._lock:
+            ancestors = []
+            parent = path.rpartition("/")[0]
+            while parent:
+                ancestors.append((target, parent))
+                parent = parent.rpartition("/")[0]
+            self._db.executemany(
+                "INSERT OR IGNORE INTO remote_index (target, path, is_dir, size, modify) VALUES (?, ?, 1, 0, '')",
+                ancestors,
+            )
+            self._db.execute(
+                "INSERT OR REPLACE INTO remote_index (target, path, is_dir, size, modify) VALUES (?, ?, 0, ?, '')",
+                (target, path, size),
+            )
+            self._touch_parent(target, path)
+            self._db.commit()
+
+    def removed(self, target: str, path: str):
+        """Файл или директория удалены с сервера."""
+        with self._lock:
+            self._remove_tree(target, path)
+            self._touch_parent(target, path)
+            self._db.commit()
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+# ─── Состояние планировщиков ────────────────────────────────────────────────
+
+class KeyValueStore:
+    """Небольшие JSON-значения по ключу в ftp_sync.db — то, что должно пережить перезапуск.
+
+    Например, расписание mirror: когда следующий проход и докуда дошёл rolling-цикл.
+    """
+
+    def __init__(self, path: Path):
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(str(path), check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS kv ("
+            " key TEXT PRIMARY KEY,"
+            " value TEXT NOT NULL,"
+            " updated_at REAL NOT NULL)"
+        )
+        self._db.commit()
+
+    def get(self, key: str, default=None):
+        with self._lock:
+            row = self._db.execute("SELECT value FROM kv WHERE key = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def set(self, key: str, value):
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO kv (key, value, updated_at) VALUES (?, ?, ?)",
+                (key, json.dumps(value), time.time()),
+            )
+            self._db.commit()
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+# ─── Очередь повторных передач ───────────────────────────────────────────────
+
+class TransferQueue:
+    """Журнал передач в SQLite (таблица transfer_queue в ftp_sync.db).
+
+    На каждый удалённый путь — одна запись с последней нужной операцией:
+    `upload` или `delete`. Состояния записи:
+    - `active` — передача выполняется прямо сейчас;
+    - `pending` — ждёт попытки в `next_attempt_at`;
+    - `dead` — исчерпаны `max_attempts` попыток, ждёт ручного повтора через API.
+
+    Неудачная попытка откладывает запись с экспоненциальной задержкой и случайным
+    разбросом, чтобы после обрыва связи тысячи файлов не ломились на сервер разом.
+    После падения процесса записи `active` возвращаются в `pending` (`recover()`).
+    `realtime` — передача пришла от UploadDispatcher и повторяется с его приоритетом.
+    """
+
+    def __init__(self, path: Path, max_attempts: int = 10,
+                 base_delay: float = 10.0, max_delay: float = 3600.0):
+        self.max_attempts = max(1, max_attempts)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._lock = threading.Lock()
+        # Будит transfer_retry_loop, когда записи стали готовы раньше расчётного времени
+        self._wakeup = threading.Event()
+        self._db = sqlite3.connect(str(path), check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS transfer_queue ("
+            " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+            " target TEXT NOT NULL,"
+            " op TEXT NOT NULL,"
+            " path TEXT NOT NULL,"
+            " state TEXT NOT NULL,"
+            " attempts INTEGER NOT NULL,"
+            " next_attempt_at REAL NOT NULL,"
+            " last_error TEXT,"
+            " created_at REAL NOT NULL,"
+            " updated_at REAL NOT NULL,"
+            " realtime INTEGER NOT NULL DEFAULT 0,"
+            " UNIQUE (target, path))"
+        )
+        # Таблица из версии без колонки realtime
+        columns = {row[1] for row in self._db.execute("PRAGMA table_info(transfer_queue)")}
+        if "realtime" not in columns:
+            self._db.execute("ALTER TABLE transfer_queue ADD COLUMN realtime INTEGER NOT NULL DEFAULT 0")
+        self._db.execute(
+            "CREATE INDEX IF NOT EXISTS transfer_queue_due"
+            " ON transfer_queue (target, state, next_attempt_at)"
+        )
+        self._db.commit()
+
+    def backoff(self, attempts: int) -> float:
+        """Задержка перед следующей попыткой: base * 2^(n-1), не больше max_delay, со случайной половиной."""
+        delay = min(self.max_delay, self.base_delay * 2 ** min(attempts - 1, 30))
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def put(self, target: str, op: str, path: str, active: bool = False, realtime: bool = False) -> int:
+        """Добавляет операцию над путём (заменяя прежнюю) и возвращает id записи.
+
+        active=True — вызывающий сам сразу выполняет передачу; иначе запись
+        подхватит transfer_retry_loop. realtime=True — повторять с PRIORITY_REALTIME.
+        """
+        now = time.time()
+        with self._lock:
+            self._db.execute(
+                "INSERT INTO transfer_queue"
+                " (target, op, path, state, attempts, next_attempt_at, last_error, created_at, updated_at, realtime)"
+                " VALUES (?, ?, ?, ?, 0, ?, NULL, ?, ?, ?)"
+                " ON CONFLICT (target, path) DO UPDATE SET"
+                " op = excluded.op, state = excluded.state, attempts = 0,"
+                " next_attempt_at = excluded.next_attempt_at, last_error = NULL,"
+                " updated_at = excluded.updated_at, realtime = excluded.realtime",
+                (target, op, path, "active" if active else "pending", now, now, now, int(realtime)),
+            )
+            job_id = self._db.execute(
+                "SELECT id FROM transfer_queue WHERE target = ? AND path = ?", (target, path)
+            ).fetchone()[0]
+            self._db.commit()
+        if not active:
+            self._wakeup.set()
+        return job_id
+
+    def complete(self, job_id: int):
+        with self._lock:
+            self._db.execute("DELETE FROM transfer_queue WHERE id = ?", (job_id,))
+            self._db.commit()
+
+    def resolve(self, target: str, path: str):
+        """Путь передан другим способом (periodic sync, mirror) — запись о нём больше не нужна."""
+        with self._lock:
+            self._db.execute("DELETE FROM transfer_queue WHERE target = ? AND path = ?", (target, path))
+            self._db.commit()
+
+    def fail(self, job_id: int, error: str) -> str:
+        """Засчитывает неудачную попытку. Возвращает новое состояние: pending или dead."""
+        now = time.time()
+        with self._lock:
+            row = self._db.execute(
+                "SELECT attempts FROM transfer_queue WHERE id = ?", (job_id,)
+            ).fetchone()
+            if row is None:
+                return "gone"
+            attempts = row[0] + 1
+            state = "dead" if attempts >= self.max_attempts else "pending"
+            self._db.execute(
+                "UPDATE transfer_queue SET state = ?, attempts = ?, next_attempt_at = ?,"
+                " last_error = ?, updated_at = ? WHERE id = ?",
+                (state, attempts, now + self.backoff(attempts), error[:500], now, job_id),
+            )
+            self._db.commit()
+        return state
+
+    def claim_due(self, target: str, limit: int) -> list[dict]:
+        """Забирает готовые к попытке записи сервера и переводит их в active."""
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT id, op, path, attempts, realtime FROM transfer_queue"
+                " WHERE target = ? AND state = 'pending' AND next_attempt_at <= ?"
+                " ORDER BY next_attempt_at LIMIT ?",
+                (target, time.time(), limit),
+            ).fetchall()
+            self._db.executemany(
+                "UPDATE transfer_queue SET state = 'active', updated_at = ? WHERE id = ?",
+                ((time.time(), row[0]) for row in rows),
+            )
+            self._db.commit()
+        return [
+            {"id": i, "op": op, "path": path, "attempts": attempts, "realtime": bool(realtime)}
+            for i, op, path, attempts, realtime in rows
+        ]
+
+    def next_due(self, target: str) -> float | None:
+        """Время (time.time()) ближайшей попытки для сервера или None, если ждать нечего."""
+        with self._lock:
+            row = self._db.execute(
+                "SELECT MIN(next_attempt_at) FROM transfer_queue WHERE target = ? AND state = 'pending'",
+                (target,),
+            ).fetchone()
+        return row[0]
+
+    def wait(self, timeout: float):
+        self._wakeup.wait(timeout)
+        self._wakeup.clear()
+
+    def recover(self) -> int:
+        """При старте: передачи, прерванные падением процесса, снова ждут попытки."""
+        with self._lock:
+            cur = self._db.execute(
+                "UPDATE transfer_queue SET state = 'pending', next_attempt_at = ?, updated_at = ?"
+                " WHERE state = 'active'",
+                (time.time(), time.time()),
+            )
+            self._db.commit()
+        return cur.rowcount
+
+    def retry(self, job_id: int | None = None) -> int:
+        """Возвращает dead-запись (или все dead при job_id=None) в pending со сброшенным счётчиком."""
+        now = time.time()
+        query = ("UPDATE transfer_queue SET state = 'pending', attempts = 0, next_attempt_at = ?,"
+                 " updated_at = ? WHERE state != 'active'")
+        params: tuple = (now, now)
+        if job_id is None:
+            query += " AND state = 'dead'"
+        else:
+            query += " AND id = ?"
+            params += (job_id,)
+        with self._lock:
+            cur = self._db.execute(query, params)
+            self._db.commit()
+        if cur.rowcount:
+            self._wakeup.set()
+        return cur.rowcount
+
+    def retarget(self, old: str, new: str) -> tuple[int, int]:
+        """Сервер сменился (PUT /config/remote): записи old переходят к new.
+
+        Загрузки — это локальные файлы, их можно выполнить и на новом сервере.
+        Удаления относились к дереву старого сервера, поэтому уходят в dead:
+        на новом сервере их нужно подтвердить повтором через API.
+        Если у new уже есть запись о том же пути, остаётся она.
+        Возвращает (перенесено загрузок, удалений в dead).
+        """
+        now = time.time()
+        with self._lock:
+            moved = self._db.execute(
+                "UPDATE OR IGNORE transfer_queue SET target = ?, updated_at = ?"
+                " WHERE target = ? AND op = 'upload'",
+                (new, now, old),
+            ).rowcount
+            dead = self._db.execute(
+                "UPDATE OR IGNORE transfer_queue SET target = ?, state = 'dead', last_error = ?, updated_at = ?"
+                " WHERE target = ? AND op = 'delete' AND state != 'active'",
+                (new, f"Сервер сменился: {old} -> {new}; удаление не подтверждено", now, old),
+            ).rowcount
+            # Остались пути, о которых у new своя запись, и удаления, которые идут прямо сейчас
+            self._db.execute("DELETE FROM transfer_queue WHERE target = ? AND state != 'active'", (old,))
+            self._db.commit()
+        if moved:
+            self._wakeup.set()
+        return moved, dead
+
+    def remove(self, job_id: int) -> bool:
+        with self._lock:
+            cur = self._db.execute("DELETE FROM transfer_queue WHERE id = ?", (job_id,))
+            self._db.commit()
+        return cur.rowcount > 0
+
+    def counts(self, target: str | None = None) -> dict[str, int]:
+        query = "SELECT state, COUNT(*) FROM transfer_queue"
+        params: tuple = ()
+        if target is not None:
+            query += " WHERE target = ?"
+            params = (target,)
+        with self._lock:
+            rows = self._db.execute(query + " GROUP BY state", params).fetchall()
+        return {"pending": 0, "active": 0, "dead": 0, **dict(rows)}
+
+    def oldest(self, target: str) -> float | None:
+        """created_at самой старой невыполненной (не dead) передачи на сервер."""
+        with self._lock:
+            row = self._db.execute(
+                "SELECT MIN(created_at) FROM transfer_queue WHERE target = ? AND state != 'dead'", (target,)
+            ).fetchone()
+        return row[0]
+
+    def items(self, state: str | None = None, limit: int = 100) -> list[dict]:
+        query = ("SELECT id, target, op, path, state, attempts, next_attempt_at, last_error, created_at, realtime"
+                 " FROM transfer_queue")
+        params: tuple = ()
+        if state:
+            query += " WHERE state = ?"
+            params = (state,)
+        query += " ORDER BY next_attempt_at LIMIT ?"
+        with self._lock:
+            rows = self._db.execute(query, params + (limit,)).fetchall()
+        keys = ("id", "target", "op", "path", "state", "attempts", "next_attempt_at", "last_error", "created_at")
+        return [{**dict(zip(keys, row)), "realtime": bool(row[-1])} for row in rows]
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+# ─── Метрики (текстовый формат Prometheus) ──────────────────────────────────
+
+def _fmt(value: float) -> str:
+    # :g округляет до 6 знаков — для байтовых счётчиков так нельзя
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+def _escape_label(value) -> str:
+    # Значения меток (например, имена серверов из конфига) могут содержать \, " и перевод строки
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class Counter:
+    """Счётчик с метками. Обновление — словарь под собственной блокировкой, без аллокаций сверх ключа."""
+
+    kind = "counter"
+
+    def __init__(self, name: str, help_text: str, labelnames: tuple[str, ...] = (), collect=None):
+        self.name = name
+        self.help = help_text
+        self.labelnames = labelnames
+        # collect() -> {значения меток: число} — считается только при чтении /metrics
+        self.collect = collect
+        self._lock = threading.Lock()
+        self._values: dict[tuple, float] = {}
+        METRICS.append(self)
+
+    def inc(self, amount: float = 1, labels: tuple = ()):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def _labels(self, values: tuple, extra: str = "") -> str:
+        pairs = [f'{k}="{_escape_label(v)}"' for k, v in zip(self.labelnames, values)]
+        if extra:
+            pairs.append(extra)
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+    def render(self) -> list[str]:
+        if self.collect:
+            values = self.collect()
+        else:
+            with self._lock:
+                values = dict(self._values)
+        return [f"{self.name}{self._labels(k)} {_fmt(v)}" for k, v in sorted(values.items())]
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, value: float, labels: tuple = ()):
+        with self._lock:
+            self._values[labels] = value
+
+
+class Histogram(Counter):
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, buckets: tuple[float, ...], labelnames: tuple[str, ...] = ()):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = buckets
+        # метки -> [счётчики по корзинам (+Inf последней), сумма]
+        self._series: dict[tuple, list] = {}
+
+    def observe(self, value: float, labels: tuple = ()):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][i] += 1
+            series[1] += value
+
+    def render(self) -> list[str]:
+        with self._lock:
+            snapshot = {k: (list(counts), total) for k, (counts, total) in self._series.items()}
+        lines = []
+        for labels, (counts, total) in sorted(snapshot.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = 'le="+Inf"' if bound == float("inf") else f'le="{_fmt(bound)}"'
+                lines.append(f"{self.name}_bucket{self._labels(labels, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{self._labels(labels)} {_fmt(total)}")
+            lines.append(f"{self.name}_count{self._labels(labels)} {cumulative}")
+        return lines
+
+
+METRICS: list[Counter] = []
+
+
+def render_metrics() -> str:
+    lines = []
+    for metric in METRICS:
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+def _collect_queue_depth() -> dict[tuple, float]:
+    counts = transfer_queue.counts() if transfer_queue else {}
+    values = {(state,): n for state, n in counts.items()}
+    if upload_dispatcher:
+        values[("dispatcher",)] = upload_dispatcher.depth()
+    return values
+
+
+def _collect_connections() -> dict[tuple, float]:
+    values = {}
+    for target in remote_targets:
+        client = target.client
+        if client:
+            active, idle = client.connections()
+            values[(target.name, "active")] = active
+            values[(target.name, "idle")] = idle
+    return values
+
+
+def _collect_target_lag() -> dict[tuple, float]:
+    return {(target.name,): target.lag()["seconds"] for target in remote_targets}
+
+
+def _collect_target_backlog() -> dict[tuple, float]:
+    return {(target.name,): target.lag()["files"] for target in remote_targets}
+
+
+MIRROR_PHASES = ("idle", "listing", "scanning", "comparing", "uploading", "deleting")
+
+UPLOADED_FILES = Counter("ftp_sync_uploaded_files_total", "Загружено файлов на удалённый сервер", ("priority",))
+UPLOADED_BYTES = Counter("ftp_sync_uploaded_bytes_total", "Загружено байт на удалённый сервер", ("priority",))
+DELETED_FILES = Counter("ftp_sync_deleted_files_total", "Удалено файлов на удалённом сервере")
+FAILED_TRANSFERS = Counter("ftp_sync_failed_transfers_total", "Неудачных попыток передачи", ("op",))
+FS_EVENTS = Counter("ftp_sync_local_events_total", "События локальных файлов (watchdog и локальный FTP)", ("event",))
+UPLOAD_SECONDS = Histogram(
+    "ftp_sync_upload_duration_seconds", "Время загрузки одного файла, с",
+    (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300), ("priority",),
+)
+UPLOAD_SIZE = Histogram(
+    "ftp_sync_upload_size_bytes", "Размер загруженного файла, байт",
+    (1024, 16384, 131072, 1048576, 8388608, 67108864, 536870912, 4294967296),
+)
+QUEUE_DEPTH = Gauge(
+    "ftp_sync_queue_depth", "Передач в очереди по состояниям; dispatcher — ждут в UploadDispatcher",
+    ("state",), collect=_collect_queue_depth,
+)
+REMOTE_CONNECTIONS = Gauge(
+    "ftp_sync_remote_connections", "Соединения пула к удалённому серверу", ("target", "state"),
+    collect=_collect_connections,
+)
+TARGET_LAG = Gauge(
+    "ftp_sync_target_lag_seconds", "Возраст самого старого изменения, ещё не переданного на сервер, с",
+    ("target",), collect=_collect_target_lag,
+)
+TARGET_BACKLOG = Gauge(
+    "ftp_sync_target_backlog_files", "Передач на сервер в работе и в очереди (без dead)",
+    ("target",), collect=_collect_target_backlog,
+)
+MIRROR_PHASE = Gauge("ftp_sync_mirror_phase", "Текущая фаза mirror (1 — активна)", ("target", "phase"))
+LISTING_SECONDS = Gauge(
+    "ftp_sync_remote_listing_duration_seconds", "Длительность последнего листинга удалённого дерева, с", ("target",),
+)
+LISTING_ENTRIES = Gauge("ftp_sync_remote_listing_entries", "Файлов и директорий в последнем листинге", ("target",))
+SYNC_SECONDS = Gauge(
+    "ftp_sync_periodic_duration_seconds", "Длительность последней периодической синхронизации, с", ("target",),
+)
+SYNC_RUNS = Counter("ftp_sync_periodic_runs_total", "Проходов периодической синхронизации", ("target",))
+STARTUP_SECONDS = Gauge(
+    "ftp_sync_startup_seconds", "Через сколько секунд после запуска готов этап (ftp, api, checks)", ("stage",),
+)
+
+
+def set_mirror_phase(target: str, phase: str):
+    for name in MIRROR_PHASES:
+        MIRROR_PHASE.set(1 if name == phase else 0, (target, name))
+
+
+def mark_startup(stage: str, what: str):
+    """Запоминает, через сколько после запуска готов этап: ftp, api или checks."""
+    seconds = time.monotonic() - PROCESS_STARTED
+    STARTUP_SECONDS.set(seconds, (stage,))
+    logger.info(f"{what} через {seconds * 1000:.0f} мс после запуска")
+
+
+# ─── Ограничение скорости и приоритеты ──────────────────────────────────────
+
+# Свежие файлы с локального FTP-сервера
+PRIORITY_REALTIME = 0
+# Periodic sync, mirror и прочая фоновая работа
+PRIORITY_BULK = 1
+PRIORITY_NAMES = {PRIORITY_REALTIME: "realtime", PRIORITY_BULK: "bulk"}
+
+
+class TokenBucket:
+    """Ограничитель скорости «ведро токенов»: rate байт/с, 0 — без ограничения.
+
+    Общий для всех потоков: каждый поток после отправки блока списывает его
+    размер и, если ведро ушло в минус, спит ровно столько, сколько нужно для
+    его пополнения.
+    """
+
+    def __init__(self, rate: int = 0):
+        self._lock = threading.Lock()
+        self.rate = 0
+        self._tokens = 0.0
+        self._stamp = time.monotonic()
+        self.set_rate(rate)
+
+    def set_rate(self, rate: int):
+        with self._lock:
+            self.rate = max(0, int(rate))
+            # Запас — секунда трафика, но не меньше 64 КБ
+            self._burst = max(self.rate, 64 * 1024)
+            self._tokens = min(self._tokens, self._burst)
+
+    def reserve(self, amount: int) -> float:
+        """Списывает amount и возвращает, сколько секунд подождать (для asyncio — без sleep)."""
+        with self._lock:
+            if self.rate <= 0:
+                return 0.0
+            now = time.monotonic()
+            self._tokens = min(self._burst, self._tokens + (now - self._stamp) * self.rate)
+            self._stamp = now
+            self._tokens -= amount
+            return -self._tokens / self.rate if self._tokens < 0 else 0.0
+
+    def consume(self, amount: int):
+        delay = self.reserve(amount)
+        if delay > 0:
+            time.sleep(delay)
+
+
+# Общие на весь процесс: все клиенты и потоки делят один канал
+rate_limiters = {
+    PRIORITY_REALTIME: TokenBucket(CONFIG["transfer_realtime_kib"] * 1024),
+    PRIORITY_BULK: TokenBucket(CONFIG["transfer_bulk_kib"] * 1024),
+}
+
+
+# ─── Трассировка передач ────────────────────────────────────────────────────
+
+class TransferTrace:
+    """Одна загрузка с разбивкой времени по шагам протокола (монотонные часы).
+
+    Одноимённые шаги суммируются: два MKD — одна фаза mkdir.
+    """
+
+    def __init__(self, target: str, path: str, priority: int):
+        self.target = target
+        self.path = path
+        self.priority = PRIORITY_NAMES[priority]
+        self.started_at = time.time()
+        self._started = time.monotonic()
+        self.phases: dict[str, float] = {}
+        self.sent = 0
+        self.seconds = 0.0
+        self.error: str | None = None
+
+    def add(self, phase: str, seconds: float):
+        self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+
+    def finish(self, error: str | None = None):
+        self.seconds = time.monotonic() - self._started
+        self.error = error
+
+    def describe(self) -> str:
+        """Разбивка для лога: «connect 120 мс, login 80 мс, data 4.90 с»."""
+        parts = [
+            f"{name} {seconds * 1000:.0f} мс" if seconds < 1 else f"{name} {seconds:.2f} с"
+            for name, seconds in self.phases.items()
+        ]
+        return ", ".join(parts) or "без фаз"
+
+    def to_dict(self) -> dict:
+        data = self.phases.get("data", 0.0)
+        return {
+            "target": self.target,
+            "path": self.path,
+            "priority": self.priority,
+            "started": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(self.started_at)),
+            "ok": self.error is None,
+            "error": self.error,
+            "seconds": round(self.seconds, 4),
+            "bytes": self.sent,
+            # Вся загрузка и только фаза data (без команд и ожидания пула)
+            "mb_per_sec": round(self.sent / self.seconds / 1048576, 2) if self.seconds else None,
+            "data_mb_per_sec": round(self.sent / data / 1048576, 2) if data else None,
+            "phases_ms": {name: round(seconds * 1000, 1) for name, seconds in self.phases.items()},
+            # Время вне размеченных фаз: чтение манифеста, разбор ответов, планировщик
+            "other_ms": round(max(0.0, self.seconds - sum(self.phases.values())) * 1000, 1),
+        }
+
+
+# Загрузка, которую сейчас выполняет поток или задача asyncio (у каждой — свой контекст)
+_current_trace: contextvars.ContextVar[TransferTrace | None] = contextvars.ContextVar("transfer_trace", default=None)
+
+
+@contextmanager
+def trace_phase(name: str):
+    """Засекает шаг протокола для текущей загрузки; вне загрузки ничего не делает."""
+    trace = _current_trace.get()
+    if trace is None:
+        yield
+        return
+    started = time.monotonic()
+    try:
+        yield
+    finally:
+        trace.add(name, time.monotonic() - started)
+
+
+def trace_sent(amount: int):
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.sent += amount
+
+
+class TransferTraces:
+    """Кольцевой буфер последних загрузок для /debug/transfers.
+
+    Загрузки дольше slow_seconds (0 — выключено) пишутся в лог с полной разбивкой.
+    """
+
+    def __init__(self, size: int, slow_seconds: float = 0):
+        self._lock = threading.Lock()
+        self._items: deque[TransferTrace] = deque(maxlen=max(1, size))
+        self.size = size
+        self.slow_seconds = slow_seconds
+
+    @contextmanager
+    def upload(self, target: str, path: str, priority: int):
+        """Трассирует загрузку внутри блока; size=0 — трассировка выключена."""
+        if self.size <= 0:
+            yield
+            return
+        trace = TransferTrace(target, path, priority)
+        token = _current_trace.set(trace)
+        try:
+            yield
+        except BaseException as e:
+            trace.finish(str(e) or type(e).__name__)
+            raise
+        else:
+            trace.finish()
+        finally:
+            _current_trace.reset(token)
+            self.record(trace)
+
+    def record(self, trace: TransferTrace):
+        with self._lock:
+            self._items.append(trace)
+        if self.slow_seconds and trace.seconds >= self.slow_seconds:
+            logger.warning(
+                f"Медленная загрузка {trace.path} ({trace.target}): {trace.seconds:.2f} с, "
+                f"{trace.sent / 1048576:.1f} МБ — {trace.describe()}"
+            )
+
+    def items(self, limit: int = 100, target: str | None = None, slow: bool = False) -> list[dict]:
+        """Последние загрузки, новые первыми."""
+        with self._lock:
+            traces = list(self._items)
+        result = []
+        for trace in reversed(traces):
+            if target and trace.target != target:
+                continue
+            if slow and not (self.slow_seconds and trace.seconds >= self.slow_seconds):
+                continue
+            result.append(trace.to_dict())
+            if len(result) >= limit:
+                break
+        return result
+
+    def summary(self, target: str | None = None) -> dict[str, dict]:
+        """Фазы по всем загрузкам в буфере: сколько раз, суммарно, в среднем и максимум, мс."""
+        with self._lock:
+            traces = [t for t in self._items if not target or t.target == target]
+        phases: dict[str, list[float]] = {}
+        for trace in traces:
+            for name, seconds in trace.phases.items():
+                phases.setdefault(name, []).append(seconds)
+        total = sum(sum(values) for values in phases.values()) or 1.0
+        return {
+            name: {
+                "count": len(values),
+                "total_ms": round(sum(values) * 1000, 1),
+                "avg_ms": round(sum(values) / len(values) * 1000, 2),
+                "max_ms": round(max(values) * 1000, 1),
+                "share": round(sum(values) / total, 3),
+            }
+            for name, values in sorted(phases.items(), key=lambda item: -sum(item[1]))
+        }
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+
+transfer_traces = TransferTraces(CONFIG["transfer_trace_size"], CONFIG["transfer_slow_seconds"])
+
+
+# ─── Сканер локального дерева ───────────────────────────────────────────────
+
+class LocalScanner:
+    """Однопроходный обход дерева через os.scandir с кэшем директорий.
+
+    Выдаёт записи (путь вида `a/b/file`, размер, mtime_ns) в порядке сортировки путей.
+    Для каждой директории запоминается её mtime и отсортированное содержимое:
+    если mtime не изменился, директория не читается заново — её файлы берутся из
+    снимка, а проверяются (одним stat) только поддиректории.
+
+    mtime директории меняется при создании, удалении и переименовании файлов в ней,
+    но не при перезаписи существующего файла. Поэтому директории файлов, о которых
+    сообщил UploadDispatcher, помечаются грязными (`mark_dirty`), а раз в
+    `rescan_seconds` снимку не доверяют вовсе — на случай изменений мимо watchdog.
+    """
+
+    def __init__(self, root: Path, use_snapshot: bool = True, rescan_seconds: float = 3600):
+        self.root = root
+        self.use_snapshot = use_snapshot
+        self.rescan_seconds = rescan_seconds
+        self._lock = threading.Lock()
+        # путь директории ("" или "a/b/") -> (mtime_ns, ((имя, размер, mtime_ns), ...)); у поддиректорий имя с "/" и None
+        self._dirs: dict[str, tuple[int, tuple]] = {}
+        self._dirty: set[str] = set()
+        # -inf, а не 0: monotonic() отсчитывается от загрузки системы, и если она была меньше
+        # rescan_seconds назад, снимку доверяли бы, а полный обход откладывался бы до этого срока
+        self._last_full = float("-inf")
+
+    def mark_dirty(self, filepath: str):
+        """Файл изменился: его директорию при следующем обходе нужно перечитать."""
+        if not self.use_snapshot:
+            return
+        try:
+            rel = Path(filepath).parent.relative_to(self.root).as_posix()
+        except ValueError:
+            return
+        with self._lock:
+            self._dirty.add("" if rel == "." else rel + "/")
+
+    def scan(self, prefix: str = "", after: str = ""):
+        """Файлы с путём, начинающимся с prefix и большим after; лишние поддеревья не обходятся."""
+        trust = self.use_snapshot and time.monotonic() - self._last_full < self.rescan_seconds
+        full = not prefix and not after
+        visited: set[str] | None = set() if full and self.use_snapshot else None
+        started = time.monotonic()
+
+        yield from self._walk(str(self.root), "", prefix, after, trust, visited)
+
+        if visited is not None:
+            with self._lock:
+                # Директории, которых больше нет, из снимка убираются только после полного обхода
+                for rel_dir in self._dirs.keys() - visited:
+                    del self._dirs[rel_dir]
+            if not trust:
+                self._last_full = started
+
+    def _walk(self, dir_path: str, rel_dir: str, prefix: str, after: str, trust: bool, visited: set | None):
+        if visited is not None:
+            visited.add(rel_dir)
+        for key, size, mtime_ns in self._entries(dir_path, rel_dir, trust):
+            rel = rel_dir + key
+            if size is None:
+                # "a/" сортируется так же, как пути внутри неё: "a-b" < "a/x" < "a0"
+                if not (rel.startswith(prefix) or prefix.startswith(rel)):
+                    continue
+                if after > rel and not after.startswith(rel):
+                    continue  # все пути поддерева меньше курсора
+                yield from self._walk(os.path.join(dir_path, key[:-1]), rel, prefix, after, trust, visited)
+            elif rel > after and rel.startswith(prefix):
+                yield rel, size, mtime_ns
+
+    def _entries(self, dir_path: str, rel_dir: str, trust: bool) -> tuple:
+        try:
+            dir_mtime = os.stat(dir_path).st_mtime_ns
+        except OSError:
+            return ()
+        with self._lock:
+            cached = self._dirs.get(rel_dir)
+            dirty = rel_dir in self._dirty
+            self._dirty.discard(rel_dir)
+        if trust and not dirty and cached and cached[0] == dir_mtime:
+            return cached[1]
+
+        entries = []
+        try:
+            with os.scandir(dir_path) as it:
+                for entry in it:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            entries.append((entry.name + "/", None, None))
+                        elif entry.is_file():
+                            st = entry.stat()
+                            entries.append((entry.name, st.st_size, st.st_mtime_ns))
+                    except OSError:
+                        continue  # файл удалили между readdir и stat
+        except OSError:
+            return ()
+        entries.sort(key=operator.itemgetter(0))
+        entries = tuple(entries)
+        if self.use_snapshot:
+            with self._lock:
+                # mtime взят до чтения: если директория менялась во время обхода, её перечитают
+                self._dirs[rel_dir] = (dir_mtime, entries)
+        return entries
+
+
+def scan_local_tree(root: Path, prefix: str = "", after: str = ""):
+    """Обход через общий сканер (со снимком), если это ftp_root, иначе — разовый обход без кэша."""
+    scanner = local_scanner
+    if scanner is None or scanner.root != root:
+        scanner = LocalScanner(root, use_snapshot=False)
+    return scanner.scan(prefix, after)
+
+
+# ─── Общее чтение файла для нескольких серверов ──────────────────────────────
+
+class SharedFileReader:
+    """Одно чтение с диска на несколько одновременных загрузок файла на разные серверы.
+
+    Блоки прочитанного файла держатся в окне из WINDOW блоков. Первая загрузка,
+    дошедшая до блока, читает его с диска, остальные берут из окна. Загрузка,
+    отставшая больше чем на окно (медленный сервер), читает файл сама — быстрые
+    серверы её не ждут.
+
+    Один раз на все серверы файл читается только при загрузках из UploadDispatcher:
+    они стартуют на всех серверах одновременно. Periodic sync, mirror и
+    transfer_retry_loop идут через тот же читатель, но у каждого сервера они
+    проходят в своё время, так что файл обычно читается по разу на сервер.
+    """
+
+    BLOCK = 1024 * 1024
+    WINDOW = 16
+
+    # Путь -> читатель, пока у него есть пользователи
+    _registry: dict[str, "SharedFileReader"] = {}
+    _registry_lock = threading.Lock()
+
+    @classmethod
+    def open(cls, path: Path) -> "SharedFileView":
+        key = os.path.normcase(os.path.abspath(path))
+        with cls._registry_lock:
+            reader = cls._registry.get(key)
+            if reader is None or reader.changed():
+                # Файл перезаписан — старым читателем дочитывают те, кто его уже открыл
+                reader = cls(path, key)
+                cls._registry[key] = reader
+            reader._users += 1
+        return SharedFileView(reader)
+
+    def __init__(self, path: Path, key: str):
+        self.path = path
+        self._key = key
+        self._f = open(path, "rb")
+        self.stat = os.fstat(self._f.fileno())
+        self._lock = threading.Lock()
+        self._blocks: dict[int, bytes] = {}
+        self._next = 0
+        self._users = 0
+
+    def changed(self) -> bool:
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return True
+        return (st.st_size, st.st_mtime_ns) != (self.stat.st_size, self.stat.st_mtime_ns)
+
+    def block(self, index: int) -> bytes | None:
+        """Блок по номеру; None — блок уже вышел из окна, читать самому."""
+        with self._lock:
+            data = self._blocks.get(index)
+            if data is not None:
+                return data
+            if index < self._next:
+                return None
+            if index > self._next:
+                # Докачка начинается не с нуля
+                self._f.seek(index * self.BLOCK)
+            data = self._f.read(self.BLOCK)
+            self._blocks[index] = data
+            self._next = index + 1
+            for old in [i for i in self._blocks if i < self._next - self.WINDOW]:
+                del self._blocks[old]
+            return data
+
+    def release(self):
+        with self._registry_lock:
+            self._users -= 1
+            if self._users:
+                return
+            if self._registry.get(self._key) is self:
+                del self._registry[self._key]
+        with self._lock:
+            self._f.close()
+            self._blocks.clear()
+
+
+class SharedFileView:
+    """Файловый объект одной загрузки поверх SharedFileReader: своя позиция чтения."""
+
+    def __init__(self, reader: SharedFileReader):
+        self._reader = reader
+        self._pos = 0
+        self._own = None
+        self.stat = reader.stat
+
+    def readinto(self, buf) -> int:
+        index, offset = divmod(self._pos, SharedFileReader.BLOCK)
+        data = self._reader.block(index)
+        if data is None:
+            if self._own is None:
+                self._own = open(self._reader.path, "rb")
+            self._own.seek(self._pos)
+            n = self._own.readinto(buf)
+        else:
+            chunk = memoryview(data)[offset:offset + len(buf)]
+            n = len(chunk)
+            buf[:n] = chunk
+        self._pos += n
+        return n
+
+    def read(self, size: int = -1) -> bytes:
+        if size < 0:
+            size = max(0, self.stat.st_size - self._pos)
+        buf = bytearray(size)
+        view = memoryview(buf)
+        got = 0
+        while got < size:
+            n = self.readinto(view[got:])
+            if not n:
+                break
+            got += n
+        return bytes(buf[:got])
+
+    def seek(self, pos: int, whence: int = 0) -> int:
+        self._pos = pos if whence == 0 else (self._pos + pos if whence == 1 else self.stat.st_size + pos)
+        return self._pos
+
+    def tell(self) -> int:
+        return self._pos
+
+    def close(self):
+        if self._reader:
+            self._reader.release()
+            self._reader = None
+        if self._own:
+            self._own.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
 
-class MirrorResult(BaseModel):
-    success: bool
-    uploaded: list[str]
-    deleted_remote: list[str]
-    skipped: list[str]
-    failed: list[str]
-    message: str
 
 # ─── Утилита для работы с удалённым FTP ─────────────────────────────────────
 
+def remote_tls_context() -> ssl.SSLContext:
+    """TLS-контекст FTPS-соединений с удалённым сервером — общий для обоих движков.
+
+    Сертификат сервера НЕ проверяется (как у ftplib.FTP_TLS по умолчанию):
+    канал шифруется, но подлинность сервера не подтверждается.
+    """
+    context = ssl.create_default_context()
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_NONE
+    return context
+
+
+def dir_shard(dir_path: str, count: int) -> int:
+    """Шард директории для rolling mirror: все файлы одной директории — в одном шарде."""
+    return zlib.crc32(dir_path.encode("utf-8")) % count
+
+
 class RemoteFTPClient:
-    """Обёртка для подключения и загрузки файлов на удалённый FTP."""
+    """Обёртка для подключения и загрузки файлов на удалённый FTP.
+
+    Держит ограниченный пул авторизованных соединений: сессия берётся из пула
+    через `_session()` и возвращается обратно, а не закрывается после каждого файла.
+    """
+
+    # Простаивавшую дольше этого сессию перед выдачей проверяем NOOP
+    POOL_CHECK_AFTER = 10.0
 
     def __init__(self, host: str, port: int, user: str, password: str,
-                 root: str = "/", tls: bool = False):
+                 root: str = "/", tls: bool = False,
+                 pool_size: int = 4, keepalive: int = 60, workers: int = 1,
+                 manifest: SyncManifest | None = None, hash_index: HashIndex | None = None,
+                 resume_min_bytes: int = 16 * 1024 * 1024, temp_suffix: str = ".part",
+                 verify_tail: int = 64 * 1024, queue: TransferQueue | None = None,
+                 block_size: int = 0, use_sendfile: bool = True,
+                 name: str = "", shared_reads: bool = False, remote_index: RemoteIndex | None = None):
+        self.name = name
         self.host = host
         self.port = port
         self.user = user
         self.password = password
         self.root = root
         self.tls = tls
+        self.workers = max(1, workers)
+        self.manifest = manifest
+        self.hash_index = hash_index
+        self.queue = queue
+        # Последнее известное удалённое дерево — для инкрементальной сверки в mirror
+        self.remote_index = remote_index
+        # Большие файлы грузятся во временное имя с докачкой (0 — выключено)
+        self.resume_min_bytes = resume_min_bytes
+        self.temp_suffix = temp_suffix
+        self.verify_tail = verify_tail
+        # Размер блока канала данных (0 — подбирается по размеру файла) и sendfile без TLS
+        self.block_size = block_size
+        # На Windows socket.sendfile сводится к send() блоками по 8 КБ — там readinto быстрее
+        self.use_sendfile = use_sendfile and hasattr(os, "sendfile")
+        # Файлы читаются через SharedFileReader (серверов несколько); sendfile при этом не используется
+        self.shared_reads = shared_reads
+        # Путь -> (размер, mtime_ns) локального файла, с которого начата недокачанная загрузка
+        self._partials: dict[str, tuple[int, int]] = {}
+        # Команда сервера для хеша файла: (команда, алгоритм HASH_ALGORITHMS); "" — нет поддержки
+        self._hash_command: tuple[str, str] | None = None
+        # Каждому потоку загрузки — своя сессия, поэтому пул не меньше числа потоков
+        self.pool_size = max(1, pool_size, self.workers)
+        # Сколько из них — сессии ftplib (у AsyncRemoteFTPClient свой пул, а ftplib — только для редких операций)
+        self.ftplib_pool_size = self.pool_size
+        self.keepalive = keepalive
+
+        self._pool_cond = threading.Condition()
+        self._idle: list[tuple[ftplib.FTP, float]] = []
+        self._in_use = 0
+        self._waiting_realtime = 0
+        self._closed = False
+
+        # Кэш директорий (от root), которые точно есть на сервере
+        self._dirs_lock = threading.Lock()
+        self._known_dirs: set[str] = set()
+
+        if self.keepalive > 0:
+            threading.Thread(target=self._keepalive_loop, daemon=True).start()
+
+    @property
+    def target_id(self) -> str:
+        """Идентификатор удалённого сервера — ключ записей в манифесте."""
+        return f"{self.user}@{self.host}:{self.port}{self.root}"
 
     def _connect(self) -> ftplib.FTP:
         if self.tls:
-            ftp = ftplib.FTP_TLS()
+            ftp = ftplib.FTP_TLS(context=remote_tls_context())
         else:
             ftp = ftplib.FTP()
-        ftp.connect(self.host, self.port, timeout=30)
-        ftp.login(self.user, self.password)
+        with trace_phase("connect"):
+            ftp.connect(self.host, self.port, timeout=30)
         if self.tls:
-            ftp.prot_p()
-        if self.root and self.root != "/":
-            ftp.cwd(self.root)
+            # FTP_TLS.login сам сделал бы AUTH TLS — явно, чтобы рукопожатие считалось отдельно
+            with trace_phase("tls"):
+                ftp.auth()
+        with trace_phase("login"):
+            ftp.login(self.user, self.password)
+        if self.tls:
+            with trace_phase("tls"):
+                ftp.prot_p()
+        # Сессия всегда стоит в root: все пути в командах считаются от него
+        with trace_phase("cwd"):
+            ftp.cwd(self.root or "/")
         return ftp
 
-    def _ensure_remote_dir(self, ftp: ftplib.FTP, remote_dir: str):
-        if not remote_dir or remote_dir == "/":
+    # ─── Пул соединений ──────────────────────────────────────────────────────
+
+    @staticmethod
+    def _quit(ftp: ftplib.FTP):
+        try:
+            ftp.quit()
+        except Exception:
+            ftp.close()
+
+    @staticmethod
+    def _is_alive(ftp: ftplib.FTP) -> bool:
+        try:
+            ftp.voidcmd("NOOP")
+            return True
+        except Exception:
+            return False
+
+    @staticmethod
+    def _slot_free(priority: int, in_use: int, waiting_realtime: int, size: int) -> bool:
+        """Может ли запрос с таким приоритетом занять соединение пула из size сессий.
+
+        Фоновой работе не отдаётся последнее свободное соединение (при пуле больше 1)
+        и ни одно, пока своей очереди ждут мгновенные загрузки.
+        """
+        if priority == PRIORITY_REALTIME:
+            return in_use < size
+        reserved = 1 if size > 1 else 0
+        return in_use < size - reserved and waiting_realtime == 0
+
+    def _acquire(self, priority: int = PRIORITY_BULK) -> ftplib.FTP:
+        """Выдаёт живую сессию из пула или открывает новую (не больше ftplib_pool_size)."""
+        with self._pool_cond:
+            realtime = priority == PRIORITY_REALTIME
+            if realtime:
+                self._waiting_realtime += 1
+            try:
+                with trace_phase("pool_wait"):
+                    while not self._slot_free(
+                        priority, self._in_use, self._waiting_realtime, self.ftplib_pool_size,
+                    ) and not self._closed:
+                        self._pool_cond.wait()
+            finally:
+                if realtime:
+                    self._waiting_realtime -= 1
+            if self._closed:
+                self._pool_cond.notify_all()
+                raise RuntimeError("Пул соединений закрыт")
+            self._in_use += 1
+
+        try:
+            while True:
+                with self._pool_cond:
+                    if not self._idle:
+                        break
+                    ftp, last_used = self._idle.pop()
+                if time.monotonic() - last_used < self.POOL_CHECK_AFTER:
+                    return ftp
+                with trace_phase("pool_check"):
+                    alive = self._is_alive(ftp)
+                if alive:
+                    return ftp
+                logger.info(f"Пул: соединение с {self.host} разорвано, переподключение")
+                ftp.close()
+            return self._connect()
+        except BaseException:
+            with self._pool_cond:
+                self._in_use -= 1
+                self._pool_cond.notify_all()
+            raise
+
+    def _release(self, ftp: ftplib.FTP, reusable: bool = True):
+        with self._pool_cond:
+            self._in_use -= 1
+            keep = reusable and not self._closed
+            if keep:
+                self._idle.append((ftp, time.monotonic()))
+            # Ждущие с разными приоритетами ждут разных условий — будим всех
+            self._pool_cond.notify_all()
+        if not keep:
+            self._quit(ftp)
+
+    @contextmanager
+    def _session(self, priority: int = PRIORITY_BULK):
+        """Сессия из пула. После сетевой ошибки соединение не возвращается в пул."""
+        ftp = self._acquire(priority)
+        reusable = True
+        try:
+            yield ftp
+        except ftplib.error_perm:
+            raise
+        except BaseException:
+            reusable = False
+            raise
+        finally:
+            self._release(ftp, reusable)
+
+    def _keepalive_loop(self):
+        """Раз в keepalive секунд шлёт NOOP простаивающим сессиям, мёртвые выбрасывает."""
+        while True:
+            time.sleep(self.keepalive)
+            with self._pool_cond:
+                if self._closed:
+                    return
+                now = time.monotonic()
+                stale = [item for item in self._idle if now - item[1] >= self.keepalive]
+                self._idle = [item for item in self._idle if now - item[1] < self.keepalive]
+            for ftp, _ in stale:
+                if self._is_alive(ftp):
+                    with self._pool_cond:
+                        if not self._closed:
+                            self._idle.append((ftp, time.monotonic()))
+                            continue
+                self._quit(ftp)
+
+    def connections(self) -> tuple[int, int]:
+        """(занятые, простаивающие) соединения пула — для метрик."""
+        with self._pool_cond:
+            return self._in_use, len(self._idle)
+
+    def close(self):
+        """Закрывает пул: простаивающие сессии — сразу, занятые — при возврате."""
+        with self._pool_cond:
+            self._closed = True
+            idle, self._idle = self._idle, []
+            self._pool_cond.notify_all()
+        for ftp, _ in idle:
+            self._quit(ftp)
+
+    def _ensure_remote_dir(self, ftp: ftplib.FTP, remote_dir: str, recheck: bool = False):
+        """Создаёт директорию remote_dir (путь от root) вместе с родителями.
+
+        Директории, про которые уже известно, что они есть, хранятся в кэше
+        `_known_dirs`, поэтому для «горячих» директорий запросов к серверу нет.
+        Для новых — по одному MKD на уровень, без CWD туда и обратно.
+        recheck=True — не доверять кэшу и пройти все уровни заново.
+        """
+        if not remote_dir or (remote_dir in self._known_dirs and not recheck):
             return
-        parts = remote_dir.strip("/").split("/")
         current = ""
-        for part in parts:
-            current += f"/{part}"
+        for part in remote_dir.split("/"):
+            current = f"{current}/{part}" if current else part
+            if current in self._known_dirs and not recheck:
+                continue
             try:
-                ftp.cwd(current)
-            except ftplib.error_perm:
-                try:
+                with trace_phase("mkdir"):
                     ftp.mkd(current)
-                    logger.info(f"Создана удалённая директория: {current}")
-                except ftplib.error_perm as e:
-                    logger.warning(f"Не удалось создать {current}: {e}")
-        ftp.cwd(self.root if self.root else "/")
+                logger.info(f"Создана удалённая директория: {current}")
+            except ftplib.error_perm:
+                # Чаще всего «уже существует». Если на самом деле нет прав —
+                # упадёт STOR, и директория будет убрана из кэша.
+                pass
+            with self._dirs_lock:
+                self._known_dirs.add(current)
+
+    def _forget_remote_dir(self, remote_dir: str):
+        """Убирает директорию и всё, что под ней, из кэша известных директорий."""
+        if not remote_dir:
+            return
+        prefix = remote_dir + "/"
+        with self._dirs_lock:
+            self._known_dirs = {
+                d for d in self._known_dirs if d != remote_dir and not d.startswith(prefix)
+            }
+
+    # Границы автоматического размера блока канала данных
+    MIN_BLOCK = 64 * 1024
+    MAX_BLOCK = 1024 * 1024
+    # Скорость передач меньше этого размера пишется только в DEBUG: её съедает задержка команд
+    LOG_THROUGHPUT_FROM = 1024 * 1024
+
+    def _block_size(self, remaining: int, bucket: TokenBucket) -> int:
+        if self.block_size > 0:
+            block = self.block_size
+        else:
+            # Примерно 1/8 файла, но в пределах MIN_BLOCK..MAX_BLOCK
+            block = min(self.MAX_BLOCK, max(self.MIN_BLOCK, remaining // 8))
+        if bucket.rate > 0:
+            # При лимите скорости блок не больше секунды трафика — иначе передача идёт рывками
+            block = min(block, max(self.MIN_BLOCK, int(bucket.rate)))
+        return block
+
+    @staticmethod
+    def _remaining(f) -> int:
+        """Сколько байт файла осталось передать с текущей позиции (0 — неизвестно).
+
+        У SharedFileView (загрузка на несколько серверов) нет дескриптора — размер берётся из его stat.
+        """
+        try:
+            size = f.stat.st_size if isinstance(f, SharedFileView) else os.fstat(f.fileno()).st_size
+            return max(0, size - f.tell())
+        except (AttributeError, OSError):
+            return 0
+
+    def _store(self, ftp: ftplib.FTP, cmd: str, f, priority: int, rest: int | None = None):
+        """Передача данных файла (STOR/APPE) с ограничением скорости по приоритету.
+
+        Вместо storbinary с блоками по 8 КБ: без TLS файл уходит через socket.sendfile
+        (на Linux — без копирования в Python), с TLS — readinto в один переиспользуемый буфер.
+        """
+        bucket = rate_limiters[priority]
+        try:
+            fd = f.fileno()
+        except (AttributeError, OSError):
+            fd = None
+        start = f.tell()
+        block = self._block_size(self._remaining(f), bucket)
+
+        started = time.monotonic()
+        sent = 0
+        # data_open: TYPE, PASV, соединение данных и ответ 150; data_close: закрытие и ответ 226
+        with trace_phase("data_open"):
+            ftp.voidcmd("TYPE I")
+            conn = ftp.transfercmd(cmd, rest)
+        with conn:
+            tls = isinstance(conn, ssl.SSLSocket)
+            with trace_phase("data"):
+                if fd is not None and self.use_sendfile and not tls:
+                    mode = "sendfile"
+                    if bucket.rate <= 0:
+                        sent = conn.sendfile(f, start)
+                    else:
+                        while True:
+                            n = conn.sendfile(f, start + sent, block)
+                            if not n:
+                                break
+                            sent += n
+                            bucket.consume(n)
+                else:
+                    mode = "tls" if tls else "buffer"
+                    buf = bytearray(block)
+                    view = memoryview(buf)
+                    while True:
+                        n = f.readinto(buf)
+                        if not n:
+                            break
+                        conn.sendall(view[:n])
+                        sent += n
+                        bucket.consume(n)
+            trace_sent(sent)
+            if tls:
+                with trace_phase("data_close"):
+                    conn.unwrap()
+        with trace_phase("data_close"):
+            ftp.voidresp()
+        self._log_throughput(cmd, sent, time.monotonic() - started, mode, block)
+
+    def _log_throughput(self, cmd: str, sent: int, elapsed: float, mode: str, block: int):
+        level = logging.INFO if sent >= self.LOG_THROUGHPUT_FROM else logging.DEBUG
+        logger.log(
+            level,
+            f"{cmd}: {sent / 1048576:.1f} МБ за {elapsed:.2f}с — "
+            f"{sent / 1048576 / max(elapsed, 1e-6):.1f} МБ/с ({mode}, блок {block // 1024} КБ)",
+        )
 
-    def upload_file(self, local_path: Path, relative_path: str) -> bool:
+    def _store_via_cwd(self, ftp: ftplib.FTP, remote_dir: str, name: str, f, priority: int):
+        """STOR из самой директории — для серверов, не принимающих путь в STOR."""
+        with trace_phase("cwd"):
+            ftp.cwd(remote_dir)
         try:
-            ftp = self._connect()
+            self._store(ftp, f"STOR {name}", f, priority)
+        finally:
+            with trace_phase("cwd"):
+                ftp.cwd(self.root or "/")
+
+    def _tail_matches(self, ftp: ftplib.FTP, f, remote_path: str, remote_size: int) -> bool:
+        """Сверяет последние verify_tail байт недокачанного файла на сервере с локальными."""
+        length = min(self.verify_tail, remote_size)
+        f.seek(remote_size - length)
+        expected = f.read(length)
+        received = bytearray()
+
+        def collect(chunk: bytes):
+            received.extend(chunk)
+
+        ftp.retrbinary(f"RETR {remote_path}", collect, rest=remote_size - length)
+        return bytes(received[:length]) == expected
+
+    def _store_resumable(self, ftp: ftplib.FTP, remote_path: str, f, st: os.stat_result, priority: int):
+        """Загрузка во временное имя с докачкой и переименованием в конце.
+
+        Если на сервере уже есть часть файла (прошлая попытка оборвалась), загрузка
+        продолжается с её конца: REST + STOR, а если сервер не умеет REST — APPE.
+        Пока файл не переименован, недокачанная версия не видна под настоящим именем.
+        """
+        temp_path = remote_path + self.temp_suffix
+        signature = (st.st_size, st.st_mtime_ns)
+        offset = 0
+
+        with trace_phase("resume_check"):
+            ftp.voidcmd("TYPE I")
             try:
-                remote_dir = str(Path(relative_path).parent)
-                if remote_dir and remote_dir != ".":
-                    self._ensure_remote_dir(ftp, remote_dir)
-                    ftp.cwd(self.root if self.root else "/")
-                    ftp.cwd(remote_dir)
+                partial = ftp.size(temp_path) or 0
+            except ftplib.error_perm:
+                partial = 0
+            if 0 < partial <= st.st_size:
+                # Локальный файл мог измениться с прошлой попытки
+                started_from = self._partials.get(remote_path)
+                if started_from is not None and started_from != signature:
+                    logger.info(f"Докачка {remote_path}: локальный файл изменился, загрузка заново")
+                elif self.verify_tail and not self._tail_matches(ftp, f, temp_path, partial):
+                    logger.warning(f"Докачка {remote_path}: хвост на сервере не совпадает, загрузка заново")
+                else:
+                    offset = partial
 
-                with open(local_path, "rb") as f:
-                    ftp.storbinary(f"STOR {Path(relative_path).name}", f)
+        self._partials[remote_path] = signature
+        if offset < st.st_size:
+            if offset:
+                logger.info(f"Докачка {remote_path} с {offset} из {st.st_size} байт")
+            f.seek(offset)
+            try:
+                self._store(ftp, f"STOR {temp_path}", f, priority, rest=offset or None)
+            except ftplib.error_perm as e:
+                if not offset or str(e)[:3] not in ("500", "501", "502", "504"):
+                    raise
+                # Сервер не поддерживает REST для STOR — дописываем через APPE
+                f.seek(offset)
+                self._store(ftp, f"APPE {temp_path}", f, priority)
+
+        with trace_phase("rename"):
+            try:
+                ftp.rename(temp_path, remote_path)
+            except ftplib.error_perm:
+                # Часть серверов не переименовывает поверх существующего файла
+                ftp.delete(remote_path)
+                ftp.rename(temp_path, remote_path)
+        self._partials.pop(remote_path, None)
 
-                logger.info(f"Загружен: {relative_path}")
-                return True
-            finally:
-                ftp.quit()
+    def upload_file(self, local_path: Path, relative_path: str, priority: int = PRIORITY_BULK) -> bool:
+        """Загружает файл; возвращает True/False, ошибка только логируется."""
+        try:
+            self.put_file(local_path, relative_path, priority)
+            return True
         except Exception as e:
             logger.error(f"Ошибка загрузки {relative_path}: {e}")
             return False
 
-    def sync_all(self, local_root: Path) -> tuple[list[str], list[str]]:
-        synced = []
+    def put_file(self, local_path: Path, relative_path: str, priority: int = PRIORITY_BULK):
+        """Загружает файл; при ошибке бросает исключение (нужно очереди, чтобы запомнить причину)."""
+        remote_path = Path(relative_path).as_posix()
+        remote_dir, _, name = remote_path.rpartition("/")
+        started = time.monotonic()
+        try:
+            with transfer_traces.upload(self.name, remote_path, priority), self._session(priority) as ftp:
+                self._ensure_remote_dir(ftp, remote_dir)
+                with trace_phase("open_local"):
+                    f, st = self._open_local(local_path)
+                with f:
+                    resumable = 0 < self.resume_min_bytes <= st.st_size
+                    try:
+                        # Сессия всегда стоит в root, поэтому путь от root работает без CWD
+                        if resumable:
+                            self._store_resumable(ftp, remote_path, f, st, priority)
+                        else:
+                            self._store(ftp, f"STOR {remote_path}", f, priority)
+                    except ftplib.error_perm:
+                        if not remote_dir:
+                            raise
+                        # Директорию могли удалить, либо сервер не понимает путь в STOR
+                        self._forget_remote_dir(remote_dir)
+                        self._ensure_remote_dir(ftp, remote_dir, recheck=True)
+                        f.seek(0)
+                        if resumable:
+                            self._store_resumable(ftp, remote_path, f, st, priority)
+                        else:
+                            self._store_via_cwd(ftp, remote_dir, name, f, priority)
+        except Exception:
+            self._forget_remote_dir(remote_dir)
+            FAILED_TRANSFERS.inc(1, ("upload",))
+            raise
+        self._uploaded(remote_path, st, priority, started)
+
+    def _open_local(self, local_path: Path):
+        """Файл для загрузки и его stat; при нескольких серверах — через SharedFileReader."""
+        if self.shared_reads:
+            f = SharedFileReader.open(local_path)
+            return f, f.stat
+        f = open(local_path, "rb")
+        return f, os.fstat(f.fileno())
+
+    def _uploaded(self, remote_path: str, st: os.stat_result, priority: int, started: float):
+        """Учёт успешной загрузки: метрики, манифест, очередь."""
+        label = (PRIORITY_NAMES[priority],)
+        UPLOADED_FILES.inc(1, label)
+        UPLOADED_BYTES.inc(st.st_size, label)
+        UPLOAD_SECONDS.observe(time.monotonic() - started, label)
+        UPLOAD_SIZE.observe(st.st_size)
+        if self.manifest:
+            self.manifest.mark_uploaded(self.target_id, remote_path, st.st_size, st.st_mtime_ns)
+        if self.queue:
+            self.queue.resolve(self.target_id, remote_path)
+        if self.remote_index:
+            self.remote_index.stored(self.target_id, remote_path, st.st_size)
+        logger.info(f"Загружен: {remote_path}")
+
+    def _upload_many(self, items, job: "Job | None" = None) -> tuple[list[str], list[str]]:
+        """Загружает тройки (локальный путь, относительный путь, размер) в `workers` потоков.
+
+        Ошибка загрузки одного файла попадает только в список failed и не
+        останавливает остальные. В очереди держится не больше workers * 4 задач,
+        так что генератор путей не разворачивается в памяти целиком.
+        Отмена задачи `job` прекращает выдачу новых файлов; начатые догружаются.
+        """
+        uploaded = []
         failed = []
-        for local_file in local_root.rglob("*"):
-            if local_file.is_file():
-                relative = local_file.relative_to(local_root)
-                if self.upload_file(local_file, str(relative)):
-                    synced.append(str(relative))
-                else:
-                    failed.append(str(relative))
+
+        def collect(rel: str, size: int, ok: bool):
+            if ok:
+                uploaded.append(rel)
+            else:
+                failed.append(rel)
+            if job:
+                job.advance(size, None if ok else f"upload:{rel}")
+
+        if self.workers == 1:
+            for local_path, rel, size in items:
+                if job and job.cancelled:
+                    break
+                collect(rel, size, self.upload_file(local_path, rel))
+            return uploaded, failed
+
+        with self._upload_submitter() as submit:
+            pending = {}
+            for local_path, rel, size in items:
+                if job and job.cancelled:
+                    break
+                if len(pending) >= self.workers * 4:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for fut in done:
+                        collect(*pending.pop(fut), fut.result())
+                pending[submit(local_path, rel)] = (rel, size)
+            for fut in wait(pending).done:
+                collect(*pending[fut], fut.result())
+        return uploaded, failed
+
+    @contextmanager
+    def _upload_submitter(self):
+        """submit(local_path, rel) -> Future[bool] для _upload_many: здесь — пул из `workers` потоков."""
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="upload") as executor:
+            yield lambda local_path, rel: executor.submit(self.upload_file, local_path, rel)
+
+    def sync_all(
+        self, local_root: Path, force: bool = False, job: "Job | None" = None
+    ) -> tuple[list[str], list[str]]:
+        """Выгружает новые и изменённые файлы; force=True — все файлы подряд.
+
+        Без манифеста (или с force) ведёт себя как полная загрузка. После полного
+        прохода из манифеста убираются записи о файлах, которых больше нет локально.
+        """
+        if job:
+            job.set_phase("uploading")
+        known = self.manifest.load(self.target_id) if self.manifest and not force else {}
+        seen = set()
+        skipped = 0
+
+        def changed_files():
+            nonlocal skipped
+            for rel, size, mtime_ns in scan_local_tree(local_root):
+                seen.add(rel)
+                if known.get(rel) == (size, mtime_ns):
+                    skipped += 1
+                    continue
+                if job:
+                    job.add_total(1, size)
+                yield local_root / rel, rel, size
+
+        synced, failed = self._upload_many(changed_files(), job)
+
+        # После отмены обход не закончен — seen неполный, чистить манифест нельзя
+        if self.manifest and not force and not (job and job.cancelled):
+            gone = known.keys() - seen
+            if gone:
+                self.manifest.forget(self.target_id, gone)
+        if skipped:
+            logger.info(f"Синхронизация: {skipped} файлов без изменений пропущено")
         return synced, failed
 
     def test_connection(self) -> bool:
         try:
-            ftp = self._connect()
-            ftp.quit()
+            with self._session(PRIORITY_REALTIME) as ftp:
+                ftp.voidcmd("NOOP")
             return True
         except Exception as e:
             logger.error(f"Ошибка подключения к {self.host}:{self.port} — {e}")
@@ -323,164 +2206,689 @@ class RemoteFTPClient:
 
     # ─── Mirror-синхронизация ────────────────────────────────────────────────
 
-    def _list_remote_files(self, ftp: ftplib.FTP, path: str = "") -> dict[str, int]:
-        files = {}
-        current_dir = ftp.pwd()
-        if path:
-            try:
-                ftp.cwd(path)
-            except ftplib.error_perm:
-                return files
-
-        items = []
+    @staticmethod
+    def _parse_mlsd_line(line: str) -> tuple[str, dict[str, str]] | None:
+        """Разбирает строку MLSD `type=file;size=12;modify=...; name` в (имя, факты)."""
+        parts = line.split("; ", 1)
+        if len(parts) != 2:
+            return None
+        facts_str, name = parts
+        if name in (".", ".."):
+            return None
+        facts = {}
+        for fact in facts_str.split(";"):
+            if "=" in fact:
+                k, v = fact.split("=", 1)
+                facts[k.strip().lower()] = v.strip()
+        return name, facts
+
+    def _list_dir_mlsd(self, ftp: ftplib.FTP, path: str) -> list[tuple[str, dict[str, str]]]:
+        """Одна директория через `MLSD <path>` — без CWD."""
+        lines = []
+        ftp.retrlines(f"MLSD {path}" if path else "MLSD", lines.append)
+        entries = []
+        for line in lines:
+            parsed = self._parse_mlsd_line(line)
+            if parsed:
+                entries.append(parsed)
+        return entries
+
+    def _list_dir_nlst(self, ftp: ftplib.FTP, path: str) -> list[tuple[str, dict[str, str]]]:
+        """Фолбэк для серверов без MLSD: `NLST <path>` и `SIZE` на каждый элемент.
+
+        SIZE отвечает только для файлов; элемент без размера проверяется CWD.
+        """
         try:
-            ftp.retrlines("MLSD", lambda line: items.append(line))
+            names = ftp.nlst(path) if path else ftp.nlst()
         except ftplib.error_perm:
-            return self._list_remote_files_fallback(ftp, path)
-
-        for item in items:
-            parts = item.split("; ", 1)
-            if len(parts) != 2:
-                continue
-            facts_str, name = parts[0], parts[1]
-            if name in (".", ".."):
+            return []
+        ftp.voidcmd("TYPE I")  # многие серверы отказывают в SIZE в режиме ASCII
+        entries = []
+        for raw in names:
+            name = raw.rstrip("/").rpartition("/")[2]
+            if name in ("", ".", ".."):
                 continue
-
-            facts = {}
-            for fact in facts_str.split(";"):
-                if "=" in fact:
-                    k, v = fact.split("=", 1)
-                    facts[k.strip().lower()] = v.strip()
-
-            rel = f"{path}/{name}".strip("/") if path else name
-
-            if facts.get("type", "").lower() == "dir":
-                files.update(self._list_remote_files(ftp, rel))
-            elif facts.get("type", "").lower() == "file":
-                size = int(facts.get("size", 0))
-                files[rel] = size
-
-        ftp.cwd(current_dir)
-        return files
-
-    def _list_remote_files_fallback(self, ftp: ftplib.FTP, path: str = "") -> dict[str, int]:
-        files = {}
-        current_dir = ftp.pwd()
-        if path:
+            full = f"{path}/{name}" if path else name
             try:
-                ftp.cwd(path)
-            except ftplib.error_perm:
-                return files
-
-        try:
-            names = ftp.nlst()
-        except ftplib.error_perm:
-            ftp.cwd(current_dir)
-            return files
-
-        for name in names:
-            if name in (".", ".."):
+                entries.append((name, {"type": "file", "size": str(ftp.size(full) or 0)}))
                 continue
-            rel = f"{path}/{name}".strip("/") if path else name
+            except ftplib.error_perm:
+                pass
             try:
-                ftp.cwd(name)
-                ftp.cwd("..")
-                files.update(self._list_remote_files_fallback(ftp, rel))
+                ftp.cwd(full)
             except ftplib.error_perm:
+                entries.append((name, {"type": "file", "size": "0"}))
+                continue
+            # CWD удался — сессия ушла из root, возвращаем её
+            ftp.cwd(self.root or "/")
+            entries.append((name, {"type": "dir"}))
+        return entries
+
+    def _list_remote_entries(self, path: str = "") -> dict[str, dict[str, str]]:
+        """Всё дерево под path: {путь от root: факты} для файлов и директорий."""
+        return self._list_dirs([path])
+
+    def _list_dirs(self, paths, descend=None) -> dict[str, dict[str, str]]:
+        """Обходит директории paths в ширину в несколько сессий пула.
+
+        Каждая директория — отдельная задача `MLSD <path>` в своей сессии, найденные
+        поддиректории сразу ставятся в очередь, если `descend(путь)` не против
+        (по умолчанию — все). Если сервер не знает MLSD, весь обход продолжается
+        через NLST. Возвращает {путь от root: факты} для найденных файлов и директорий.
+        """
+        entries: dict[str, dict[str, str]] = {}
+        lister = self._list_dir_mlsd
+
+        def list_dir(dir_path: str):
+            nonlocal lister
+            for attempt in (1, 2):
                 try:
-                    size = ftp.size(name) or 0
+                    with self._session() as ftp:
+                        try:
+                            return lister(ftp, dir_path)
+                        except ftplib.error_perm as e:
+                            if lister == self._list_dir_mlsd and str(e)[:3] in ("500", "501", "502", "504"):
+                                logger.info("Листинг: сервер не поддерживает MLSD, используется NLST")
+                                lister = self._list_dir_nlst
+                                return lister(ftp, dir_path)
+                            logger.warning(f"Листинг: нет доступа к {dir_path or '/'}: {e}")
+                            return []
+                except ftplib.error_perm:
+                    raise
                 except Exception:
-                    size = 0
-                files[rel] = size
-
-        ftp.cwd(current_dir)
-        return files
+                    # Сессия уже выброшена из пула — одна повторная попытка в новой
+                    if attempt == 2:
+                        raise
+
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="listing") as executor:
+            pending = {executor.submit(list_dir, path): path for path in paths}
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for fut in done:
+                    dir_path = pending.pop(fut)
+                    for name, facts in fut.result():
+                        rel = f"{dir_path}/{name}" if dir_path else name
+                        entries[rel] = facts
+                        if facts.get("type", "").lower() == "dir" and (descend is None or descend(rel)):
+                            pending[executor.submit(list_dir, rel)] = rel
+        return entries
+
+    def _dir_modify(self, dirs: list[str]) -> dict[str, str | None]:
+        """`modify` каждой директории по MLST (без канала данных); None — директории нет.
+
+        Сервер без MLST отвечает 500-504 — это исключение уходит вызывающему.
+        """
+        def check(rel: str) -> str | None:
+            with self._session() as ftp:
+                try:
+                    return self._parse_mlst_modify(ftp.sendcmd(f"MLST {rel}" if rel else "MLST"))
+                except ftplib.error_perm as e:
+                    if str(e)[:3] == "550":
+                        return None
+                    raise
+
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="mlst") as executor:
+            return dict(zip(dirs, executor.map(check, dirs)))
+
+    @classmethod
+    def _parse_mlst_modify(cls, resp: str) -> str:
+        # 250-Listing dir\n type=dir;modify=20240101120000; /dir\n250 End
+        for line in resp.splitlines()[1:-1]:
+            parsed = cls._parse_mlsd_line(line.strip())
+            if parsed:
+                return parsed[1].get("modify", "")
+        return ""
+
+    def _remote_entries(self, full_listing_days: float) -> dict[str, dict[str, str]]:
+        """Удалённое дерево для mirror: инкрементальная сверка индекса или полный листинг.
+
+        Полный листинг — если индекса нет, сервер в нём ещё не листался целиком
+        или последний полный листинг старше full_listing_days (0 — каждый раз).
+        Полный листинг заменяет индекс сервера.
+        """
+        index = self.remote_index
+        if index is None:
+            return self._list_remote_entries()
+        root_modify, full_listing_at = index.state(self.target_id)
+        full = not full_listing_days or full_listing_at is None or (
+            time.time() - full_listing_at > full_listing_days * 86400
+        )
+        if not full:
+            try:
+                return self._refresh_remote_index(root_modify)
+            except ftplib.error_perm as e:
+                if str(e)[:3] not in ("500", "501", "502", "504"):
+                    raise
+                logger.info("Mirror: сервер не поддерживает MLST, используется полный листинг")
+        logger.info("Mirror: полный листинг удалённого сервера")
+        entries = self._list_remote_entries()
+        index.replace(self.target_id, entries)
+        return entries
+
+    def _refresh_remote_index(self, root_modify: str) -> dict[str, dict[str, str]]:
+        """Инкрементальная сверка индекса с сервером.
+
+        Свои изменения уже записаны в индекс, поэтому проверяется только, какие
+        директории изменились: MLST каждой известной директории, MLSD — лишь тех,
+        у которых `modify` другой (или сброшен нашими загрузками и удалениями),
+        и полный обход новых поддиректорий. Перезапись файла на месте `modify`
+        директории не меняет — такое находит только периодический полный листинг.
+        """
+        known = self.remote_index.load(self.target_id)
+        stored = {"": root_modify}
+        stored.update((rel, facts["modify"]) for rel, facts in known.items() if facts["type"] == "dir")
+        current = self._dir_modify(list(stored))
+        if current[""] is None:
+            raise RuntimeError("корневая директория сервера недоступна")
+
+        changed = [d for d, modify in current.items() if modify is not None and (not stored[d] or modify != stored[d])]
+        gone = [d for d, modify in current.items() if modify is None]
+        found = self._list_dirs(changed, descend=lambda rel: rel not in known)
+
+        listed = set(changed)
+        listed.update(rel for rel, facts in found.items() if facts.get("type", "").lower() == "dir" and rel not in known)
+        removed = gone + self._stale_entries(known, found, listed)
+        upserts = dict(found)
+        for d in changed:
+            if d:
+                upserts[d] = {**upserts.get(d, known[d]), "modify": current[d]}
+        self.remote_index.apply(self.target_id, upserts, removed, current[""])
+        logger.info(
+            f"Mirror: инкрементальная сверка — проверено {len(current)} директорий, "
+            f"перечитано {len(listed)}, удалено из индекса {len(removed)}"
+        )
+        return self.remote_index.load(self.target_id)
+
+    @staticmethod
+    def _stale_entries(known: dict, found: dict, listed: set[str]) -> list[str]:
+        """Записи индекса в перечитанных директориях, которых в новом листинге нет."""
+        return [rel for rel in known if rel.rpartition("/")[0] in listed and rel not in found]
+
+    def _list_shards(
+        self, shards: set[int], shard_count: int, local_files: dict[str, tuple[int, int]],
+    ) -> tuple[dict[str, dict[str, str]], set[str]]:
+        """Листинг только директорий из шардов `shards` — для rolling mirror.
+
+        Какие директории есть на сервере, известно из RemoteIndex, плюс все локальные
+        директории: пока индекс пуст (новая установка, смена сервера), шард 0 иначе
+        обошёл бы всё дерево разом, а остальные шарды не увидели бы, что файлы на
+        сервере уже есть. Директории, которой нет на сервере, соответствует пустой
+        листинг. Поддиректории, которых нет ни там, ни там, обходятся целиком: это
+        новое или лишнее на сервере. Возвращает (факты, перечитанные директории);
+        индекс обновляется по результату.
+        """
+        local_dirs = {""}
+        for rel in local_files:
+            d = rel.rpartition("/")[0]
+            while d not in local_dirs:
+                local_dirs.add(d)
+                d = d.rpartition("/")[0]
+        known = self.remote_index.load(self.target_id) if self.remote_index else {}
+        remote_dirs = local_dirs | {rel for rel, facts in known.items() if facts["type"] == "dir"}
+
+        selected = [d for d in remote_dirs if dir_shard(d, shard_count) in shards]
+        found = self._list_dirs(selected, descend=lambda rel: rel not in remote_dirs)
+        listed = set(selected)
+        listed.update(rel for rel, facts in found.items() if facts.get("type", "").lower() == "dir" and rel not in remote_dirs)
+        if self.remote_index:
+            # Свежий modify поддиректории, которую саму не перечитали, пометил бы её в индексе
+            # сверенной, и инкрементальная сверка её бы пропустила: оставляем прежний
+            # (у новой — пустой, такую _refresh_remote_index перечитает)
+            upserts = {
+                rel: facts if rel in listed or facts.get("type", "").lower() != "dir"
+                else {**facts, "modify": known.get(rel, {}).get("modify", "")}
+                for rel, facts in found.items()
+            }
+            self.remote_index.apply(self.target_id, upserts, self._stale_entries(known, found, listed))
+        return found, listed
+
+    def _list_remote_files(self, path: str = "") -> dict[str, int]:
+        """Все файлы под path: {путь от root: размер}."""
+        return {
+            rel: int(facts.get("size", 0))
+            for rel, facts in self._list_remote_entries(path).items()
+            if facts.get("type", "").lower() == "file"
+        }
 
     def _delete_remote_file(self, ftp: ftplib.FTP, remote_path: str) -> bool:
         try:
             ftp.delete(remote_path)
-            logger.info(f"Удалён с удалённого: {remote_path}")
-            return True
         except ftplib.error_perm as e:
-            logger.error(f"Не удалось удалить {remote_path}: {e}")
+            self._delete_refused(remote_path, e)
             return False
-
-    def _remove_empty_dirs(self, ftp: ftplib.FTP, dir_path: str):
-        try:
-            items = []
-            ftp.retrlines(f"MLSD {dir_path}", lambda line: items.append(line))
-            real_items = [
-                i for i in items
-                if not i.strip().endswith("; .") and not i.strip().endswith("; ..")
-            ]
-            if len(real_items) == 0:
-                ftp.rmd(dir_path)
-                logger.info(f"Удалена пустая директория: {dir_path}")
-                parent = str(Path(dir_path).parent)
-                if parent and parent != "." and parent != "/":
-                    self._remove_empty_dirs(ftp, parent)
+        self._deleted(remote_path)
+        return True
+
+    def _deleted(self, remote_path: str):
+        DELETED_FILES.inc()
+        if self.queue:
+            self.queue.resolve(self.target_id, remote_path)
+        if self.remote_index:
+            self.remote_index.removed(self.target_id, remote_path)
+        logger.info(f"Удалён с удалённого: {remote_path}")
+
+    def _delete_refused(self, remote_path: str, e: ftplib.error_perm):
+        logger.error(f"Не удалось удалить {remote_path}: {e}")
+        FAILED_TRANSFERS.inc(1, ("delete",))
+        if self.queue:
+            self.queue.fail(self.queue.put(self.target_id, "delete", remote_path, active=True), str(e))
+
+    def delete_file(self, remote_path: str):
+        """Удаляет файл на сервере; ответ 550 (файла уже нет) ошибкой не считается."""
+        try:
+            with self._session() as ftp:
+                try:
+                    ftp.delete(remote_path)
+                except ftplib.error_perm as e:
+                    if not str(e).startswith("550"):
+                        raise
         except Exception:
-            pass
+            FAILED_TRANSFERS.inc(1, ("delete",))
+            raise
+        self._deleted(remote_path)
+
+    def _remove_remote_dir(self, ftp: ftplib.FTP, dir_path: str) -> bool:
+        try:
+            ftp.rmd(dir_path)
+        except ftplib.error_perm as e:
+            # Например, после листинга в директорию успели загрузить новый файл
+            logger.warning(f"Не удалось удалить директорию {dir_path}: {e}")
+            return False
+        self._removed_dir(dir_path)
+        return True
+
+    def _removed_dir(self, dir_path: str):
+        self._forget_remote_dir(dir_path)
+        if self.remote_index:
+            self.remote_index.removed(self.target_id, dir_path)
+        logger.info(f"Удалена пустая директория: {dir_path}")
+
+    def _run_in_sessions(
+        self, paths: list[str], op: str, job: "Job | None" = None,
+    ) -> tuple[list[str], list[str]]:
+        """Выполняет op ("delete" — DELE, "rmd" — RMD) для путей по порядку в `workers` сессиях пула.
+
+        Каждый исполнитель держит одну сессию и берёт следующий путь из общего списка.
+        После сетевой ошибки путь считается неудачным и исполнитель открывает новую сессию;
+        если не удаётся и это, он завершается. Пути, до которых так и не дошли,
+        возвращаются как неудачные; неудачные удаления файлов ставятся в очередь повторов.
+        """
+        done: list[str] = []
+        failed: list[str] = []
+        todo = iter(paths)
+        lock = threading.Lock()
+
+        def next_path() -> str | None:
+            with lock:
+                if job and job.cancelled:
+                    return None
+                return next(todo, None)
+
+        def record(path: str, ok: bool, error: str | None = None):
+            with lock:
+                (done if ok else failed).append(path)
+            if job:
+                job.advance(0, None if ok else f"{op}:{path}")
+            if error and op == "delete" and self.queue:
+                self.queue.fail(self.queue.put(self.target_id, "delete", path, active=True), error)
+
+        self._session_workers(min(self.workers, len(paths)), op, next_path, record)
+
+        if not (job and job.cancelled):
+            for path in todo:
+                record(path, False, "нет соединения с сервером")
+        return done, failed
+
+    def _session_workers(self, count: int, op: str, next_path, record):
+        """Исполнители _run_in_sessions: здесь — потоки, каждый со своей сессией пула."""
+        action = {"delete": self._delete_remote_file, "rmd": self._remove_remote_dir}[op]
+
+        def worker():
+            while True:
+                current = None
+                try:
+                    with self._session() as ftp:
+                        while True:
+                            current = next_path()
+                            if current is None:
+                                return
+                            record(current, action(ftp, current))
+                except Exception as e:
+                    if current is None:
+                        logger.error(f"Нет соединения для удаления: {e}")
+                        return
+                    logger.error(f"Ошибка при удалении {current}: {e}")
+                    FAILED_TRANSFERS.inc(1, ("delete",))
+                    record(current, False, str(e))
+
+        if count <= 1:
+            worker()
+        else:
+            with ThreadPoolExecutor(max_workers=count, thread_name_prefix="delete") as executor:
+                for fut in [executor.submit(worker) for _ in range(count)]:
+                    fut.result()
+
+    def _delete_orphans(
+        self, orphans: set[str], remote_entries: dict[str, dict[str, str]],
+        local_files: dict[str, tuple[int, int]], job: "Job | None" = None, listed: set[str] | None = None,
+    ) -> tuple[list[str], list[str]]:
+        """Удаляет orphan-файлы, затем ставшие пустыми директории — без повторного листинга.
+
+        Какие директории опустели, считается по листингу, уже полученному mirror:
+        для каждой директории — сколько в ней осталось записей после удаления файлов.
+        Директории удаляются по уровням, начиная с самых глубоких; внутри уровня — параллельно.
+        Рассматриваются только предки удалённых файлов, в которых нет локальных файлов,
+        и только перечитанные директории `listed` (None — листинг полный).
+        """
+        deleted, failed = self._run_in_sessions(sorted(orphans, reverse=True), "delete", job)
+
+        def parent(rel: str) -> str:
+            return rel.rpartition("/")[0]
+
+        # Записей (файлов и директорий) непосредственно в каждой директории по листингу
+        children: dict[str, int] = {}
+        for rel in remote_entries:
+            children[parent(rel)] = children.get(parent(rel), 0) + 1
+        for rel in deleted:
+            children[parent(rel)] -= 1
+
+        local_dirs = set()
+        for rel in local_files:
+            d = parent(rel)
+            while d and d not in local_dirs:
+                local_dirs.add(d)
+                d = parent(d)
+
+        candidates = set()
+        for rel in deleted:
+            d = parent(rel)
+            while d and d not in candidates and d not in local_dirs:
+                if listed is None or d in listed:
+                    candidates.add(d)
+                d = parent(d)
+
+        by_depth: dict[int, list[str]] = {}
+        for d in candidates:
+            by_depth.setdefault(d.count("/"), []).append(d)
+        for depth in sorted(by_depth, reverse=True):
+            if job and job.cancelled:
+                break
+            empty = [d for d in by_depth[depth] if children.get(d, 0) == 0]
+            if not empty:
+                continue
+            removed, _ = self._run_in_sessions(empty, "rmd")
+            for d in removed:
+                if parent(d):
+                    # При листинге по шардам родителя могли не перечитывать
+                    children[parent(d)] = children.get(parent(d), 0) - 1
+        return deleted, failed
+
+    def _detect_hash_command(self) -> tuple[str, str] | None:
+        """Узнаёт через FEAT, умеет ли сервер считать хеши (HASH, XSHA1, XMD5, XCRC)."""
+        if self._hash_command is None:
+            with self._session() as ftp:
+                try:
+                    feat = ftp.sendcmd("FEAT").upper()
+                except ftplib.error_perm:
+                    feat = ""
+            features = {line.strip().split(" ")[0]: line.strip() for line in feat.splitlines()[1:]}
+            command = ("", "")
+            if "HASH" in features:
+                offered = features["HASH"][4:].replace("*", "").split(";")
+                for algo in HASH_ALGORITHMS:
+                    if algo in (a.strip() for a in offered):
+                        command = ("HASH", algo)
+                        break
+            if not command[0]:
+                for cmd, algo in (("XSHA1", "SHA-1"), ("XMD5", "MD5"), ("XCRC", "CRC32")):
+                    if cmd in features:
+                        command = (cmd, algo)
+                        break
+            self._hash_command = command
+            if command[0]:
+                logger.info(f"Mirror: сервер считает хеши командой {command[0]} ({command[1]})")
+            else:
+                logger.info("Mirror: сервер не считает хеши, сравнение по MLSD modify")
+        return self._hash_command if self._hash_command[0] else None
+
+    def _remote_hash(self, ftp: ftplib.FTP, command: str, algo: str, remote_path: str) -> str:
+        if command == "HASH":
+            # Алгоритм выбирается один раз на сессию
+            if getattr(ftp, "hash_algo", None) != algo:
+                ftp.sendcmd(f"OPTS HASH {algo}")
+                ftp.hash_algo = algo
+            # 213 SHA-256 0-49 169cd22282da7f147cb491e559e9dd filename
+            return ftp.sendcmd(f"HASH {remote_path}").split()[3].lower()
+        # 250 <hex> или 213 <hex> [filename]
+        return ftp.sendcmd(f"{command} {remote_path}").split()[1].lower()
+
+    def _local_hashes(self, local_root: Path, files: dict[str, tuple[int, int]], algo: str) -> dict[str, str | None]:
+        """Хеши локальных файлов: из индекса, недостающие — в пуле потоков.
+
+        None — файл не прочитался (исчез или заблокирован после обхода).
+        """
+        hash_algo = HASH_ALGORITHMS[algo]
+        cached = self.hash_index.lookup(hash_algo) if self.hash_index else {}
+        digests = {}
+        missing = []
+        for rel, (size, mtime_ns) in files.items():
+            hit = cached.get(rel)
+            if hit and hit[0] == size and hit[1] == mtime_ns:
+                digests[rel] = hit[2]
+            else:
+                missing.append(rel)
+
+        if missing:
+            logger.info(f"Mirror: подсчёт хешей {len(missing)} файлов ({len(digests)} из индекса)")
+            paths = [str(local_root / rel) for rel in missing]
+            if len(missing) >= HASH_POOL_THRESHOLD:
+                with ThreadPoolExecutor(max_workers=os.cpu_count() or 4, thread_name_prefix="hash-local") as executor:
+                    computed = list(executor.map(hash_file_or_none, paths, [hash_algo] * len(paths)))
+            else:
+                computed = [hash_file_or_none(p, hash_algo) for p in paths]
+            digests.update(zip(missing, computed))
+            if self.hash_index:
+                self.hash_index.store(
+                    hash_algo, ((rel, *files[rel], digests[rel]) for rel in missing if digests[rel] is not None)
+                )
+        return digests
+
+    @staticmethod
+    def _parse_mlsd_time(value: str) -> float | None:
+        """`modify` из MLSD (YYYYMMDDHHMMSS[.sss], UTC) -> unix time."""
+        try:
+            return calendar.timegm(time.strptime(value[:14], "%Y%m%d%H%M%S"))
+        except (ValueError, TypeError):
+            return None
+
+    def _changed_by_checksum(
+        self, local_root: Path, candidates: dict[str, tuple[int, int]], remote_entries: dict[str, dict[str, str]]
+    ) -> set[str]:
+        """Из файлов с одинаковым размером выбирает те, у которых отличается содержимое.
+
+        Если сервер умеет HASH/XMD5/XSHA1/XCRC — сравниваются хеши. Иначе файл
+        считается изменённым, если локальный mtime новее `modify` на сервере.
+        """
+        hash_command = self._detect_hash_command()
+        if not hash_command:
+            changed = set()
+            for rel, (_, mtime_ns) in candidates.items():
+                remote_mtime = self._parse_mlsd_time(remote_entries.get(rel, {}).get("modify"))
+                # Допуск 2с — на случай серверов с грубыми отметками времени
+                if remote_mtime is not None and mtime_ns / 1e9 > remote_mtime + 2:
+                    changed.add(rel)
+            return changed
+
+        command, algo = hash_command
+        local = self._local_hashes(local_root, candidates, algo)
+
+        def remote_digest(rel: str) -> str | None:
+            try:
+                with self._session() as ftp:
+                    return self._remote_hash(ftp, command, algo, rel)
+            except Exception as e:
+                logger.warning(f"Mirror: не удалось получить хеш {rel}: {e}")
+                return None
+
+        # Локальный файл не прочитался — пропускаем в этом проходе, его подхватит следующий
+        unreadable = {rel for rel in candidates if local[rel] is None}
+        if unreadable:
+            logger.warning(f"Mirror: {len(unreadable)} файлов не прочитано для сверки хешей, пропущены")
+        readable = [rel for rel in candidates if rel not in unreadable]
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="hash") as executor:
+            remote = dict(zip(readable, executor.map(remote_digest, readable)))
+        # Не удалось получить хеш с сервера — загружаем заново, это безопаснее
+        hash_algo = HASH_ALGORITHMS[algo]
+        return {
+            rel for rel in readable
+            if remote[rel] is None or not same_digest(remote[rel], local[rel], hash_algo)
+        }
 
     def mirror_sync(
-        self, local_root: Path, delete_orphans: bool = True
+        self, local_root: Path, delete_orphans: bool = True, compare: str = "size",
+        job: "Job | None" = None, max_deletions: int = 0, full_listing_days: float = 0,
+        shards: set[int] | None = None, shard_count: int = 0,
+    ) -> tuple[list[str], list[str], list[str], list[str]]:
+        """Сверяет локальное дерево с удалённым.
+
+        compare="size" — файл не изменён, если совпадает размер;
+        compare="checksum" — при совпадении размера дополнительно сверяется содержимое.
+        max_deletions — если orphan-файлов больше, удаление пропускается целиком
+        и в failed попадает "delete_limit: ..." (0 — без лимита).
+        full_listing_days — как часто листать сервер целиком; между полными листингами
+        удалённое дерево берётся из RemoteIndex с инкрементальной сверкой (0 — всегда целиком).
+        shards — сверить только директории из этих шардов (из shard_count, см. dir_shard).
+        Отмена задачи `job` проверяется между фазами и между файлами.
+        """
+        try:
+            return self._mirror_sync(
+                local_root, delete_orphans, compare, job, max_deletions, full_listing_days, shards, shard_count,
+            )
+        finally:
+            set_mirror_phase(self.name, "idle")
+
+    def _mirror_sync(
+        self, local_root: Path, delete_orphans: bool, compare: str, job: "Job | None", max_deletions: int,
+        full_listing_days: float, shards: set[int] | None, shard_count: int,
     ) -> tuple[list[str], list[str], list[str], list[str]]:
         uploaded = []
         deleted = []
         skipped = []
         failed = []
 
+        def phase(name: str) -> bool:
+            """Переходит к следующей фазе; False — задачу отменили."""
+            set_mirror_phase(self.name, name)
+            if job:
+                job.set_phase(name)
+                return not job.cancelled
+            return True
+
+        local_files: dict[str, tuple[int, int]] | None = None
+        listed = None
+        if shards is not None:
+            # Какие директории листать, зависит от локального дерева — сначала оно
+            if not phase("scanning"):
+                return uploaded, deleted, skipped, failed
+            local_files = {rel: (size, mtime_ns) for rel, size, mtime_ns in scan_local_tree(local_root)}
+
         try:
-            ftp = self._connect()
+            logger.info("Mirror: сканирование удалённого сервера...")
+            phase("listing")
+            started = time.monotonic()
+            if shards is None:
+                remote_entries = self._remote_entries(full_listing_days)
+            else:
+                remote_entries, listed = self._list_shards(shards, shard_count, local_files)
+            remote_files = {
+                rel: int(facts.get("size", 0))
+                for rel, facts in remote_entries.items()
+                if facts.get("type", "").lower() == "file"
+            }
+            elapsed = time.monotonic() - started
+            LISTING_SECONDS.set(elapsed, (self.name,))
+            LISTING_ENTRIES.set(len(remote_entries), (self.name,))
+            logger.info(f"Mirror: листинг занял {elapsed:.1f}с")
         except Exception as e:
-            logger.error(f"Mirror: не удалось подключиться — {e}")
+            logger.error(f"Mirror: не удалось получить список файлов — {e}")
             return uploaded, deleted, skipped, [f"connection: {e}"]
 
         try:
-            logger.info("Mirror: сканирование удалённого сервера...")
-            remote_files = self._list_remote_files(ftp, "")
             logger.info(f"Mirror: найдено {len(remote_files)} файлов на удалённом сервере")
-
-            local_files: dict[str, int] = {}
-            for local_file in local_root.rglob("*"):
-                if local_file.is_file():
-                    rel = str(local_file.relative_to(local_root))
-                    local_files[rel] = local_file.stat().st_size
+            if local_files is None:
+                if not phase("scanning"):
+                    return uploaded, deleted, skipped, failed
+                local_files = {rel: (size, mtime_ns) for rel, size, mtime_ns in scan_local_tree(local_root)}
+            else:
+                # Сверяются только файлы шардов: директории, выбранные по шарду или перечитанные
+                local_files = {
+                    rel: stat for rel, stat in local_files.items()
+                    if rel.rpartition("/")[0] in listed
+                    or dir_shard(rel.rpartition("/")[0], shard_count) in shards
+                }
 
             logger.info(f"Mirror: найдено {len(local_files)} локальных файлов")
-            ftp.quit()
 
-            for rel_path, local_size in local_files.items():
-                remote_size = remote_files.get(rel_path)
-                if remote_size is not None and remote_size == local_size:
+            same_size = {
+                rel: stat for rel, stat in local_files.items()
+                if remote_files.get(rel) == stat[0]
+            }
+            changed = set()
+            if compare == "checksum" and same_size:
+                if not phase("comparing"):
+                    return uploaded, deleted, skipped, failed
+                changed = self._changed_by_checksum(local_root, same_size, remote_entries)
+                logger.info(f"Mirror: по содержимому изменено {len(changed)} файлов того же размера")
+                if self.hash_index and shards is None:
+                    self.hash_index.retain(set(local_files))
+
+            to_upload = []
+            for rel_path in local_files:
+                if rel_path in same_size and rel_path not in changed:
                     skipped.append(rel_path)
                     continue
-                local_path = local_root / rel_path
-                if self.upload_file(local_path, rel_path):
-                    uploaded.append(rel_path)
-                else:
-                    failed.append(rel_path)
-
-            if delete_orphans:
+                to_upload.append((local_root / rel_path, rel_path, local_files[rel_path][0]))
+
+            if not phase("uploading"):
+                return uploaded, deleted, skipped, failed
+            if job:
+                job.add_total(len(to_upload), sum(item[2] for item in to_upload))
+            done, not_done = self._upload_many(to_upload, job)
+            uploaded.extend(done)
+            failed.extend(not_done)
+            if self.manifest:
+                self.manifest.forget(self.target_id, set(remote_files) - set(local_files))
+
+            if delete_orphans and not (job and job.cancelled):
                 orphans = set(remote_files.keys()) - set(local_files.keys())
-                if orphans:
+                # Недокачанные временные файлы ещё нужны для докачки, если сам файл есть локально
+                suffix_len = len(self.temp_suffix)
+                orphans = {
+                    o for o in orphans
+                    if not (suffix_len and o.endswith(self.temp_suffix) and o[:-suffix_len] in local_files)
+                }
+                if max_deletions and len(orphans) > max_deletions:
+                    # Столько orphan-файлов — скорее опустевшая локальная папка, чем удалённые файлы:
+                    # ничего не удаляем, пока оператор не подтвердит max_deletions: 0
+                    logger.warning(
+                        f"Mirror: orphan-файлов {len(orphans)} — больше лимита mirror.max_deletions "
+                        f"({max_deletions}); удаление пропущено. Если удаление ожидаемо — "
+                        f"запустите mirror с max_deletions: 0"
+                    )
+                    failed.append(
+                        f"delete_limit: orphan-файлов {len(orphans)} больше mirror.max_deletions "
+                        f"({max_deletions}), удаление пропущено"
+                    )
+                    orphans = set()
+                if orphans and phase("deleting"):
                     logger.info(f"Mirror: удаление {len(orphans)} orphan-файлов с сервера")
-                    ftp2 = self._connect()
-                    try:
-                        for orphan in sorted(orphans, reverse=True):
-                            if self._delete_remote_file(ftp2, orphan):
-                                deleted.append(orphan)
-                            else:
-                                failed.append(f"delete:{orphan}")
-                        orphan_dirs = set()
-                        for orphan in orphans:
-                            parent = str(Path(orphan).parent)
-                            if parent and parent != ".":
-                                orphan_dirs.add(parent)
-                        for d in sorted(orphan_dirs, key=len, reverse=True):
-                            self._remove_empty_dirs(ftp2, d)
-                    finally:
-                        ftp2.quit()
+                    if job:
+                        job.add_total(len(orphans), 0)
+                    started = time.monotonic()
+                    done, not_done = self._delete_orphans(orphans, remote_entries, local_files, job, listed)
+                    deleted.extend(done)
+                    failed.extend(f"delete:{rel}" for rel in not_done)
+                    logger.info(f"Mirror: удаление заняло {time.monotonic() - started:.1f}с")
 
         except Exception as e:
             logger.error(f"Mirror: ошибка — {e}")
@@ -489,315 +2897,2088 @@ class RemoteFTPClient:
         return uploaded, deleted, skipped, failed
 
 
-# ─── Глобальное состояние ────────────────────────────────────────────────────
+# ─── asyncio-движок удалённого FTP ──────────────────────────────────────────
 
-sync_state = {
-    "synced_files": 0,
-    "failed_files": 0,
-    "last_sync": None,
-    "is_running": False,
-}
+class AsyncFTP:
+    """FTP-сессия на потоках asyncio — подмножество ftplib.FTP, которое нужно клиенту.
 
-mirror_state = {
-    "last_mirror": None,
-    "next_mirror": None,
-    "uploaded": 0,
-    "deleted": 0,
-    "skipped": 0,
-    "failed": 0,
-    "is_running": False,
-}
+    Ответы разбираются как в ftplib, и ошибки те же (error_perm, error_temp,
+    error_reply), поэтому обработка ошибок у обоих движков общая. Канал данных —
+    пассивный (PASV, для IPv6 — EPSV); TLS канала данных включается после
+    ответа 1xx, как в ftplib.FTP_TLS.
+    """
+
+    def __init__(self, timeout: float = 30, encoding: str = "utf-8"):
+        self.timeout = timeout
+        self.encoding = encoding
+        self.host = ""
+        self.welcome = ""
+        self.context: ssl.SSLContext | None = None
+        self.prot_private = False
+        self._reader: asyncio.StreamReader | None = None
+        self._writer: asyncio.StreamWriter | None = None
+
+    async def connect(self, host: str, port: int) -> str:
+        self.host = host
+        self._reader, self._writer = await asyncio.wait_for(asyncio.open_connection(host, port), self.timeout)
+        self.welcome = await self.getresp()
+        return self.welcome
+
+    async def _readline(self) -> str:
+        line = await asyncio.wait_for(self._reader.readline(), self.timeout)
+        if not line:
+            raise EOFError("Сервер закрыл соединение")
+        return line.decode(self.encoding).rstrip("\r\n")
+
+    async def getresp(self) -> str:
+        line = await self._readline()
+        if line[3:4] == "-":
+            code = line[:3]
+            lines = [line]
+            while True:
+                line = await self._readline()
+                lines.append(line)
+                if line[:3] == code and line[3:4] != "-":
+                    break
+            line = "\n".join(lines)
+        kind = line[:1]
+        if kind in ("1", "2", "3"):
+            return line
+        if kind == "4":
+            raise ftplib.error_temp(line)
+        if kind == "5":
+            raise ftplib.error_perm(line)
+        raise ftplib.error_proto(line)
+
+    async def voidresp(self) -> str:
+        resp = await self.getresp()
+        if resp[:1] != "2":
+            raise ftplib.error_reply(resp)
+        return resp
+
+    async def sendcmd(self, cmd: str) -> str:
+        self._writer.write(f"{cmd}\r\n".encode(self.encoding))
+        await self._writer.drain()
+        return await self.getresp()
+
+    async def voidcmd(self, cmd: str) -> str:
+        resp = await self.sendcmd(cmd)
+        if resp[:1] != "2":
+            raise ftplib.error_reply(resp)
+        return resp
+
+    async def auth_tls(self, context: ssl.SSLContext):
+        await self.voidcmd("AUTH TLS")
+        self.context = context
+        await self._writer.start_tls(context, server_hostname=self.host)
+
+    async def login(self, user: str, password: str) -> str:
+        resp = await self.sendcmd(f"USER {user}")
+        if resp[:1] == "3":
+            resp = await self.sendcmd(f"PASS {password}")
+        if resp[:1] != "2":
+            raise ftplib.error_reply(resp)
+        return resp
+
+    async def prot_p(self):
+        await self.voidcmd("PBSZ 0")
+        await self.voidcmd("PROT P")
+        self.prot_private = True
+
+    async def transfer(self, cmd: str, rest: int | None = None) -> tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+        """Открывает пассивный канал данных и отправляет команду передачи."""
+        peer = self._writer.get_extra_info("peername")
+        if self._writer.get_extra_info("socket").family == socket.AF_INET:
+            # Адрес из ответа PASV не используем — только порт (как ftplib по умолчанию)
+            _, port = ftplib.parse227(await self.sendcmd("PASV"))
+            host = peer[0]
+        else:
+            host, port = ftplib.parse229(await self.sendcmd("EPSV"), peer)
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port), self.timeout)
+        try:
+            if rest is not None:
+                resp = await self.sendcmd(f"REST {rest}")
+                if resp[:1] != "3":
+                    raise ftplib.error_reply(resp)
+            resp = await self.sendcmd(cmd)
+            if resp[:1] == "2":
+                resp = await self.getresp()
+            if resp[:1] != "1":
+                raise ftplib.error_reply(resp)
+            if self.prot_private:
+                await writer.start_tls(self.context, server_hostname=self.host)
+        except BaseException:
+            writer.close()
+            raise
+        # Запись ждёт полного опустошения буфера: вызывающий переиспользует свой буфер
+        writer.transport.set_write_buffer_limits(0)
+        return reader, writer
+
+    @staticmethod
+    async def close_data(writer: asyncio.StreamWriter):
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except (OSError, ssl.SSLError):
+            pass
+
+    async def read_all(self, reader: asyncio.StreamReader) -> bytes:
+        """Всё содержимое канала данных; таймаут — на каждый блок, а не на всю передачу."""
+        data = bytearray()
+        while chunk := await asyncio.wait_for(reader.read(65536), self.timeout):
+            data += chunk
+        return bytes(data)
+
+    async def retrlines(self, cmd: str) -> list[str]:
+        await self.voidcmd("TYPE A")
+        reader, writer = await self.transfer(cmd)
+        try:
+            data = await self.read_all(reader)
+        finally:
+            await self.close_data(writer)
+        await self.voidresp()
+        return data.decode(self.encoding).splitlines()
+
+    async def retrbinary(self, cmd: str, rest: int | None = None) -> bytes:
+        await self.voidcmd("TYPE I")
+        reader, writer = await self.transfer(cmd, rest)
+        try:
+            data = await self.read_all(reader)
+        finally:
+            await self.close_data(writer)
+        await self.voidresp()
+        return data
+
+    async def size(self, path: str) -> int | None:
+        resp = await self.sendcmd(f"SIZE {path}")
+        if resp[:3] == "213":
+            return int(resp[3:].strip())
+        return None
+
+    async def mkd(self, path: str):
+        await self.voidcmd(f"MKD {path}")
+
+    async def rmd(self, path: str):
+        await self.voidcmd(f"RMD {path}")
+
+    async def cwd(self, path: str):
+        await self.voidcmd(f"CWD {path}")
+
+    async def delete(self, path: str):
+        resp = await self.sendcmd(f"DELE {path}")
+        if resp[:3] not in ("200", "250"):
+            raise ftplib.error_reply(resp)
+
+    async def rename(self, source: str, target: str):
+        resp = await self.sendcmd(f"RNFR {source}")
+        if resp[:1] != "3":
+            raise ftplib.error_reply(resp)
+        await self.voidcmd(f"RNTO {target}")
+
+    async def quit(self):
+        try:
+            await self.voidcmd("QUIT")
+        finally:
+            self.close()
+
+    def close(self):
+        if self._writer:
+            self._writer.close()
+            self._writer = None
+
+
+class AsyncRemoteFTPClient(RemoteFTPClient):
+    """RemoteFTPClient, у которого передачи — задачи одного цикла asyncio, а не потоки.
+
+    Цикл событий работает в собственном потоке; синхронные методы (put_file,
+    sync_all, mirror_sync, ...) ставят в него корутины и ждут результат, поэтому
+    остальной код не знает, какой движок выбран. `workers` здесь — число
+    одновременных передач в цикле, и оно может быть сотнями без сотен потоков.
+    Учёт (манифест, очередь, метрики, кэш директорий) — общий с RemoteFTPClient.
+    Редкие операции (сверка хешей, листинг через NLST) идут через сессии ftplib.
+    """
+
+    # Сессий ftplib для редких операций — сверх pool_size сессий asyncio
+    FTPLIB_POOL_SIZE = 2
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.ftplib_pool_size = min(self.pool_size, self.FTPLIB_POOL_SIZE)
+        self._aidle: list[tuple[AsyncFTP, float]] = []
+        self._ain_use = 0
+        self._awaiting_realtime = 0
+        self._acond = asyncio.Condition()
+        self._loop = asyncio.new_event_loop()
+        threading.Thread(target=self._run_loop, daemon=True, name=f"ftp-asyncio-{self.name or self.host}").start()
+        self._keepalive_task = None
+        if self.keepalive > 0:
+            self._keepalive_task = asyncio.run_coroutine_threadsafe(self._akeepalive(), self._loop)
+
+    def _run_loop(self):
+        self._loop.run_forever()
+        self._loop.close()
+
+    def _call(self, coro):
+        """Выполняет корутину в цикле клиента и ждёт результат из вызывающего потока."""
+        if not self._loop.is_running():
+            coro.close()
+            raise RuntimeError("Пул соединений закрыт")
+        return asyncio.run_coroutine_threadsafe(coro, self._loop).result()
+
+    async def _offload(self, func, *args):
+        """Блокирующий вызов (диск, SQLite) — в пуле потоков цикла, чтобы не стояли остальные передачи."""
+        return await self._loop.run_in_executor(None, func, *args)
+
+    # ─── Пул соединений ──────────────────────────────────────────────────────
+
+    async def _aconnect(self) -> AsyncFTP:
+        ftp = AsyncFTP(timeout=30)
+        try:
+            with trace_phase("connect"):
+                await ftp.connect(self.host, self.port)
+            if self.tls:
+                with trace_phase("tls"):
+                    await ftp.auth_tls(remote_tls_context())
+            with trace_phase("login"):
+                await ftp.login(self.user, self.password)
+            if self.tls:
+                with trace_phase("tls"):
+                    await ftp.prot_p()
+            # Сессия всегда стоит в root: все пути в командах считаются от него
+            with trace_phase("cwd"):
+                await ftp.cwd(self.root or "/")
+        except BaseException:
+            ftp.close()
+            raise
+        return ftp
+
+    @staticmethod
+    async def _aquit(ftp: AsyncFTP):
+        try:
+            await ftp.quit()
+        except Exception:
+            ftp.close()
+
+    async def _aacquire(self, priority: int) -> AsyncFTP:
+        async with self._acond:
+            realtime = priority == PRIORITY_REALTIME
+            if realtime:
+                self._awaiting_realtime += 1
+            try:
+                with trace_phase("pool_wait"):
+                    while not self._slot_free(
+                        priority, self._ain_use, self._awaiting_realtime, self.pool_size,
+                    ) and not self._closed:
+                        await self._acond.wait()
+            finally:
+                if realtime:
+                    self._awaiting_realtime -= 1
+            if self._closed:
+                self._acond.notify_all()
+                raise RuntimeError("Пул соединений закрыт")
+            self._ain_use += 1
+
+        try:
+            while self._aidle:
+                ftp, last_used = self._aidle.pop()
+                if time.monotonic() - last_used < self.POOL_CHECK_AFTER:
+                    return ftp
+                try:
+                    with trace_phase("pool_check"):
+                        await ftp.voidcmd("NOOP")
+                    return ftp
+                except Exception:
+                    logger.info(f"Пул: соединение с {self.host} разорвано, переподключение")
+                    ftp.close()
+            return await self._aconnect()
+        except BaseException:
+            async with self._acond:
+                self._ain_use -= 1
+                self._acond.notify_all()
+            raise
+
+    async def _arelease(self, ftp: AsyncFTP, reusable: bool):
+        async with self._acond:
+            self._ain_use -= 1
+            keep = reusable and not self._closed
+            if keep:
+                self._aidle.append((ftp, time.monotonic()))
+            self._acond.notify_all()
+        if not keep:
+            await self._aquit(ftp)
+
+    @asynccontextmanager
+    async def _asession(self, priority: int = PRIORITY_BULK):
+        """Сессия из пула. После сетевой ошибки соединение не возвращается в пул."""
+        ftp = await self._aacquire(priority)
+        reusable = True
+        try:
+            yield ftp
+        except ftplib.error_perm:
+            raise
+        except BaseException:
+            reusable = False
+            raise
+        finally:
+            await self._arelease(ftp, reusable)
+
+    async def _akeepalive(self):
+        while not self._closed:
+            await asyncio.sleep(self.keepalive)
+            now = time.monotonic()
+            stale = [item for item in self._aidle if now - item[1] >= self.keepalive]
+            self._aidle = [item for item in self._aidle if now - item[1] < self.keepalive]
+            for ftp, _ in stale:
+                try:
+                    await ftp.voidcmd("NOOP")
+                except Exception:
+                    ftp.close()
+                    continue
+                if self._closed:
+                    await self._aquit(ftp)
+                else:
+                    self._aidle.append((ftp, time.monotonic()))
+
+    def connections(self) -> tuple[int, int]:
+        active, idle = super().connections()
+        return active + self._ain_use, idle + len(self._aidle)
+
+    async def _aclose(self):
+        async with self._acond:
+            idle, self._aidle = self._aidle, []
+            self._acond.notify_all()
+        for ftp, _ in idle:
+            await self._aquit(ftp)
+        if self._keepalive_task:
+            self._keepalive_task.cancel()
+        self._loop.create_task(self._astop_when_done())
+
+    async def _astop_when_done(self):
+        """Останавливает цикл, когда начатые до close() передачи закончатся."""
+        current = asyncio.current_task()
+        while any(task is not current and not task.done() for task in asyncio.all_tasks()):
+            await asyncio.sleep(0.5)
+        self._loop.stop()
+
+    def close(self):
+        super().close()
+        if self._loop.is_running():
+            asyncio.run_coroutine_threadsafe(self._aclose(), self._loop).result()
+
+    # ─── Загрузка ────────────────────────────────────────────────────────────
+
+    async def _aensure_remote_dir(self, ftp: AsyncFTP, remote_dir: str, recheck: bool = False):
+        """Как _ensure_remote_dir: MKD по уровням, известные директории — из кэша."""
+        if not remote_dir or (remote_dir in self._known_dirs and not recheck):
+            return
+        current = ""
+        for part in remote_dir.split("/"):
+            current = f"{current}/{part}" if current else part
+            if current in self._known_dirs and not recheck:
+                continue
+            try:
+                with trace_phase("mkdir"):
+                    await ftp.mkd(current)
+                logger.info(f"Создана удалённая директория: {current}")
+            except ftplib.error_perm:
+                pass
+            with self._dirs_lock:
+                self._known_dirs.add(current)
+
+    async def _astore(self, ftp: AsyncFTP, cmd: str, f, priority: int, rest: int | None = None):
+        """Передача данных файла: чтение с диска — в пуле потоков цикла, отправка — в цикле."""
+        bucket = rate_limiters[priority]
+        block = self._block_size(self._remaining(f), bucket)
+        buf = bytearray(block)
+        view = memoryview(buf)
+
+        started = time.monotonic()
+        sent = 0
+        with trace_phase("data_open"):
+            await ftp.voidcmd("TYPE I")
+            _, writer = await ftp.transfer(cmd, rest)
+        try:
+            with trace_phase("data"):
+                while True:
+                    n = await self._loop.run_in_executor(None, f.readinto, buf)
+                    if not n:
+                        break
+                    writer.write(view[:n])
+                    await asyncio.wait_for(writer.drain(), ftp.timeout)
+                    sent += n
+                    delay = bucket.reserve(n)
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+            trace_sent(sent)
+        finally:
+            with trace_phase("data_close"):
+                await ftp.close_data(writer)
+        with trace_phase("data_close"):
+            await ftp.voidresp()
+        self._log_throughput(cmd, sent, time.monotonic() - started, "asyncio", block)
+
+    async def _astore_via_cwd(self, ftp: AsyncFTP, remote_dir: str, name: str, f, priority: int):
+        with trace_phase("cwd"):
+            await ftp.cwd(remote_dir)
+        try:
+            await self._astore(ftp, f"STOR {name}", f, priority)
+        finally:
+            with trace_phase("cwd"):
+                await ftp.cwd(self.root or "/")
+
+    @staticmethod
+    def _read_at(f, offset: int, length: int) -> bytes:
+        f.seek(offset)
+        return f.read(length)
+
+    async def _atail_matches(self, ftp: AsyncFTP, f, remote_path: str, remote_size: int) -> bool:
+        length = min(self.verify_tail, remote_size)
+        expected = await self._offload(self._read_at, f, remote_size - length, length)
+        received = await ftp.retrbinary(f"RETR {remote_path}", rest=remote_size - length)
+        return received[:length] == expected
+
+    async def _astore_resumable(self, ftp: AsyncFTP, remote_path: str, f, st: os.stat_result, priority: int):
+        """Как _store_resumable: временное имя, докачка REST/APPE, переименование в конце."""
+        temp_path = remote_path + self.temp_suffix
+        signature = (st.st_size, st.st_mtime_ns)
+        offset = 0
+
+        with trace_phase("resume_check"):
+            await ftp.voidcmd("TYPE I")
+            try:
+                partial = await ftp.size(temp_path) or 0
+            except ftplib.error_perm:
+                partial = 0
+            if 0 < partial <= st.st_size:
+                started_from = self._partials.get(remote_path)
+                if started_from is not None and started_from != signature:
+                    logger.info(f"Докачка {remote_path}: локальный файл изменился, загрузка заново")
+                elif self.verify_tail and not await self._atail_matches(ftp, f, temp_path, partial):
+                    logger.warning(f"Докачка {remote_path}: хвост на сервере не совпадает, загрузка заново")
+                else:
+                    offset = partial
+
+        self._partials[remote_path] = signature
+        if offset < st.st_size:
+            if offset:
+                logger.info(f"Докачка {remote_path} с {offset} из {st.st_size} байт")
+            f.seek(offset)
+            try:
+                await self._astore(ftp, f"STOR {temp_path}", f, priority, rest=offset or None)
+            except ftplib.error_perm as e:
+                if not offset or str(e)[:3] not in ("500", "501", "502", "504"):
+                    raise
+                f.seek(offset)
+                await self._astore(ftp, f"APPE {temp_path}", f, priority)
+
+        with trace_phase("rename"):
+            try:
+                await ftp.rename(temp_path, remote_path)
+            except ftplib.error_perm:
+                await ftp.delete(remote_path)
+                await ftp.rename(temp_path, remote_path)
+        self._partials.pop(remote_path, None)
+
+    async def _aput_file(self, local_path: Path, relative_path: str, priority: int = PRIORITY_BULK):
+        remote_path = Path(relative_path).as_posix()
+        remote_dir, _, name = remote_path.rpartition("/")
+        started = time.monotonic()
+        try:
+            with transfer_traces.upload(self.name, remote_path, priority):
+                async with self._asession(priority) as ftp:
+                    await self._aensure_remote_dir(ftp, remote_dir)
+                    with trace_phase("open_local"):
+                        f, st = await self._offload(self._open_local, local_path)
+                    with f:
+                        resumable = 0 < self.resume_min_bytes <= st.st_size
+                        try:
+                            if resumable:
+                                await self._astore_resumable(ftp, remote_path, f, st, priority)
+                            else:
+                                await self._astore(ftp, f"STOR {remote_path}", f, priority)
+                        except ftplib.error_perm:
+                            if not remote_dir:
+                                raise
+                            self._forget_remote_dir(remote_dir)
+                            await self._aensure_remote_dir(ftp, remote_dir, recheck=True)
+                            f.seek(0)
+                            if resumable:
+                                await self._astore_resumable(ftp, remote_path, f, st, priority)
+                            else:
+                                await self._astore_via_cwd(ftp, remote_dir, name, f, priority)
+        except Exception:
+            self._forget_remote_dir(remote_dir)
+            FAILED_TRANSFERS.inc(1, ("upload",))
+            raise
+        await self._offload(self._uploaded, remote_path, st, priority, started)
+
+    async def _aupload_file(self, local_path: Path, relative_path: str) -> bool:
+        try:
+            await self._aput_file(local_path, relative_path)
+            return True
+        except Exception as e:
+            logger.error(f"Ошибка загрузки {relative_path}: {e}")
+            return False
+
+    def put_file(self, local_path: Path, relative_path: str, priority: int = PRIORITY_BULK):
+        self._call(self._aput_file(local_path, relative_path, priority))
+
+    @contextmanager
+    def _upload_submitter(self):
+        # Вместо потоков — задачи в цикле клиента; concurrent.futures.Future подходит для wait()
+        yield lambda local_path, rel: asyncio.run_coroutine_threadsafe(
+            self._aupload_file(local_path, rel), self._loop,
+        )
+
+    def test_connection(self) -> bool:
+        async def noop():
+            async with self._asession(PRIORITY_REALTIME) as ftp:
+                await ftp.voidcmd("NOOP")
+
+        try:
+            self._call(noop())
+            return True
+        except Exception as e:
+            logger.error(f"Ошибка подключения к {self.host}:{self.port} — {e}")
+            return False
+
+    # ─── Листинг ─────────────────────────────────────────────────────────────
+
+    class _MLSDUnsupported(Exception):
+        pass
+
+    async def _alist_dir(self, dir_path: str) -> list[tuple[str, dict[str, str]]]:
+        for attempt in (1, 2):
+            try:
+                async with self._asession() as ftp:
+                    try:
+                        lines = await ftp.retrlines(f"MLSD {dir_path}" if dir_path else "MLSD")
+                    except ftplib.error_perm as e:
+                        if str(e)[:3] in ("500", "501", "502", "504"):
+                            raise self._MLSDUnsupported() from e
+                        logger.warning(f"Листинг: нет доступа к {dir_path or '/'}: {e}")
+                        return []
+                return [parsed for parsed in map(self._parse_mlsd_line, lines) if parsed]
+            except (ftplib.error_perm, self._MLSDUnsupported):
+                raise
+            except Exception:
+                if attempt == 2:
+                    raise
+
+    async def _alist_dirs(self, paths, descend) -> dict[str, dict[str, str]]:
+        entries: dict[str, dict[str, str]] = {}
+        limit = asyncio.Semaphore(self.workers)
+
+        async def walk(dir_path: str):
+            async with limit:
+                items = await self._alist_dir(dir_path)
+            subdirs = []
+            for name, facts in items:
+                rel = f"{dir_path}/{name}" if dir_path else name
+                entries[rel] = facts
+                if facts.get("type", "").lower() == "dir" and (descend is None or descend(rel)):
+                    subdirs.append(rel)
+            await asyncio.gather(*(walk(rel) for rel in subdirs))
+
+        await asyncio.gather(*(walk(path) for path in paths))
+        return entries
+
+    def _list_dirs(self, paths, descend=None) -> dict[str, dict[str, str]]:
+        try:
+            return self._call(self._alist_dirs(paths, descend))
+        except self._MLSDUnsupported:
+            logger.info("Листинг: сервер не поддерживает MLSD, используется NLST")
+            return super()._list_dirs(paths, descend)
+
+    def _dir_modify(self, dirs: list[str]) -> dict[str, str | None]:
+        limit = asyncio.Semaphore(self.workers)
+
+        async def check(rel: str) -> str | None:
+            async with limit, self._asession() as ftp:
+                try:
+                    return self._parse_mlst_modify(await ftp.sendcmd(f"MLST {rel}" if rel else "MLST"))
+                except ftplib.error_perm as e:
+                    if str(e)[:3] == "550":
+                        return None
+                    raise
+
+        async def check_all():
+            return dict(zip(dirs, await asyncio.gather(*(check(rel) for rel in dirs))))
+
+        return self._call(check_all())
+
+    # ─── Удаление ────────────────────────────────────────────────────────────
+
+    async def _adelete_remote_file(self, ftp: AsyncFTP, remote_path: str) -> bool:
+        try:
+            await ftp.delete(remote_path)
+        except ftplib.error_perm as e:
+            await self._offload(self._delete_refused, remote_path, e)
+            return False
+        await self._offload(self._deleted, remote_path)
+        return True
+
+    async def _aremove_remote_dir(self, ftp: AsyncFTP, dir_path: str) -> bool:
+        try:
+            await ftp.rmd(dir_path)
+        except ftplib.error_perm as e:
+            logger.warning(f"Не удалось удалить директорию {dir_path}: {e}")
+            return False
+        await self._offload(self._removed_dir, dir_path)
+        return True
+
+    def _session_workers(self, count: int, op: str, next_path, record):
+        action = {"delete": self._adelete_remote_file, "rmd": self._aremove_remote_dir}[op]
+
+        async def worker():
+            while True:
+                current = None
+                try:
+                    async with self._asession() as ftp:
+                        while True:
+                            current = next_path()
+                            if current is None:
+                                return
+                            # record может ставить запись в очередь (SQLite)
+                            await self._offload(record, current, await action(ftp, current))
+                except Exception as e:
+                    if current is None:
+                        logger.error(f"Нет соединения для удаления: {e}")
+                        return
+                    logger.error(f"Ошибка при удалении {current}: {e}")
+                    FAILED_TRANSFERS.inc(1, ("delete",))
+                    await self._offload(record, current, False, str(e))
+
+        async def run_all():
+            await asyncio.gather(*(worker() for _ in range(max(1, count))))
+
+        self._call(run_all())
+
+    def delete_file(self, remote_path: str):
+        async def delete():
+            async with self._asession() as ftp:
+                try:
+                    await ftp.delete(remote_path)
+                except ftplib.error_perm as e:
+                    if not str(e).startswith("550"):
+                        raise
+
+        try:
+            self._call(delete())
+        except Exception:
+            FAILED_TRANSFERS.inc(1, ("delete",))
+            raise
+        self._deleted(remote_path)
+
+
+# Движки удалённого FTP для remote_ftp.engine
+REMOTE_ENGINES = {"ftplib": RemoteFTPClient, "asyncio": AsyncRemoteFTPClient}
 
-remote_client: RemoteFTPClient | None = None
+
+# ─── Глобальное состояние ────────────────────────────────────────────────────
+
+class RemoteTarget:
+    """Удалённый сервер из remote_ftp: свой клиент (пул), свои счётчики sync и mirror.
+
+    Настройки — словарь из CONFIG["remote_targets"]; `connect()` пересоздаёт клиент
+    после их изменения. Записи манифеста и очереди разделены по `client.target_id`.
+    """
+
+    def __init__(self, settings: dict):
+        self.settings = settings
+        self.name = settings["name"]
+        self.client: RemoteFTPClient | None = None
+        self.sync_state = {
+            "synced_files": 0,
+            "failed_files": 0,
+            "last_sync": None,
+            "is_running": False,
+        }
+        self.mirror_state = {
+            "last_mirror": None,
+            "next_mirror": None,
+            "uploaded": 0,
+            "deleted": 0,
+            "skipped": 0,
+            "failed": 0,
+            "is_running": False,
+        }
+        # Время последней успешной передачи на этот сервер
+        self.last_transfer: float | None = None
+        set_mirror_phase(self.name, "idle")
+
+    def connect(self):
+        """Создаёт клиент из текущих настроек. Пул предыдущего клиента закрывается."""
+        settings = self.settings
+        old_client = self.client
+        self.client = REMOTE_ENGINES[settings["engine"]](
+            host=settings["host"],
+            port=settings["port"],
+            user=settings["user"],
+            password=settings["password"],
+            root=settings["root"],
+            tls=settings["tls"],
+            pool_size=settings["pool_size"],
+            keepalive=settings["keepalive"],
+            # concurrency — одновременные передачи на этот сервер (0 — как sync.workers)
+            workers=settings["concurrency"] or CONFIG["sync_workers"],
+            manifest=sync_manifest,
+            hash_index=hash_index,
+            remote_index=remote_index,
+            resume_min_bytes=CONFIG["transfer_resume_min_bytes"],
+            temp_suffix=CONFIG["transfer_temp_suffix"],
+            verify_tail=CONFIG["transfer_verify_tail"],
+            queue=transfer_queue,
+            block_size=CONFIG["transfer_block_kib"] * 1024,
+            use_sendfile=CONFIG["transfer_sendfile"],
+            name=self.name,
+            shared_reads=len(CONFIG["remote_targets"]) > 1,
+        )
+        if old_client:
+            old_client.close()
+            old_id, new_id = old_client.target_id, self.client.target_id
+            if transfer_queue and old_id != new_id:
+                moved, dead = transfer_queue.retarget(old_id, new_id)
+                if moved or dead:
+                    logger.info(
+                        f"Очередь [{self.name}]: сервер сменился ({old_id} -> {new_id}) — "
+                        f"перенесено загрузок: {moved}, удалений в dead: {dead}"
+                    )
+
+    def transferred(self):
+        self.last_transfer = time.time()
+
+    def lag(self) -> dict:
+        """Насколько сервер отстаёт от локальной папки: передачи в работе и в очереди."""
+        files = 0
+        oldest = None
+        if upload_dispatcher:
+            files, oldest = upload_dispatcher.backlog(self.name)
+        if transfer_queue and self.client:
+            counts = transfer_queue.counts(self.client.target_id)
+            files += counts["pending"] + counts["active"]
+            queued = transfer_queue.oldest(self.client.target_id)
+            if queued is not None and (oldest is None or queued < oldest):
+                oldest = queued
+        return {
+            "files": files,
+            "seconds": round(time.time() - oldest, 1) if oldest is not None else 0.0,
+            "last_transfer": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(self.last_transfer))
+            if self.last_transfer else None,
+        }
+
+
+def get_target(name: str | None) -> list[RemoteTarget]:
+    """Серверы по имени из API: None — все. Неизвестное имя — 404."""
+    if name is None:
+        return list(remote_targets)
+    for target in remote_targets:
+        if target.name == name:
+            return [target]
+    from fastapi import HTTPException
+    raise HTTPException(status_code=404, detail=f"Нет сервера {name!r} в remote_ftp")
+
+
+def total_state() -> tuple[dict, dict]:
+    """Счётчики sync и mirror, сложенные по всем серверам (для /status и трея)."""
+    sync = {"synced_files": 0, "failed_files": 0, "last_sync": None, "is_running": False}
+    mirror = {"last_mirror": None, "uploaded": 0, "deleted": 0, "skipped": 0, "failed": 0, "is_running": False}
+    for target in remote_targets:
+        for total, state in ((sync, target.sync_state), (mirror, target.mirror_state)):
+            for key, value in total.items():
+                if key == "is_running":
+                    total[key] = value or state[key]
+                elif key.startswith("last_"):
+                    if state[key] and (value is None or state[key] > value):
+                        total[key] = state[key]
+                else:
+                    total[key] = value + state[key]
+    return sync, mirror
+
+
+remote_targets: list[RemoteTarget] = []
+sync_manifest: SyncManifest | None = None
+hash_index: HashIndex | None = None
+state_store: KeyValueStore | None = None
+remote_index: RemoteIndex | None = None
+transfer_queue: TransferQueue | None = None
+local_scanner: LocalScanner | None = None
+upload_dispatcher: "UploadDispatcher | None" = None
 ftp_root: Path | None = None
 
 
-def init_remote_client():
-    global remote_client
-    remote_client = RemoteFTPClient(
-        host=CONFIG["remote_ftp_host"],
-        port=CONFIG["remote_ftp_port"],
-        user=CONFIG["remote_ftp_user"],
-        password=CONFIG["remote_ftp_pass"],
-        root=CONFIG["remote_ftp_root"],
-        tls=CONFIG["remote_ftp_tls"],
-    )
+def init_remote_targets():
+    """Создаёт серверы из CONFIG["remote_targets"] и их клиенты."""
+    global remote_targets
+    remote_targets = [RemoteTarget(settings) for settings in CONFIG["remote_targets"]]
+    for target in remote_targets:
+        target.connect()
 
 
 # ─── Watchdog: мгновенная синхронизация при получении файла ──────────────────
 
-class FTPUploadHandler(FileSystemEventHandler):
-    def __init__(self, local_root: Path, client: RemoteFTPClient):
+class UploadDispatcher:
+    """Очередь мгновенной синхронизации.
+
+    Повторные события по одному пути склеиваются. Файл уходит в потоки загрузки,
+    только когда его размер и mtime не менялись `quiet` секунд, и ровно один раз:
+    пока файл загружается, новые события по нему копятся и обрабатываются после.
+
+    Файлы, принятые локальным FTP-сервером, приходят через `submit(..., ready=True)`
+    сразу после окончания STOR и загружаются без ожидания. Пока идёт приём
+    (`hold()`), события watchdog по этому пути игнорируются.
+
+    Перед загрузкой файл записывается в TransferQueue: неудачную загрузку
+    повторяет transfer_retry_loop, а после падения процесса она не теряется.
+
+    Готовый файл уходит на все серверы сразу: у каждого сервера свои потоки
+    загрузки, поэтому медленный сервер не задерживает остальные. С диска файл
+    читается один раз (SharedFileReader), пока серверы успевают друг за другом.
+    """
+
+    # Сколько путей помнить в _skip_sigs
+    SKIP_MEMORY = 10000
+
+    def __init__(self, local_root: Path, quiet: float, workers: int, targets: list[RemoteTarget]):
         self.local_root = local_root
-        self.client = client
+        self.quiet = quiet
+        self.targets = targets
+        self._cond = threading.Condition()
+        # путь -> (момент проверки по monotonic, (размер, mtime_ns) при прошлой проверке, файл готов)
+        self._pending: dict[str, tuple[float, tuple[int, int] | None, bool]] = {}
+        # путь -> {имя сервера: время постановки}, пока загрузка на сервер не закончилась
+        self._in_flight: dict[str, dict[str, float]] = {}
+        # путь -> все ли серверы пока загрузили файл успешно
+        self._in_flight_ok: dict[str, bool] = {}
+        self._held: set[str] = set()
+        # Версии файлов, которые уже загружены или заведомо недописаны: повторные
+        # события watchdog с тем же (размер, mtime_ns) не вызывают загрузку
+        self._skip_sigs: dict[str, tuple[int, int]] = {}
+        self._stopped = False
+        self._executors = {
+            target.name: ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix=f"instant-{target.name}")
+            for target in targets
+        }
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        self._thread.join()
+        for executor in self._executors.values():
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def submit(self, filepath: str, ready: bool = False):
+        """Ставит путь в очередь. Вызывается из потоков watchdog и FTP-сервера — только запись в словарь."""
+        if local_scanner:
+            local_scanner.mark_dirty(filepath)
+        with self._cond:
+            if ready:
+                self._held.discard(filepath)
+                self._pending[filepath] = (time.monotonic(), None, True)
+            elif filepath in self._held:
+                return
+            else:
+                prev = self._pending.get(filepath)
+                if prev and prev[2]:
+                    return
+                self._pending[filepath] = (time.monotonic() + self.quiet, prev[1] if prev else None, False)
+            self._cond.notify()
+
+    def hold(self, filepath: str):
+        """Файл принимается по FTP: до `submit(ready=True)` или `discard()` события по нему не нужны."""
+        with self._cond:
+            self._held.add(filepath)
+            self._pending.pop(filepath, None)
+
+    def release(self, filepath: str):
+        """Приём так и не начался: снимаем hold, файл обрабатывается как обычное событие."""
+        with self._cond:
+            self._held.discard(filepath)
+        self.submit(filepath)
+
+    def discard(self, filepath: str):
+        """Приём файла прерван: недописанную версию не загружаем."""
+        if local_scanner:
+            local_scanner.mark_dirty(filepath)
+        try:
+            st = os.stat(filepath)
+        except OSError:
+            st = None
+        with self._cond:
+            self._held.discard(filepath)
+            self._pending.pop(filepath, None)
+            if st:
+                self._remember_skip(filepath, (st.st_size, st.st_mtime_ns))
+
+    def depth(self) -> int:
+        """Сколько путей ждут проверки или загружаются."""
+        with self._cond:
+            return len(self._pending) + len(self._in_flight)
+
+    def backlog(self, target: str) -> tuple[int, float | None]:
+        """Сколько файлов ещё загружается на сервер и с какого времени ждёт самый старый."""
+        with self._cond:
+            queued = [waiting[target] for waiting in self._in_flight.values() if target in waiting]
+        return len(queued), min(queued, default=None)
+
+    def _remember_skip(self, filepath: str, sig: tuple[int, int]):
+        self._skip_sigs.pop(filepath, None)
+        self._skip_sigs[filepath] = sig
+        while len(self._skip_sigs) > self.SKIP_MEMORY:
+            del self._skip_sigs[next(iter(self._skip_sigs))]
+
+    def _next_due(self) -> tuple[list[tuple[str, tuple[int, int] | None, bool]], float | None]:
+        """Под блокировкой: забирает созревшие пути и возвращает время до следующего."""
+        now = time.monotonic()
+        due = []
+        timeout = None
+        for filepath, (deadline, last_sig, ready) in list(self._pending.items()):
+            if filepath in self._in_flight:
+                continue
+            if deadline <= now:
+                due.append((filepath, last_sig, ready))
+                del self._pending[filepath]
+            elif timeout is None or deadline - now < timeout:
+                timeout = deadline - now
+        return due, timeout
+
+    def _run(self):
+        while True:
+            with self._cond:
+                due, timeout = self._next_due()
+                while not due and not self._stopped:
+                    self._cond.wait(timeout)
+                    due, timeout = self._next_due()
+                if self._stopped:
+                    return
+
+            for filepath, last_sig, ready in due:
+                try:
+                    st = os.stat(filepath)
+                except OSError:
+                    continue  # файл удалён или переименован — загружать нечего
+                if not os.path.isfile(filepath):
+                    continue
+                sig = (st.st_size, st.st_mtime_ns)
+                settled = ready or sig == last_sig or time.time() - st.st_mtime >= self.quiet
+
+                with self._cond:
+                    if filepath in self._pending:
+                        # Пока проверяли, пришло новое событие — ждём заново
+                        deadline, _, pending_ready = self._pending[filepath]
+                        self._pending[filepath] = (deadline, sig, pending_ready)
+                    elif not settled:
+                        self._pending[filepath] = (time.monotonic() + self.quiet, sig, False)
+                    elif not ready and self._skip_sigs.get(filepath) == sig:
+                        continue  # эта версия уже загружена (или недописана)
+                    else:
+                        now = time.time()
+                        self._in_flight[filepath] = {target.name: now for target in self.targets}
+                        self._in_flight_ok[filepath] = True
+                        for target in self.targets:
+                            self._executors[target.name].submit(self._upload, filepath, sig, target)
+
+    def _upload(self, filepath: str, sig: tuple[int, int], target: RemoteTarget):
+        ok = False
+        try:
+            path = Path(filepath)
+            try:
+                relative = path.relative_to(self.local_root).as_posix()
+            except ValueError:
+                return
+            client = target.client
+            job_id = (
+                transfer_queue.put(client.target_id, "upload", relative, active=True, realtime=True)
+                if transfer_queue else None
+            )
+            try:
+                client.put_file(path, relative, priority=PRIORITY_REALTIME)
+                ok = True
+                target.sync_state["synced_files"] += 1
+                target.transferred()
+            except Exception as e:
+                target.sync_state["failed_files"] += 1
+                if job_id is None:
+                    logger.error(f"[{target.name}] Ошибка загрузки {relative}: {e}")
+                else:
+                    transfer_queue.fail(job_id, str(e))
+                    logger.error(f"[{target.name}] Ошибка загрузки {relative}: {e} — повтор через очередь")
+        finally:
+            with self._cond:
+                waiting = self._in_flight[filepath]
+                waiting.pop(target.name, None)
+                if not ok:
+                    self._in_flight_ok[filepath] = False
+                if not waiting:
+                    del self._in_flight[filepath]
+                    # Версию запоминаем, только если она дошла до всех серверов
+                    if self._in_flight_ok.pop(filepath):
+                        self._remember_skip(filepath, sig)
+                    self._cond.notify()
+
+
+class FTPUploadHandler(FileSystemEventHandler):
+    """Только передаёт пути в UploadDispatcher, чтобы не задерживать поток watchdog."""
+
+    def __init__(self, dispatcher: UploadDispatcher):
+        self.dispatcher = dispatcher
 
     def on_created(self, event):
         if event.is_directory:
             return
-        self._sync_file(event.src_path)
+        FS_EVENTS.inc(1, ("created",))
+        self.dispatcher.submit(event.src_path)
 
     def on_modified(self, event):
         if event.is_directory:
             return
-        self._sync_file(event.src_path)
-
-    def _sync_file(self, filepath: str):
-        path = Path(filepath)
-        time.sleep(0.5)
-        if path.is_file():
-            relative = path.relative_to(self.local_root)
-            ok = self.client.upload_file(path, str(relative))
-            if ok:
-                sync_state["synced_files"] += 1
+        FS_EVENTS.inc(1, ("modified",))
+        self.dispatcher.submit(event.src_path)
+
+
+# ─── Повтор передач из очереди ──────────────────────────────────────────────
+
+# Как часто перечитывать очередь, даже если ближайшая попытка нескоро
+# (PUT /config/remote мог сменить сервер)
+RETRY_POLL_SECONDS = 30.0
+
+
+def run_queued_transfer(target: RemoteTarget, client: RemoteFTPClient, local_root: Path, job: dict):
+    """Одна попытка передачи из очереди: успех удаляет запись, ошибка откладывает её."""
+    rel = job["path"]
+    local_path = local_root / rel
+    try:
+        if job["op"] == "upload":
+            if not local_path.is_file():
+                logger.info(f"Очередь [{target.name}]: {rel} больше нет локально — загрузка отменена")
             else:
-                sync_state["failed_files"] += 1
+                # Мгновенная загрузка и при повторе не встаёт за фоновой работой
+                client.put_file(local_path, rel, priority=PRIORITY_REALTIME if job["realtime"] else PRIORITY_BULK)
+                target.sync_state["synced_files"] += 1
+                target.transferred()
+        elif local_path.exists():
+            logger.info(f"Очередь [{target.name}]: {rel} снова есть локально — удаление отменено")
+        else:
+            client.delete_file(rel)
+            target.transferred()
+        transfer_queue.complete(job["id"])
+    except Exception as e:
+        state = transfer_queue.fail(job["id"], str(e))
+        attempt = job["attempts"] + 1
+        if state == "dead":
+            logger.error(f"Очередь [{target.name}]: {job['op']} {rel} — попытка {attempt}, отказ: {e}. Перенесено в dead")
+        else:
+            logger.warning(f"Очередь [{target.name}]: {job['op']} {rel} — попытка {attempt} не удалась: {e}")
+
+
+def transfer_retry_loop(target: RemoteTarget, local_root: Path, workers: int):
+    """Повторяет передачи на сервер из TransferQueue по мере наступления их времени."""
+    workers = max(1, workers)
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix=f"retry-{target.name}") as executor:
+        while True:
+            client = target.client
+            jobs = transfer_queue.claim_due(client.target_id, workers * 4)
+            if jobs:
+                logger.info(f"Очередь [{target.name}]: повтор {len(jobs)} передач")
+                wait([executor.submit(run_queued_transfer, target, client, local_root, job) for job in jobs])
+                continue
+            next_at = transfer_queue.next_due(client.target_id)
+            delay = RETRY_POLL_SECONDS if next_at is None else next_at - time.time()
+            transfer_queue.wait(min(RETRY_POLL_SECONDS, max(0.1, delay)))
 
 
 # ─── Периодическая полная синхронизация ──────────────────────────────────────
 
-def periodic_sync_loop(local_root: Path, client: RemoteFTPClient, interval: int):
+def run_target_sync(target: RemoteTarget, local_root: Path, force: bool = False, job: "Job | None" = None):
+    """Один проход sync_all на сервер с учётом в его счётчиках."""
+    target.sync_state["is_running"] = True
+    try:
+        # Клиент берётся заново на каждом проходе: PUT /config/remote мог его заменить
+        synced, failed = target.client.sync_all(local_root, force=force, job=job)
+    finally:
+        target.sync_state["is_running"] = False
+    if synced:
+        target.transferred()
+    target.sync_state["synced_files"] += len(synced)
+    target.sync_state["failed_files"] += len(failed)
+    target.sync_state["last_sync"] = time.strftime("%Y-%m-%d %H:%M:%S")
+    return synced, failed
+
+
+def periodic_sync_loop(target: RemoteTarget, local_root: Path, interval: int):
+    # У каждого сервера свой цикл: медленный сервер не задерживает проходы остальных
     while True:
         time.sleep(interval)
-        logger.info("Запуск периодической синхронизации...")
-        sync_state["is_running"] = True
-        synced, failed = client.sync_all(local_root)
-        sync_state["synced_files"] += len(synced)
-        sync_state["failed_files"] += len(failed)
-        sync_state["last_sync"] = time.strftime("%Y-%m-%d %H:%M:%S")
-        sync_state["is_running"] = False
-        logger.info(f"Синхронизация завершена: {len(synced)} ок, {len(failed)} ошибок")
+        logger.info(f"[{target.name}] Запуск периодической синхронизации...")
+        started = time.monotonic()
+        synced, failed = run_target_sync(target, local_root)
+        SYNC_SECONDS.set(time.monotonic() - started, (target.name,))
+        SYNC_RUNS.inc(1, (target.name,))
+        logger.info(f"[{target.name}] Синхронизация завершена: {len(synced)} ок, {len(failed)} ошибок")
 
 
 # ─── Mirror-синхронизация раз в N дней ──────────────────────────────────────
 
-def run_mirror_sync(local_root: Path, client: RemoteFTPClient):
+def run_mirror_sync(
+    local_root: Path, target: RemoteTarget,
+    delete_orphans: bool | None = None, compare: str | None = None, job: "Job | None" = None,
+    max_deletions: int | None = None, full_listing: bool = False, shards: range | None = None,
+):
+    """Одна итерация mirror на сервер. Параметры, не заданные явно, берутся из CONFIG.
+
+    full_listing=True — полный листинг сервера вне расписания mirror.full_listing_days.
+    shards — только эти шарды из mirror.shards (шаг rolling mirror).
+    """
+    mirror_state = target.mirror_state
     mirror_state["is_running"] = True
-    logger.info("=== Запуск MIRROR-синхронизации ===")
+    scope = f" (шарды {shards.start}-{shards.stop - 1} из {CONFIG['mirror_shards']})" if shards else ""
+    logger.info(f"=== [{target.name}] Запуск MIRROR-синхронизации{scope} ===")
 
-    uploaded, deleted, skipped, failed = client.mirror_sync(
-        local_root,
-        delete_orphans=CONFIG["mirror_delete_orphans"],
-    )
+    try:
+        uploaded, deleted, skipped, failed = target.client.mirror_sync(
+            local_root,
+            delete_orphans=CONFIG["mirror_delete_orphans"] if delete_orphans is None else delete_orphans,
+            compare=compare or CONFIG["mirror_compare"],
+            job=job,
+            max_deletions=CONFIG["mirror_max_deletions"] if max_deletions is None else max_deletions,
+            full_listing_days=0 if full_listing else CONFIG["mirror_full_listing_days"],
+            shards=set(shards) if shards else None,
+            shard_count=CONFIG["mirror_shards"],
+        )
+    finally:
+        mirror_state["is_running"] = False
 
     mirror_state["uploaded"] += len(uploaded)
     mirror_state["deleted"] += len(deleted)
     mirror_state["skipped"] += len(skipped)
     mirror_state["failed"] += len(failed)
     mirror_state["last_mirror"] = time.strftime("%Y-%m-%d %H:%M:%S")
-    mirror_state["is_running"] = False
+    if uploaded or deleted:
+        target.transferred()
 
     logger.info(
-        f"=== Mirror завершён: загружено={len(uploaded)}, "
+        f"=== [{target.name}] Mirror завершён: загружено={len(uploaded)}, "
         f"удалено={len(deleted)}, пропущено={len(skipped)}, "
         f"ошибок={len(failed)} ==="
     )
     return uploaded, deleted, skipped, failed
 
 
-def mirror_sync_loop(local_root: Path, client: RemoteFTPClient, interval_days: int):
+def mirror_sync_loop(target: RemoteTarget, local_root: Path, interval_days: int):
+    """Mirror целиком раз в interval_days. Время следующего прохода переживает перезапуск."""
     interval_seconds = interval_days * 24 * 3600
+    mirror_state = target.mirror_state
+    key = f"mirror_burst:{target.name}"
+    next_time = state_store.get(key, {}).get("next_mirror") or time.time() + interval_seconds
     while True:
-        next_time = time.time() + interval_seconds
+        state_store.set(key, {"next_mirror": next_time})
         mirror_state["next_mirror"] = time.strftime(
             "%Y-%m-%d %H:%M:%S", time.localtime(next_time)
         )
         logger.info(
-            f"Mirror: следующая синхронизация через {interval_days} дн. "
-            f"({mirror_state['next_mirror']})"
+            f"[{target.name}] Mirror: следующая синхронизация через "
+            f"{max(0.0, next_time - time.time()) / 86400:.1f} дн. ({mirror_state['next_mirror']})"
         )
-        time.sleep(interval_seconds)
-        run_mirror_sync(local_root, client)
+        time.sleep(max(0.0, next_time - time.time()))
+        next_time = time.time() + interval_seconds
+        if mirror_state["is_running"]:
+            logger.info(f"[{target.name}] Mirror уже идёт (запущен из API) — проход по расписанию пропущен")
+            continue
+        run_mirror_sync(local_root, target)
+
+
+def _window_spans(windows: list[tuple[int, int]]) -> list[tuple[int, int]]:
+    """Окна в минутах суток без перехода через полночь; пустой список — весь день."""
+    spans = []
+    for start, end in windows or [(0, 1440)]:
+        if start < end:
+            spans.append((start, end))
+        elif start == end:
+            spans.append((0, 1440))
+        else:
+            spans.extend([(start, 1440), (0, end)])
+    return spans
+
+
+def _midnight(ts: float, days: int = 0) -> float:
+    t = time.localtime(ts)
+    return time.mktime((t.tm_year, t.tm_mon, t.tm_mday + days, 0, 0, 0, 0, 0, -1))
+
+
+def window_seconds(start: float, end: float, windows: list[tuple[int, int]]) -> float:
+    """Сколько секунд из [start, end) приходится на окна mirror.windows (локальное время)."""
+    total = 0.0
+    day = _midnight(start)
+    while day < end:
+        for lo, hi in _window_spans(windows):
+            total += max(0.0, min(end, day + hi * 60) - max(start, day + lo * 60))
+        day = _midnight(day, 1)
+    return total
+
+
+def next_window_start(now: float, windows: list[tuple[int, int]]) -> float:
+    """now, если сейчас окно; иначе начало ближайшего окна."""
+    for days in (0, 1):
+        day = _midnight(now, days)
+        starts = []
+        for lo, hi in _window_spans(windows):
+            if day + lo * 60 <= now < day + hi * 60:
+                return now
+            if day + lo * 60 > now:
+                starts.append(day + lo * 60)
+        if starts:
+            return min(starts)
+    return now
+
+
+def rolling_mirror_loop(target: RemoteTarget, local_root: Path, interval_days: int):
+    """Mirror по частям: каждые mirror.tick_minutes — несколько шардов, только в окнах mirror.windows.
+
+    Дерево делится на mirror.shards шардов по хешу директории. Шаг берёт столько шардов,
+    чтобы оставшиеся равномерно распределились по оставшимся тикам окон до конца цикла
+    (interval_days от его начала) — нагрузка ровная, а полный круг укладывается в интервал.
+    Позиция в цикле хранится в ftp_sync.db, после перезапуска цикл продолжается с неё.
+    """
+    shard_count = CONFIG["mirror_shards"]
+    tick = max(60.0, CONFIG["mirror_tick_minutes"] * 60)
+    windows = CONFIG["mirror_windows"]
+    interval = interval_days * 86400
+    mirror_state = target.mirror_state
+    key = f"mirror_rolling:{target.name}"
+
+    def show_next(ts: float):
+        mirror_state["next_mirror"] = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(ts))
+
+    while True:
+        now = time.time()
+        start = next_window_start(now, windows)
+        if start > now:
+            show_next(start)
+            time.sleep(start - now)
+            continue
+
+        cycle = state_store.get(key) or {"started": now, "position": 0}
+        if cycle["position"] >= shard_count:
+            if now < cycle["started"] + interval:
+                # Круг пройден — следующий начнётся через interval_days от начала этого
+                show_next(cycle["started"] + interval)
+                time.sleep(min(tick, cycle["started"] + interval - now))
+                continue
+            cycle = {"started": now, "position": 0}
+            logger.info(f"[{target.name}] Rolling mirror: новый цикл, {shard_count} шардов за {interval_days} дн.")
+
+        remaining = shard_count - cycle["position"]
+        deadline = cycle["started"] + interval
+        if deadline <= now:
+            # Цикл опаздывает (программа не работала) — дальше в обычном темпе, без рывка
+            logger.warning(f"[{target.name}] Rolling mirror: цикл опаздывает, осталось {remaining} шардов")
+            deadline = now + interval * remaining / shard_count
+        ticks_left = max(1, int(window_seconds(now, deadline, windows) // tick))
+        count = -(-remaining // ticks_left)
+        shards = range(cycle["position"], cycle["position"] + count)
+
+        if mirror_state["is_running"]:
+            logger.info(f"[{target.name}] Mirror уже идёт (запущен из API) — шаг rolling mirror пропущен")
+        else:
+            _, _, _, failed = run_mirror_sync(local_root, target, shards=shards)
+            if any(error.startswith("connection:") for error in failed):
+                logger.warning(f"[{target.name}] Rolling mirror: сервер недоступен, шаг будет повторён")
+            else:
+                cycle["position"] += count
+                state_store.set(key, cycle)
+        mirror_state["cycle_position"] = f"{cycle['position']}/{shard_count}"
+
+        show_next(now + tick)
+        time.sleep(max(0.0, now + tick - time.time()))
+
+
+# ─── Фоновые задачи (sync / mirror из API и трея) ─────────────────────────────
+
+class Job:
+    """Синхронизация, запущенная в фоне: прогресс, ошибки и флаг отмены.
+
+    Счётчики обновляет поток задачи, читает API — поэтому под своей блокировкой.
+    Байты считаются по завершённым файлам.
+    """
+
+    MAX_ERRORS = 100
+
+    def __init__(self, kind: str, options: dict):
+        self.id = uuid.uuid4().hex[:12]
+        self.kind = kind
+        self.options = options
+        self.state = "queued"
+        self.phase = "queued"
+        self.files_done = 0
+        self.files_total = 0
+        self.bytes_done = 0
+        self.bytes_total = 0
+        self.errors: list[str] = []
+        self.error_count = 0
+        self.result: dict | None = None
+        self.created_at = time.time()
+        self.started_at: float | None = None
+        self.finished_at: float | None = None
+        self._lock = threading.Lock()
+        self._cancel = threading.Event()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancel.is_set()
+
+    def cancel(self):
+        self._cancel.set()
+
+    def set_phase(self, phase: str):
+        self.phase = phase
+
+    def add_total(self, files: int, size: int):
+        with self._lock:
+            self.files_total += files
+            self.bytes_total += size
+
+    def advance(self, size: int, error: str | None = None):
+        with self._lock:
+            self.files_done += 1
+            self.bytes_done += size
+            if error:
+                self._record_error(error)
+
+    def add_error(self, error: str):
+        """Ошибка не по конкретному файлу (листинг, обрыв связи)."""
+        with self._lock:
+            self._record_error(error)
+
+    def _record_error(self, error: str):
+        self.error_count += 1
+        if len(self.errors) < self.MAX_ERRORS:
+            self.errors.append(error)
+
+    def eta(self) -> float | None:
+        """Оценка оставшегося времени по средней скорости с начала задачи."""
+        if self.state != "running" or not self.started_at:
+            return None
+        elapsed = time.time() - self.started_at
+        with self._lock:
+            if self.bytes_total and self.bytes_done:
+                return elapsed * (self.bytes_total - self.bytes_done) / self.bytes_done
+            if self.files_total and self.files_done:
+                return elapsed * (self.files_total - self.files_done) / self.files_done
+        return None
+
+    def snapshot(self) -> dict:
+        eta = self.eta()
+        with self._lock:
+            return {
+                "id": self.id, "kind": self.kind, "options": self.options,
+                "state": self.state, "phase": self.phase,
+                "files_done": self.files_done, "files_total": self.files_total,
+                "bytes_done": self.bytes_done, "bytes_total": self.bytes_total,
+                "eta_seconds": round(eta, 1) if eta is not None else None,
+                "errors": list(self.errors), "error_count": self.error_count,
+                "result": self.result,
+                "created_at": self.created_at, "started_at": self.started_at, "finished_at": self.finished_at,
+            }
+
+
+class JobManager:
+    """Запускает задачи в отдельных потоках; одновременно — не больше одной задачи каждого вида."""
+
+    # Сколько завершённых задач помнить для GET /jobs
+    KEEP_FINISHED = 50
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._jobs: dict[str, Job] = {}
+
+    def start(self, kind: str, options: dict, target) -> Job | None:
+        """Запускает target(job) в фоне. None — задача этого вида уже выполняется."""
+        with self._lock:
+            if any(j.kind == kind and j.finished_at is None for j in self._jobs.values()):
+                return None
+            job = Job(kind, options)
+            self._jobs[job.id] = job
+            finished = [j for j in self._jobs.values() if j.finished_at is not None]
+            for old in sorted(finished, key=lambda j: j.finished_at)[:-self.KEEP_FINISHED or None]:
+                del self._jobs[old.id]
+        threading.Thread(target=self._run, args=(job, target), daemon=True, name=f"job-{job.id}").start()
+        return job
+
+    def _run(self, job: Job, target):
+        job.started_at = time.time()
+        job.state = "running"
+        logger.info(f"Задача {job.id}: {job.kind} {job.options}")
+        try:
+            job.result = target(job)
+            job.state = "cancelled" if job.cancelled else "done"
+        except Exception as e:
+            logger.error(f"Задача {job.id}: ошибка — {e}")
+            job.add_error(f"{job.kind}_error: {e}")
+            job.state = "failed"
+        finally:
+            job.phase = "finished"
+            job.finished_at = time.time()
+        logger.info(f"Задача {job.id}: {job.state} за {job.finished_at - job.started_at:.1f}с")
+
+    def get(self, job_id: str) -> Job | None:
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def list(self) -> list[Job]:
+        with self._lock:
+            return sorted(self._jobs.values(), key=lambda j: j.created_at, reverse=True)
+
+
+def run_on_targets(job: Job, action) -> dict:
+    """Выполняет action(target) на выбранных в задаче серверах параллельно; результат — по именам.
+
+    Прогресс задачи общий: файлы и байты всех серверов складываются.
+    """
+    targets = get_target(job.options.get("target"))
+    if len(targets) == 1:
+        return {targets[0].name: action(targets[0])}
+    with ThreadPoolExecutor(max_workers=len(targets), thread_name_prefix=f"job-{job.kind}") as executor:
+        futures = {target.name: executor.submit(action, target) for target in targets}
+        return {name: future.result() for name, future in futures.items()}
+
+
+def run_sync_job(job: Job) -> dict:
+    def sync_target(target: RemoteTarget) -> dict:
+        synced, failed = run_target_sync(target, ftp_root, force=job.options["force"], job=job)
+        return {"synced": len(synced), "failed": len(failed)}
+
+    return run_on_targets(job, sync_target)
+
+
+def run_mirror_job(job: Job) -> dict:
+    def mirror_target(target: RemoteTarget) -> dict:
+        uploaded, deleted, skipped, failed = run_mirror_sync(
+            ftp_root, target,
+            delete_orphans=job.options["delete_orphans"], compare=job.options["compare"], job=job,
+            max_deletions=job.options["max_deletions"], full_listing=job.options["full_listing"],
+        )
+        # Ошибки по файлам уже учтены в job.advance, а ошибки листинга и прочие — нет
+        for error in failed:
+            if error.startswith(("connection:", "mirror_error:", "delete_limit:")):
+                job.add_error(f"{target.name}: {error}")
+        return {"uploaded": len(uploaded), "deleted": len(deleted), "skipped": len(skipped), "failed": len(failed)}
+
+    return run_on_targets(job, mirror_target)
+
+
+job_manager = JobManager()
 
 
 # ─── Локальный FTP-сервер ────────────────────────────────────────────────────
 
-def start_local_ftp_server():
+def on_ftp_event(event: str, file: str):
+    """Событие приёма файла от SyncFTPHandler: hold, release, received или incomplete."""
+    if event == "received":
+        FS_EVENTS.inc(1, ("received",))
+    elif event == "incomplete":
+        FS_EVENTS.inc(1, ("incomplete",))
+        logger.warning(f"FTP: приём прерван, файл не синхронизируется: {file}")
+    if not upload_dispatcher:
+        return
+    if event == "hold":
+        upload_dispatcher.hold(file)
+    elif event == "release":
+        upload_dispatcher.release(file)
+    elif event == "received":
+        upload_dispatcher.submit(file, ready=True)
+    elif event == "incomplete":
+        upload_dispatcher.discard(file)
+
+
+def forward_ftp_events(events):
+    """Движок multiprocess: события из процессов соединений — в диспетчер главного процесса."""
+    while True:
+        event, file = events.get()
+        try:
+            on_ftp_event(event, file)
+        except Exception as e:
+            logger.error(f"FTP: ошибка обработки события {event} {file}: {e}")
+
+
+class SyncFTPHandler(FTPHandler):
+    """FTPHandler, который ставит файл в очередь синхронизации сразу по окончании STOR.
+
+    Прерванные передачи (ABOR, обрыв соединения) не синхронизируются.
+    """
+
+    _receiving: str | None = None
+    # Очередь событий в главный процесс — у движка multiprocess соединения живут в других процессах
+    events = None
+
+    def _notify(self, event: str, file: str):
+        if self.events is not None:
+            self.events.put((event, file))
+        else:
+            on_ftp_event(event, file)
+
+    def ftp_STOR(self, file, mode="w"):
+        # APPE тоже приходит сюда (mode="a")
+        self._notify("hold", file)
+        self._receiving = file
+        result = super().ftp_STOR(file, mode)
+        if result is None:
+            # Команда отклонена до начала передачи
+            self._notify("release", file)
+            self._receiving = None
+        return result
+
+    def on_file_received(self, file):
+        self._receiving = None
+        self._notify("received", file)
+
+    def on_incomplete_file_received(self, file):
+        self._receiving = None
+        self._notify("incomplete", file)
+
+    def on_disconnect(self):
+        # Передача так и не началась (клиент отключился до открытия канала данных)
+        if self._receiving:
+            self._notify("release", self._receiving)
+        self._receiving = None
+
+
+# Движки локального FTP-сервера для local_ftp.engine
+LOCAL_FTP_ENGINES = {
+    # Один поток, неблокирующий ввод-вывод: медленная запись на диск тормозит всех клиентов
+    "async": FTPServer,
+    # Поток на соединение
+    "threaded": ThreadedFTPServer,
+    # Процесс на соединение (только POSIX)
+    "multiprocess": MultiprocessFTPServer,
+}
+
+
+def build_local_ftp_server(root: Path, address: tuple[str, int] | None = None) -> FTPServer:
+    """Создаёт локальный FTP-сервер по настройкам local_ftp (ещё не запущенный)."""
+    engine = CONFIG["local_ftp_engine"]
+    server_class = LOCAL_FTP_ENGINES.get(engine)
+    if server_class is None:
+        logger.warning(f"FTP: движок {engine!r} недоступен на этой системе, используется threaded")
+        engine, server_class = "threaded", ThreadedFTPServer
+
     authorizer = DummyAuthorizer()
     authorizer.add_user(
         CONFIG["local_ftp_user"],
         CONFIG["local_ftp_pass"],
-        str(ftp_root),
+        str(root),
         perm=CONFIG["local_ftp_perm"],
     )
 
-    handler = FTPHandler
+    handler = SyncFTPHandler
     handler.authorizer = authorizer
-    handler.passive_ports = range(60000, 60100)
+    handler.passive_ports = CONFIG["local_ftp_passive_ports"]
     handler.banner = "FTP Sync Server ready."
-
-    server = FTPServer(
-        (CONFIG["local_ftp_host"], CONFIG["local_ftp_port"]),
+    # socket.sendfile есть не везде (на Windows — нет os.sendfile)
+    handler.use_sendfile = CONFIG["local_ftp_sendfile"] and hasattr(os, "sendfile")
+    handler.dtp_handler = type("SyncDTPHandler", (DTPHandler,), {
+        # Сколько байт читать из сокета за раз при приёме и отправлять при отдаче
+        "ac_in_buffer_size": CONFIG["local_ftp_read_buffer"],
+        "ac_out_buffer_size": CONFIG["local_ftp_write_buffer"],
+    })
+    handler.events = multiprocessing.Queue() if engine == "multiprocess" else None
+    if handler.events is not None:
+        threading.Thread(target=forward_ftp_events, args=(handler.events,), daemon=True).start()
+
+    server = server_class(
+        address or (CONFIG["local_ftp_host"], CONFIG["local_ftp_port"]),
         handler,
     )
-    server.max_cons = 50
-    server.max_cons_per_ip = 10
+    server.max_cons = CONFIG["local_ftp_max_cons"]
+    server.max_cons_per_ip = CONFIG["local_ftp_max_cons_per_ip"]
+    logger.info(
+        f"Локальный FTP-сервер ({engine}): не больше {server.max_cons} соединений, "
+        f"{server.max_cons_per_ip} с одного IP"
+    )
+    return server
+
 
-    logger.info(f"Локальный FTP-сервер: {CONFIG['local_ftp_host']}:{CONFIG['local_ftp_port']}")
+def start_local_ftp_server(attempts: int = 15):
+    """Поток ftp_thread: открывает порт и обслуживает клиентов.
+
+    После падения порт может ещё держать старый процесс — тогда повтор раз в 2 с.
+    """
+    port = CONFIG["local_ftp_port"]
+    for attempt in range(1, attempts + 1):
+        try:
+            server = build_local_ftp_server(ftp_root)
+            break
+        except OSError as e:
+            if attempt == attempts:
+                logger.error(f"[CHECK] Порт FTP {port}: не удалось открыть ({e}), FTP-сервер не запущен")
+                return
+            logger.warning(f"[CHECK] Порт FTP {port}: {e}, повтор через 2 с")
+            time.sleep(2)
+    mark_startup("ftp", f"Локальный FTP-сервер {CONFIG['local_ftp_host']}:{port} принимает подключения")
     server.serve_forever()
 
 
-# ─── FastAPI Lifespan ────────────────────────────────────────────────────────
+# ─── Листинг локальных файлов для API ───────────────────────────────────────
+
+def encode_files_cursor(sort: str, rel: str, size: int, mtime_ns: int) -> str:
+    key = [sort, rel] if sort == "path" else [sort, mtime_ns, rel]
+    return base64.urlsafe_b64encode(json.dumps(key).encode()).decode()
+
+
+def decode_files_cursor(cursor: str, sort: str) -> list:
+    from fastapi import HTTPException
 
-@asynccontextmanager
-async def lifespan(app: FastAPI):
-    global ftp_root
+    try:
+        key = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Некорректный cursor")
+    if not isinstance(key, list) or not key or key[0] != sort:
+        raise HTTPException(status_code=400, detail="cursor выдан для другой сортировки")
+    # Те же поля, что пишет encode_files_cursor: [путь] или [mtime_ns, путь]
+    types = (str,) if sort == "path" else (int, str)
+    values = key[1:]
+    if len(values) != len(types) or any(
+        type(value) is not expected for value, expected in zip(values, types)
+    ):
+        raise HTTPException(status_code=400, detail="Некорректный cursor")
+    return values
+
+
+def stream_local_files(root: Path, prefix: str, pattern: str | None, sort: str, limit: int, cursor: str | None):
+    """NDJSON: по строке на файл, последняя строка — {"count", "next_cursor"}.
+
+    Синхронный генератор: StreamingResponse гоняет его в пуле потоков,
+    так что обход диска не блокирует event loop.
+    """
+    after = decode_files_cursor(cursor, sort) if cursor else None
+    files = scan_local_tree(root, prefix, after[0] if after and sort == "path" else "")
+    if pattern:
+        files = (item for item in files if fnmatch.fnmatch(item[0], pattern))
+
+    if sort != "path":
+        # Сортировка по mtime требует обойти всё дерево, но в памяти — только страница
+        key = lambda item: (item[2], item[0])
+        if sort == "mtime":
+            if after:
+                files = (item for item in files if key(item) > tuple(after))
+            files = heapq.nsmallest(limit + 1, files, key=key)
+        else:
+            if after:
+                files = (item for item in files if key(item) < tuple(after))
+            files = heapq.nlargest(limit + 1, files, key=key)
+
+    count = 0
+    next_cursor = None
+    last = None
+    batch = []
+    for item in files:
+        if count == limit:
+            next_cursor = encode_files_cursor(sort, *last)
+            break
+        rel, size, mtime_ns = item
+        batch.append(json.dumps({
+            "path": rel,
+            "size": size,
+            "modified": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(mtime_ns / 1e9)),
+        }, ensure_ascii=False) + "\n")
+        count += 1
+        last = item
+        if len(batch) >= 500:
+            yield "".join(batch)
+            batch = []
+    batch.append(json.dumps({"count": count, "next_cursor": next_cursor}) + "\n")
+    yield "".join(batch)
+
+
+# ─── Запуск и остановка служб ───────────────────────────────────────────────
+
+observer = None
+
+
+def start_services():
+    """Поднимает всё, кроме API и трея. Первым делом — локальный FTP-сервер.
+
+    До него создаются только хранилища, клиенты серверов (без подключения) и диспетчер,
+    чтобы SyncFTPHandler не пропустил первые файлы. Остальное запускается, пока
+    сервер уже принимает подключения.
+    """
+    global ftp_root, sync_manifest, hash_index, remote_index, state_store, transfer_queue, local_scanner, upload_dispatcher, observer
 
     ftp_root = (APP_DIR / CONFIG["local_ftp_root"]).resolve()
-    ftp_root.mkdir(parents=True, exist_ok=True)
+    try:
+        ftp_root.mkdir(parents=True, exist_ok=True)
+    except OSError as e:
+        logger.error(f"[CHECK] Не удалось создать FTP root: {e}")
+        show_error(f"Критическая ошибка при запуске:\n\nНе удалось создать FTP root: {e}")
+        sys.exit(1)
     logger.info(f"FTP root: {ftp_root}")
 
-    init_remote_client()
+    sync_manifest = SyncManifest(STATE_DB_PATH)
+    hash_index = HashIndex(STATE_DB_PATH)
+    remote_index = RemoteIndex(STATE_DB_PATH)
+    state_store = KeyValueStore(STATE_DB_PATH)
+    transfer_queue = TransferQueue(
+        STATE_DB_PATH, CONFIG["queue_max_attempts"], CONFIG["queue_base_delay"], CONFIG["queue_max_delay"],
+    )
+    init_remote_targets()
+
+    # Диспетчер создаётся до FTP-сервера, чтобы SyncFTPHandler не пропустил первые файлы
+    if CONFIG["sync_on_upload"]:
+        upload_dispatcher = UploadDispatcher(
+            ftp_root, CONFIG["sync_quiet_seconds"], CONFIG["sync_workers"], remote_targets,
+        )
+        upload_dispatcher.start()
 
-    ftp_thread = threading.Thread(target=start_local_ftp_server, daemon=True)
+    ftp_thread = threading.Thread(target=start_local_ftp_server, daemon=True, name="ftp")
     ftp_thread.start()
 
-    observer = None
-    if CONFIG["sync_on_upload"]:
-        event_handler = FTPUploadHandler(ftp_root, remote_client)
+    logger.info(f"Манифест синхронизации: {STATE_DB_PATH}")
+    logger.info(f"Удалённые серверы: {', '.join(t.name for t in remote_targets)}")
+    if upload_dispatcher:
+        logger.info("Мгновенная синхронизация включена (по окончании приёма по FTP)")
+    recovered = transfer_queue.recover()
+    if recovered:
+        logger.info(f"Очередь: {recovered} прерванных передач будут повторены")
+    counts = transfer_queue.counts()
+    if counts["pending"] or counts["dead"]:
+        logger.info(f"Очередь: ожидают {counts['pending']}, в dead {counts['dead']}")
+
+    for target in remote_targets:
+        threading.Thread(
+            target=transfer_retry_loop, args=(target, ftp_root, CONFIG["sync_workers"]), daemon=True,
+        ).start()
+
+    # Снимку директорий можно доверять, только если изменения файлов приходят через диспетчер,
+    # причём и от watchdog: перезапись файла мимо встроенного FTP mtime директории не меняет
+    local_scanner = LocalScanner(
+        ftp_root,
+        use_snapshot=CONFIG["sync_on_upload"] and CONFIG["sync_watch_filesystem"],
+        rescan_seconds=CONFIG["sync_rescan_minutes"] * 60,
+    )
+
+    if upload_dispatcher and CONFIG["sync_watch_filesystem"]:
+        event_handler = FTPUploadHandler(upload_dispatcher)
         observer = Observer()
         observer.schedule(event_handler, str(ftp_root), recursive=True)
         observer.start()
-        logger.info("Watchdog: мгновенная синхронизация включена")
+        logger.info("Watchdog: слежение за файловой системой включено")
 
     if CONFIG["sync_interval"] > 0:
-        sync_thread = threading.Thread(
-            target=periodic_sync_loop,
-            args=(ftp_root, remote_client, CONFIG["sync_interval"]),
-            daemon=True,
-        )
-        sync_thread.start()
+        for target in remote_targets:
+            sync_thread = threading.Thread(
+                target=periodic_sync_loop,
+                args=(target, ftp_root, CONFIG["sync_interval"]),
+                daemon=True,
+            )
+            sync_thread.start()
         logger.info(f"Периодическая синхронизация каждые {CONFIG['sync_interval']}с")
 
-    if CONFIG["mirror_interval_days"] > 0:
-        mirror_thread = threading.Thread(
-            target=mirror_sync_loop,
-            args=(ftp_root, remote_client, CONFIG["mirror_interval_days"]),
-            daemon=True,
-        )
-        mirror_thread.start()
-        logger.info(f"Mirror-синхронизация каждые {CONFIG['mirror_interval_days']} дн.")
+    for target in remote_targets:
+        interval_days = target.settings["mirror_interval_days"]
+        if interval_days > 0:
+            rolling = CONFIG["mirror_mode"] == "rolling"
+            mirror_thread = threading.Thread(
+                target=rolling_mirror_loop if rolling else mirror_sync_loop,
+                args=(target, ftp_root, interval_days),
+                daemon=True,
+            )
+            mirror_thread.start()
+            if rolling:
+                logger.info(
+                    f"[{target.name}] Rolling mirror: {CONFIG['mirror_shards']} шардов за {interval_days} дн., "
+                    f"шаг раз в {CONFIG['mirror_tick_minutes']:g} мин."
+                )
+            else:
+                logger.info(f"[{target.name}] Mirror-синхронизация каждые {interval_days} дн.")
 
-    yield
 
+def stop_services():
+    """Останавливает слежение и диспетчер, закрывает пулы и базы."""
     if observer:
         observer.stop()
         observer.join()
+    if upload_dispatcher:
+        upload_dispatcher.stop()
+
+    for target in remote_targets:
+        if target.client:
+            target.client.close()
+    if sync_manifest:
+        sync_manifest.close()
+    if hash_index:
+        hash_index.close()
+    if remote_index:
+        remote_index.close()
+    if state_store:
+        state_store.close()
+    if transfer_queue:
+        transfer_queue.close()
 
 
 # ─── FastAPI приложение ──────────────────────────────────────────────────────
 
-app = FastAPI(
-    title="FTP Sync Server",
-    description="Локальный FTP-сервер с автоматической синхронизацией на удалённый FTP",
-    version="1.0.0",
-    lifespan=lifespan,
-)
-
+def create_app():
+    """FastAPI-приложение с эндпоинтами управления.
+
+    fastapi импортируется здесь, а не при загрузке модуля: импорт занимает сотни
+    миллисекунд, и локальный FTP-сервер не должен его ждать.
+    """
+    from fastapi import FastAPI, HTTPException, Query
+    from fastapi.responses import PlainTextResponse, StreamingResponse
+
+    @asynccontextmanager
+    async def lifespan(app: FastAPI):
+        mark_startup("api", "API загружено")
+        yield
+
+    app = FastAPI(
+        title="FTP Sync Server",
+        description="Локальный FTP-сервер с автоматической синхронизацией на удалённый FTP",
+        version="1.0.0",
+        lifespan=lifespan,
+    )
 
-@app.get("/", summary="Главная")
-async def root():
-    return {
-        "service": "FTP Sync Server",
-        "local_ftp": f"{CONFIG['local_ftp_host']}:{CONFIG['local_ftp_port']}",
-        "remote_ftp": f"{CONFIG['remote_ftp_host']}:{CONFIG['remote_ftp_port']}",
-        "endpoints": ["/status", "/sync", "/mirror", "/mirror/status", "/config", "/files", "/test-connection"],
-    }
+    @app.get("/", summary="Главная")
+    async def root():
+        return {
+            "service": "FTP Sync Server",
+            "local_ftp": f"{CONFIG['local_ftp_host']}:{CONFIG['local_ftp_port']}",
+            "remote_ftp": {t["name"]: f"{t['host']}:{t['port']}" for t in CONFIG["remote_targets"]},
+            "endpoints": ["/status", "/sync", "/mirror", "/mirror/status", "/config", "/files", "/test-connection", "/limits", "/queue", "/metrics", "/jobs", "/debug/transfers"],
+        }
+
+
+    @app.get("/status", summary="Статус всех синхронизаций")
+    async def get_status():
+        sync, mirror = total_state()
+        return {
+            "sync": sync,
+            "mirror": mirror,
+            "targets": {
+                t.name: {"sync": t.sync_state, "mirror": t.mirror_state, "lag": t.lag()} for t in remote_targets
+            },
+        }
+
+
+    @app.post("/sync", status_code=202, summary="Запустить синхронизацию в фоне")
+    async def force_sync(options: SyncOptions | None = None):
+        if not remote_targets or not ftp_root:
+            raise HTTPException(status_code=500, detail="Сервер не инициализирован")
+        options = options or SyncOptions()
+        get_target(options.target)
+        job = job_manager.start("sync", options.model_dump(), run_sync_job)
+        if job is None:
+            raise HTTPException(status_code=409, detail="Синхронизация уже запущена")
+        return {"job_id": job.id, "status_url": f"/jobs/{job.id}"}
+
+
+    @app.get("/files", summary="Список файлов в локальном FTP (NDJSON, постранично)")
+    async def list_files(
+        prefix: str = "",
+        glob: str | None = None,
+        sort: str = "path",
+        limit: int = Query(1000, ge=1, le=10000),
+        cursor: str | None = None,
+    ):
+        if not ftp_root:
+            raise HTTPException(status_code=500, detail="Сервер не инициализирован")
+        if sort not in ("path", "mtime", "-mtime"):
+            raise HTTPException(status_code=400, detail="sort: path, mtime или -mtime")
+        if cursor:
+            decode_files_cursor(cursor, sort)  # 400 до начала потока, а не посреди него
+        return StreamingResponse(
+            stream_local_files(ftp_root, prefix, glob, sort, limit, cursor),
+            media_type="application/x-ndjson",
+        )
 
 
-@app.get("/status", summary="Статус всех синхронизаций")
-async def get_status():
-    return {"sync": sync_state, "mirror": mirror_state}
-
-
-@app.post("/sync", response_model=SyncResult, summary="Принудительная синхронизация")
-async def force_sync():
-    if not remote_client or not ftp_root:
-        raise HTTPException(status_code=500, detail="Сервер не инициализирован")
-    sync_state["is_running"] = True
-    synced, failed = remote_client.sync_all(ftp_root)
-    sync_state["synced_files"] += len(synced)
-    sync_state["failed_files"] += len(failed)
-    sync_state["last_sync"] = time.strftime("%Y-%m-%d %H:%M:%S")
-    sync_state["is_running"] = False
-    return SyncResult(
-        success=len(failed) == 0, synced=synced, failed=failed,
-        message=f"Синхронизировано: {len(synced)}, ошибок: {len(failed)}",
-    )
+    @app.get("/queue", response_model=QueueStatus, summary="Очередь повторных передач")
+    async def get_queue(state: str | None = None, limit: int = 100):
+        if not transfer_queue:
+            raise HTTPException(status_code=500, detail="Сервер не инициализирован")
+        if state and state not in ("pending", "active", "dead"):
+            raise HTTPException(status_code=400, detail="state: pending, active или dead")
+        return QueueStatus(**transfer_queue.counts(), items=transfer_queue.items(state, limit))
+
+
+    @app.post("/queue/retry", summary="Повторить все передачи из dead")
+    async def retry_dead_transfers():
+        if not transfer_queue:
+            raise HTTPException(status_code=500, detail="Сервер не инициализирован")
+        return {"requeued": transfer_queue.retry()}
+
+
+    @app.post("/queue/{job_id}/retry", summary="Повторить передачу немедленно")
+    async def retry_transfer(job_id: int):
+        if not transfer_queue:
+            raise HTTPException(status_code=500, detail="Сервер не инициализирован")
+        if not transfer_queue.retry(job_id):
+            raise HTTPException(status_code=404, detail="Нет такой записи (или она выполняется)")
+        return {"requeued": 1}
+
+
+    @app.delete("/queue/{job_id}", summary="Убрать передачу из очереди")
+    async def delete_transfer(job_id: int):
+        if not transfer_queue:
+            raise HTTPException(status_code=500, detail="Сервер не инициализирован")
+        if not transfer_queue.remove(job_id):
+            raise HTTPException(status_code=404, detail="Нет такой записи")
+        return {"removed": job_id}
+
+
+    @app.post("/mirror", status_code=202, summary="Запустить mirror-синхронизацию в фоне")
+    async def force_mirror(options: MirrorOptions | None = None):
+        if not remote_targets or not ftp_root:
+            raise HTTPException(status_code=500, detail="Сервер не инициализирован")
+        options = options or MirrorOptions()
+        if any(t.mirror_state["is_running"] for t in get_target(options.target)):
+            raise HTTPException(status_code=409, detail="Mirror-синхронизация уже запущена")
+        job = job_manager.start("mirror", options.model_dump(), run_mirror_job)
+        if job is None:
+            raise HTTPException(status_code=409, detail="Mirror-синхронизация уже запущена")
+        return {"job_id": job.id, "status_url": f"/jobs/{job.id}"}
+
+
+    @app.get("/jobs", response_model=list[JobInfo], summary="Последние фоновые задачи")
+    async def list_jobs():
+        return [job.snapshot() for job in job_manager.list()]
+
+
+    @app.get("/jobs/{job_id}", response_model=JobInfo, summary="Прогресс фоновой задачи")
+    async def get_job(job_id: str):
+        job = job_manager.get(job_id)
+        if not job:
+            raise HTTPException(status_code=404, detail="Задача не найдена")
+        return job.snapshot()
+
+
+    @app.post("/jobs/{job_id}/cancel", response_model=JobInfo, summary="Отменить фоновую задачу")
+    async def cancel_job(job_id: str):
+        job = job_manager.get(job_id)
+        if not job:
+            raise HTTPException(status_code=404, detail="Задача не найдена")
+        if job.finished_at is not None:
+            raise HTTPException(status_code=409, detail="Задача уже завершена")
+        job.cancel()
+        return job.snapshot()
+
+
+    @app.get("/mirror/status", summary="Статус mirror-синхронизации")
+    async def get_mirror_status():
+        _, mirror = total_state()
+        return {
+            **mirror,
+            "delete_orphans": CONFIG["mirror_delete_orphans"],
+            "mode": CONFIG["mirror_mode"],
+            "targets": {
+                t.name: {**t.mirror_state, "interval_days": t.settings["mirror_interval_days"]} for t in remote_targets
+            },
+        }
+
+
+    @app.get("/test-connection", summary="Проверка подключения к удалённым FTP")
+    def test_connection(target: str | None = None):
+        if not remote_targets:
+            raise HTTPException(status_code=500, detail="Клиент не инициализирован")
+        results = [
+            {"name": t.name, "host": t.settings["host"], "port": t.settings["port"], "connected": t.client.test_connection()}
+            for t in get_target(target)
+        ]
+        return {"connected": all(r["connected"] for r in results), "targets": results}
+
+
+    @app.get("/metrics", response_class=PlainTextResponse, summary="Метрики в формате Prometheus")
+    async def metrics():
+        return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+    @app.get("/debug/transfers", summary="Последние загрузки с разбивкой по фазам")
+    async def debug_transfers(limit: int = Query(100, ge=1), target: str | None = None, slow: bool = False):
+        if target:
+            get_target(target)
+        return {
+            "size": transfer_traces.size,
+            "slow_seconds": transfer_traces.slow_seconds,
+            "summary": transfer_traces.summary(target),
+            "transfers": transfer_traces.items(limit, target, slow),
+        }
+
+
+    @app.get("/config", summary="Текущая конфигурация")
+    async def get_config():
+        safe = {k: v for k, v in CONFIG.items()}
+        safe["local_ftp_pass"] = "***"
+        safe["remote_targets"] = [{**t, "password": "***"} for t in CONFIG["remote_targets"]]
+        return safe
+
+
+    @app.get("/limits", response_model=RateLimits, summary="Текущие ограничения скорости")
+    async def get_limits():
+        return RateLimits(
+            realtime_kib_per_sec=CONFIG["transfer_realtime_kib"],
+            bulk_kib_per_sec=CONFIG["transfer_bulk_kib"],
+        )
 
 
-@app.get("/files", summary="Список файлов в локальном FTP")
-async def list_files():
-    if not ftp_root:
-        raise HTTPException(status_code=500, detail="Сервер не инициализирован")
-    files = []
-    for f in ftp_root.rglob("*"):
-        if f.is_file():
-            stat = f.stat()
-            files.append({
-                "path": str(f.relative_to(ftp_root)),
-                "size": stat.st_size,
-                "modified": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(stat.st_mtime)),
-            })
-    return {"root": str(ftp_root), "count": len(files), "files": files}
-
-
-@app.post("/mirror", response_model=MirrorResult, summary="Принудительная mirror-синхронизация")
-async def force_mirror(delete_orphans: bool = True):
-    if not remote_client or not ftp_root:
-        raise HTTPException(status_code=500, detail="Сервер не инициализирован")
-    if mirror_state["is_running"]:
-        raise HTTPException(status_code=409, detail="Mirror-синхронизация уже запущена")
-    old_val = CONFIG["mirror_delete_orphans"]
-    CONFIG["mirror_delete_orphans"] = delete_orphans
-    uploaded, deleted, skipped, failed = run_mirror_sync(ftp_root, remote_client)
-    CONFIG["mirror_delete_orphans"] = old_val
-    return MirrorResult(
-        success=len(failed) == 0, uploaded=uploaded, deleted_remote=deleted,
-        skipped=skipped, failed=failed,
-        message=f"Загружено: {len(uploaded)}, удалено: {len(deleted)}, пропущено: {len(skipped)}, ошибок: {len(failed)}",
-    )
+    @app.put("/limits", response_model=RateLimits, summary="Изменить ограничения скорости на лету")
+    async def update_limits(limits: RateLimits):
+        CONFIG["transfer_realtime_kib"] = limits.realtime_kib_per_sec
+        CONFIG["transfer_bulk_kib"] = limits.bulk_kib_per_sec
+        rate_limiters[PRIORITY_REALTIME].set_rate(limits.realtime_kib_per_sec * 1024)
+        rate_limiters[PRIORITY_BULK].set_rate(limits.bulk_kib_per_sec * 1024)
+        logger.info(
+            f"Лимиты скорости: мгновенные {limits.realtime_kib_per_sec} КБ/с, "
+            f"фоновые {limits.bulk_kib_per_sec} КБ/с"
+        )
+        return limits
 
 
-@app.get("/mirror/status", summary="Статус mirror-синхронизации")
-async def get_mirror_status():
-    return {**mirror_state, "interval_days": CONFIG["mirror_interval_days"], "delete_orphans": CONFIG["mirror_delete_orphans"]}
+    @app.put("/config/remote", summary="Обновить настройки удалённого FTP")
+    def update_remote_config(cfg: RemoteConfig):
+        if not remote_targets:
+            raise HTTPException(status_code=500, detail="Клиент не инициализирован")
+        target = get_target(cfg.name)[0] if cfg.name else remote_targets[0]
+        # settings — тот же словарь, что лежит в CONFIG["remote_targets"]
+        target.settings.update(
+            host=cfg.host, port=cfg.port, user=cfg.user, password=cfg.password, root=cfg.root, tls=cfg.tls,
+        )
+        if cfg.engine:
+            target.settings["engine"] = cfg.engine
+        target.connect()
+        ok = target.client.test_connection()
+        return {
+            "updated": True, "connection_test": ok, "name": target.name, "host": cfg.host, "port": cfg.port,
+            "engine": target.settings["engine"],
+        }
 
+    return app
 
-@app.get("/test-connection", summary="Проверка подключения к удалённому FTP")
-async def test_connection():
-    if not remote_client:
-        raise HTTPException(status_code=500, detail="Клиент не инициализирован")
-    ok = remote_client.test_connection()
-    return {"host": CONFIG["remote_ftp_host"], "port": CONFIG["remote_ftp_port"], "connected": ok}
 
+# Запущенный uvicorn — трей останавливает его при выходе
+uv_server = None
 
-@app.get("/config", summary="Текущая конфигурация")
-async def get_config():
-    safe = {k: v for k, v in CONFIG.items()}
-    safe["local_ftp_pass"] = "***"
-    safe["remote_ftp_pass"] = "***"
-    return safe
 
+def run_api_server():
+    """Поток server_thread: импорт uvicorn и FastAPI и работа API на порту 8000."""
+    global uv_server
+    import uvicorn
 
-@app.put("/config/remote", summary="Обновить настройки удалённого FTP")
-async def update_remote_config(cfg: RemoteConfig):
-    CONFIG["remote_ftp_host"] = cfg.host
-    CONFIG["remote_ftp_port"] = cfg.port
-    CONFIG["remote_ftp_user"] = cfg.user
-    CONFIG["remote_ftp_pass"] = cfg.password
-    CONFIG["remote_ftp_root"] = cfg.root
-    CONFIG["remote_ftp_tls"] = cfg.tls
-    init_remote_client()
-    ok = remote_client.test_connection()
-    return {"updated": True, "connection_test": ok, "host": cfg.host, "port": cfg.port}
+    uv_server = uvicorn.Server(uvicorn.Config(create_app(), host="0.0.0.0", port=8000, log_level="info"))
+    uv_server.run()
 
 
 # ─── Системный трей ─────────────────────────────────────────────────────────
 
-def run_tray(uvicorn_server):
-    """Запускает иконку в системном трее (блокирует main thread)."""
+def run_tray():
+    """Запускает иконку в системном трее (блокирует main thread до выхода)."""
+    import pystray
 
     def on_status(icon, item):
+        sync_state, mirror_state = total_state()
         msg = (
             f"Synced: {sync_state['synced_files']}\n"
             f"Failed: {sync_state['failed_files']}\n"
@@ -807,12 +4988,11 @@ def run_tray(uvicorn_server):
         icon.notify(msg, "FTP Sync - Status")
 
     def on_force_sync(icon, item):
-        if remote_client and ftp_root:
-            threading.Thread(
-                target=lambda: remote_client.sync_all(ftp_root),
-                daemon=True,
-            ).start()
-            icon.notify("Sync started...", "FTP Sync")
+        if remote_targets and ftp_root:
+            if job_manager.start("sync", {"force": False, "target": None}, run_sync_job):
+                icon.notify("Sync started...", "FTP Sync")
+            else:
+                icon.notify("Sync is already running", "FTP Sync")
 
     def on_open_config(icon, item):
         os.startfile(str(CONFIG_PATH))
@@ -823,7 +5003,6 @@ def run_tray(uvicorn_server):
 
     def on_exit(icon, item):
         logger.info("Завершение работы по запросу пользователя...")
-        uvicorn_server.should_exit = True
         icon.stop()
 
     icon = pystray.Icon(
@@ -848,19 +5027,24 @@ def run_tray(uvicorn_server):
 # ─── Запуск ──────────────────────────────────────────────────────────────────
 
 if __name__ == "__main__":
-    import uvicorn
+    # Сначала — локальный FTP: после перезапуска службой файлы не должны получать отказ
+    start_services()
+    threading.Thread(target=run_startup_checks, daemon=True, name="checks").start()
 
-    if not run_startup_checks():
-        sys.exit(1)
-
-    # Uvicorn в фоновом потоке
-    uv_config = uvicorn.Config(app, host="0.0.0.0", port=8000, log_level="info")
-    uv_server = uvicorn.Server(uv_config)
+    # Порт API — пока uvicorn его ещё не занял (отказ в подключении приходит сразу)
+    if warning := check_port_free("API", 8000):
+        logger.warning(f"[CHECK] {warning}")
 
-    server_thread = threading.Thread(target=uv_server.run, daemon=True)
+    # Uvicorn в фоновом потоке; FastAPI импортируется уже там
+    server_thread = threading.Thread(target=run_api_server, daemon=True, name="api")
     server_thread.start()
 
     logger.info("Сервер запущен, иконка в трее активна")
 
     # Трей в основном потоке (блокирует до выхода)
-    run_tray(uv_server)
+    run_tray()
+
+    if uv_server:
+        uv_server.should_exit = True
+        server_thread.join(timeout=10)
+    stop_services()